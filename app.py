@@ -1,13 +1,15 @@
 # app.py - Complete School ERP System
 import os
 import secrets
+import hashlib
 from sqlalchemy import and_, or_, func
 import json
 from datetime import datetime, date, timedelta  # ADD timedelta here
 from functools import wraps
+from contextlib import contextmanager
 from string import Template
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_wtf import FlaskForm
@@ -26,8 +28,29 @@ from datetime import datetime, date, timedelta
 from wtforms import StringField, PasswordField, SelectField, SelectMultipleField, IntegerField, EmailField, DateField, BooleanField, SubmitField, ValidationError, FloatField
 
 import csv
-from io import StringIO
-from flask import make_response
+from io import StringIO, BytesIO
+from flask import make_response, g, has_request_context, Response, stream_with_context
+import click
+import threading
+import time
+import math
+import zlib
+import gzip
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+from itertools import chain, islice
+from collections import namedtuple, defaultdict, deque
+from bisect import bisect_left, bisect_right
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import Pool
+from werkzeug.local import LocalProxy
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from pdf_worker import html_to_pdf, weasyprint
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -44,6 +67,20 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # 2MB
+app.config['CONTEXT_CACHE_TTL'] = int(os.environ.get('CONTEXT_CACHE_TTL', 60))  # seconds
+app.config['EXPORT_FOLDER'] = os.environ.get('EXPORT_FOLDER', 'exports')
+app.config['JOB_RESULT_RETENTION_DAYS'] = int(os.environ.get('JOB_RESULT_RETENTION_DAYS', 7))  # downloadable job files
+app.config['PDF_WORKERS'] = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))  # per report card job
+app.config['PDF_REQUEST_WORKERS'] = int(os.environ.get('PDF_REQUEST_WORKERS', 2))  # per web process, for downloads
+app.config['PDF_CACHE_FOLDER'] = os.environ.get('PDF_CACHE_FOLDER', os.path.join(app.config['EXPORT_FOLDER'], 'pdf-cache'))
+app.config['PDF_RENDER_TIMEOUT'] = int(os.environ.get('PDF_RENDER_TIMEOUT', 10))  # seconds a download waits before a 503
+# Opt-in request/SQL profiling: Server-Timing headers, logs/perf.log and /developer/perf
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+app.config['PROFILING_SAMPLE_RATE'] = float(os.environ.get('PROFILING_SAMPLE_RATE', 0.05))  # share of requests logged
+app.config['PROFILING_SLOW_MS'] = int(os.environ.get('PROFILING_SLOW_MS', 1000))  # slower requests are always logged
+app.config['PROFILING_BUFFER_SIZE'] = int(os.environ.get('PROFILING_BUFFER_SIZE', 5000))  # requests kept per process
+# Bearer token for scraping /metrics; without one only developers can read it
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 ALLOWED_EXTENSIONS = {'pdf'}
 
 def allowed_file(filename):
@@ -51,6 +88,8 @@ def allowed_file(filename):
 
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['EXPORT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['PDF_CACHE_FOLDER'], exist_ok=True)
 
 # Initialize extensions
 db = SQLAlchemy(app)
@@ -68,27 +107,70 @@ app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', 'c9748268@gmail.co
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', 'uzemporsbfeesjpy')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', app.config['MAIL_USERNAME'])
 
+# Outbound mail is queued in the outbound_emails table and delivered by a
+# sender thread (or the job worker) over a reused SMTP connection. For local
+# testing point MAIL_SERVER/MAIL_PORT at an SMTP stand-in, e.g.
+#   python -m aiosmtpd -n -l localhost:8025
+# with MAIL_PORT=8025, MAIL_USE_TLS=false, an empty MAIL_USERNAME and a
+# MAIL_DEFAULT_SENDER address.
+app.config['MAIL_SEND_IN_BACKGROUND'] = os.environ.get('MAIL_SEND_IN_BACKGROUND', 'true').lower() == 'true'
+app.config['MAIL_BATCH_SIZE'] = int(os.environ.get('MAIL_BATCH_SIZE', 50))
+app.config['MAIL_IDLE_TIMEOUT'] = int(os.environ.get('MAIL_IDLE_TIMEOUT', 30))  # seconds an idle connection stays open
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_MAX_ATTEMPTS', 5))
+app.config['MAIL_RETENTION_DAYS'] = int(os.environ.get('MAIL_RETENTION_DAYS', 30))  # sent/failed rows kept this long
+
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import smtplib
 
-def send_email(to_email, subject, html_body, text_body=None):
-    """
-    Send an email. Raises an exception if configuration is missing or sending fails.
-    Returns True on success.
-    """
-    # Validate configuration
-    if not app.config['MAIL_SERVER']:
-        raise Exception("MAIL_SERVER not configured in environment variables")
-    if not app.config['MAIL_USERNAME'] or not app.config['MAIL_PASSWORD']:
-        raise Exception("MAIL_USERNAME and MAIL_PASSWORD not configured in environment variables")
-    if not app.config['MAIL_DEFAULT_SENDER']:
-        # Fallback to MAIL_USERNAME if not set
-        app.config['MAIL_DEFAULT_SENDER'] = app.config['MAIL_USERNAME']
-
-    # Create message
+MAIL_POLL_INTERVAL = 5  # seconds between queue checks when nothing wakes the sender
+MAIL_SMTP_TIMEOUT = 15
+MAIL_RETRY_BASE_SECONDS = 30
+MAIL_STALE_AFTER = timedelta(minutes=10)  # 'sending' rows older than this are reclaimed
+
+class OutboundEmail(db.Model):
+    __tablename__ = 'outbound_emails'
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html_body = db.Column(db.Text, nullable=False)
+    text_body = db.Column(db.Text)
+    status = db.Column(db.String(20), default='queued')  # 'queued', 'sending', 'sent', 'failed'
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime)  # not sent after this, e.g. an OTP past its validity
+    locked_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    # Foreign keys
+    school_id = db.Column(db.Integer, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_outbound_emails_status_run_after', 'status', 'run_after'),
+    )
+    
+    def clear_body(self):
+        """Drop the message text (OTPs, temporary passwords) once it is no longer needed"""
+        self.html_body = ''
+        self.text_body = None
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'to_email': self.to_email,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.last_error if self.status != 'sent' else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None
+        }
+
+def build_email_message(to_email, subject, html_body, text_body=None):
+    """Build the multipart message sent for an email"""
     msg = MIMEMultipart('alternative')
-    msg['From'] = app.config['MAIL_DEFAULT_SENDER']
+    msg['From'] = app.config['MAIL_DEFAULT_SENDER'] or app.config['MAIL_USERNAME']
     msg['To'] = to_email
     msg['Subject'] = subject
 
@@ -98,30 +180,213 @@ def send_email(to_email, subject, html_body, text_body=None):
         text_body = re.sub(r'<[^>]+>', '', html_body)
         text_body = text_body.replace('&nbsp;', ' ').replace('&amp;', '&')
 
-    part_text = MIMEText(text_body, 'plain')
-    part_html = MIMEText(html_body, 'html')
-    msg.attach(part_text)
-    msg.attach(part_html)
+    msg.attach(MIMEText(text_body, 'plain'))
+    msg.attach(MIMEText(html_body, 'html'))
+    return msg
 
-    # Try TLS (587) first, fallback to SSL (465)
-    last_error = None
-    for port, use_ssl in [(587, False), (465, True)]:
+class SMTPMailer:
+    """An authenticated SMTP connection reused across messages.
+    
+    The port that last worked is tried first on reconnect, so a server that
+    only speaks SSL on 465 is not retried on 587 for every batch.
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        self.server = None
+        self.endpoint = None  # (port, use_ssl) that last connected
+        self.last_used = 0
+    
+    def candidate_endpoints(self):
+        port = self.config['MAIL_PORT']
+        candidates = [(port, port == 465), (587, False), (465, True)]
+        if self.endpoint:
+            candidates.insert(0, self.endpoint)
+        return list(dict.fromkeys(candidates))
+    
+    def connect(self):
+        host = self.config['MAIL_SERVER']
+        if not host:
+            raise Exception("MAIL_SERVER not configured in environment variables")
+        
+        last_error = None
+        for port, use_ssl in self.candidate_endpoints():
+            server = None
+            try:
+                if use_ssl:
+                    server = smtplib.SMTP_SSL(host, port, timeout=MAIL_SMTP_TIMEOUT)
+                else:
+                    server = smtplib.SMTP(host, port, timeout=MAIL_SMTP_TIMEOUT)
+                    if self.config['MAIL_USE_TLS']:
+                        server.starttls()
+                if self.config['MAIL_USERNAME'] and self.config['MAIL_PASSWORD']:
+                    server.login(self.config['MAIL_USERNAME'], self.config['MAIL_PASSWORD'])
+            except Exception as e:
+                app.logger.error(f"SMTP connection on port {port} failed: {e}")
+                last_error = e
+                if server is not None:
+                    server.close()
+                continue
+            
+            self.server = server
+            self.endpoint = (port, use_ssl)
+            app.logger.info(f"SMTP connected on port {port}{' (SSL)' if use_ssl else ''}")
+            return server
+        
+        raise Exception(f"All SMTP connection attempts failed. Last error: {last_error}")
+    
+    def send(self, msg):
+        started = time.perf_counter()
         try:
-            if use_ssl:
-                server = smtplib.SMTP_SSL(app.config['MAIL_SERVER'], port)
-            else:
-                server = smtplib.SMTP(app.config['MAIL_SERVER'], port)
-                server.starttls()
-            server.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            server.send_message(msg)
-            server.quit()
-            app.logger.info(f"Email sent via {'SSL' if use_ssl else 'TLS'} to {to_email}")
-            return True
-        except Exception as e:
-            app.logger.error(f"Attempt on port {port} failed: {e}")
-            last_error = e
+            if self.server is None:
+                self.connect()
+            try:
+                self.server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # The server dropped an idle connection; reconnect once
+                self.server = None
+                self.connect().send_message(msg)
+        except Exception:
+            SMTP_SEND_FAILURES.inc()
+            raise
+        finally:
+            SMTP_SEND_SECONDS.observe(time.perf_counter() - started)
+        self.last_used = time.monotonic()
+    
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                self.server.close()
+            self.server = None
+    
+    def close_if_idle(self, idle_timeout):
+        if self.server is not None and time.monotonic() - self.last_used > idle_timeout:
+            self.close()
+
+_mailer = SMTPMailer(app.config)
+_mail_wakeup = threading.Event()
+_mail_sender_lock = threading.Lock()
+_mail_sender_thread = None
+
+def send_email(to_email, subject, html_body, text_body=None, expires_at=None):
+    """
+    Queue an email for delivery and commit it. Returns the OutboundEmail,
+    whose status moves to 'sent' or 'failed' once the sender has tried it.
+    An email still undelivered at expires_at fails instead of going out late.
+    """
+    email = OutboundEmail(
+        to_email=to_email,
+        subject=subject,
+        html_body=html_body,
+        text_body=text_body,
+        run_after=datetime.utcnow(),
+        expires_at=expires_at
+    )
+    if has_request_context() and current_user.is_authenticated:
+        email.created_by = current_user.id
+        email.school_id = current_user.school_id
+    db.session.add(email)
+    db.session.commit()
+    
+    if app.config['MAIL_SEND_IN_BACKGROUND']:
+        start_mail_sender()
+        _mail_wakeup.set()
+    return email
+
+def claim_queued_emails(limit):
+    """Lock up to `limit` deliverable emails for this sender"""
+    now = datetime.utcnow()
+    emails = OutboundEmail.query.filter(
+        or_(
+            and_(OutboundEmail.status == 'queued', OutboundEmail.run_after <= now),
+            and_(OutboundEmail.status == 'sending', OutboundEmail.locked_at < now - MAIL_STALE_AFTER)
+        )
+    ).order_by(OutboundEmail.id).limit(limit).with_for_update(skip_locked=True).all()
+    
+    for email in emails:
+        email.status = 'sending'
+        email.locked_at = now
+        email.attempts = (email.attempts or 0) + 1
+    db.session.commit()
+    return emails
+
+def deliver_queued_mail():
+    """Send one batch of queued emails over the shared connection. Returns the batch size."""
+    emails = claim_queued_emails(app.config['MAIL_BATCH_SIZE'])
+    
+    for email in emails:
+        if email.expires_at and email.expires_at <= datetime.utcnow():
+            email.status = 'failed'
+            email.last_error = 'Expired before it could be delivered'
+            email.clear_body()
+            app.logger.warning(f"Email {email.id} to {email.to_email} expired undelivered")
+            db.session.commit()
             continue
-    raise Exception(f"All email attempts failed. Last error: {last_error}")
+        try:
+            _mailer.send(build_email_message(email.to_email, email.subject, email.html_body, email.text_body))
+        except Exception as e:
+            email.last_error = str(e)
+            retry_at = datetime.utcnow() + timedelta(seconds=MAIL_RETRY_BASE_SECONDS * 2 ** (email.attempts - 1))
+            if email.attempts < app.config['MAIL_MAX_ATTEMPTS'] and not (email.expires_at and retry_at >= email.expires_at):
+                email.status = 'queued'
+                email.run_after = retry_at
+            else:
+                email.status = 'failed'
+            app.logger.error(f"Email {email.id} to {email.to_email} failed (attempt {email.attempts}): {e}")
+            if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError)):
+                _mailer.close()
+        else:
+            email.status = 'sent'
+            email.sent_at = datetime.utcnow()
+            email.last_error = None
+            email.clear_body()
+            app.logger.info(f"Email {email.id} sent to {email.to_email}")
+        # Commit per message so delivery status is visible straight away
+        db.session.commit()
+    
+    return len(emails)
+
+def purge_outbound_email(max_age_days):
+    """Delete sent and failed emails older than max_age_days. Returns how many went."""
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    deleted = OutboundEmail.query.filter(
+        OutboundEmail.status.in_(['sent', 'failed']),
+        OutboundEmail.created_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+@app.cli.command('purge-outbound-email')
+@click.option('--max-age-days', default=None, type=int, help='Defaults to MAIL_RETENTION_DAYS')
+def purge_outbound_email_command(max_age_days):
+    """Delete sent and failed emails older than the retention period"""
+    if max_age_days is None:
+        max_age_days = app.config['MAIL_RETENTION_DAYS']
+    print(f"Deleted {purge_outbound_email(max_age_days)} outbound emails")
+
+def mail_sender_loop():
+    """Deliver queued mail whenever woken, keeping the SMTP connection warm between batches"""
+    while True:
+        _mail_wakeup.wait(MAIL_POLL_INTERVAL)
+        _mail_wakeup.clear()
+        with app.app_context():
+            try:
+                while deliver_queued_mail():
+                    pass
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Mail sender error: {e}")
+        _mailer.close_if_idle(app.config['MAIL_IDLE_TIMEOUT'])
+
+def start_mail_sender():
+    """Start this process's mail sender thread if it is not already running"""
+    global _mail_sender_thread
+    with _mail_sender_lock:
+        if _mail_sender_thread is None or not _mail_sender_thread.is_alive():
+            _mail_sender_thread = threading.Thread(target=mail_sender_loop, name='mail-sender', daemon=True)
+            _mail_sender_thread.start()
 
 def get_admin_welcome_email(admin_name, school_name, email, temp_password, login_url):
     html_template = """<!DOCTYPE html>
@@ -412,6 +677,8 @@ def receptionist_debug():
 
 import random
 
+OTP_VALID_FOR = timedelta(minutes=5)
+
 def generate_otp():
     """Generate a 6‑digit numeric OTP."""
     return f"{random.randint(100000, 999999)}"
@@ -433,7 +700,7 @@ def send_otp_email(parent_email, student_name, visitor_name, otp):
         <small>EduManage Pro – School Management System</small>
     </div>
     """
-    send_email(parent_email, subject, html_body)
+    return send_email(parent_email, subject, html_body, expires_at=datetime.utcnow() + OTP_VALID_FOR)
 
 
 # ==================== RECEPTIONIST / VISITOR PASS ROUTES ====================
@@ -551,17 +818,33 @@ def request_visitor_pass():
         'relationship': relationship,
         'purpose': purpose,
         'otp': otp,
-        'otp_expires': (datetime.utcnow() + timedelta(minutes=5)).timestamp()
+        'otp_expires': (datetime.utcnow() + OTP_VALID_FOR).timestamp()
     }
 
-    # Send OTP email
+    # Queue OTP email; the receptionist page polls its delivery status
     try:
-        send_otp_email(student.parent_email, f"{student.first_name} {student.last_name}", visitor_name, otp)
-        return jsonify({'success': True, 'message': f'OTP sent to {student.parent_email}'})
+        email = send_otp_email(student.parent_email, f"{student.first_name} {student.last_name}", visitor_name, otp)
+        return jsonify({
+            'success': True,
+            'message': f'OTP is being sent to {student.parent_email}',
+            'email_id': email.id,
+            'status_url': url_for('email_status', email_id=email.id)
+        })
     except Exception as e:
         return jsonify({'success': False, 'error': f'Failed to send OTP: {str(e)}'})
 
 
+@app.route('/emails/<int:email_id>')
+@login_required
+def email_status(email_id):
+    """Delivery status of a queued email"""
+    email = OutboundEmail.query.get_or_404(email_id)
+    if not (current_user.is_developer or email.created_by == current_user.id or
+            (current_user.is_school_admin and email.school_id == current_user.school_id)):
+        abort(404)
+    return jsonify(email.to_dict())
+
+
 @app.route('/receptionist/verify-otp', methods=['POST'])
 @role_required(['receptionist'])
 def verify_otp_and_create_pass():
@@ -775,6 +1058,27 @@ class Syllabus(db.Model):
     uploader = db.relationship('User', foreign_keys=[uploaded_by])
 
 
+def get_teacher_subjects(teacher_id, session_id):
+    """(Class, Subject) pairs a teacher teaches in a session, resolved in one join.
+    
+    Assignments name their subject as text, so they are matched to the active
+    Subject of the same class and session. A teacher with several subjects in
+    one class gets one pair per subject. Memoized for the request.
+    """
+    def load():
+        return db.session.query(Class, Subject).join(
+            TeacherAssignment, TeacherAssignment.class_id == Class.id
+        ).join(Subject, and_(
+            Subject.class_id == TeacherAssignment.class_id,
+            Subject.session_id == TeacherAssignment.session_id,
+            Subject.name == TeacherAssignment.subject,
+            Subject.is_active == True
+        )).filter(
+            TeacherAssignment.teacher_id == teacher_id,
+            TeacherAssignment.session_id == session_id
+        ).distinct().order_by(Class.name, Subject.name).all()
+    return request_memo(('teacher_subjects', teacher_id, session_id), load)
+
 @app.route('/teacher/syllabus')
 @role_required(['teacher'])
 @school_active_required
@@ -790,32 +1094,22 @@ def teacher_syllabus():
         return redirect(url_for('teacher_dashboard'))
     
     # Get subjects assigned to this teacher in current session
-    assignments = TeacherAssignment.query.filter_by(
-        teacher_id=current_user.id,
-        session_id=view_session.id
-    ).all()
-    
-    subject_ids = []
-    for ass in assignments:
-        subj = Subject.query.filter_by(
-            class_id=ass.class_id,
-            name=ass.subject,
-            session_id=view_session.id,
-            is_active=True
-        ).first()
-        if subj:
-            subject_ids.append(subj.id)
+    teacher_subjects = get_teacher_subjects(current_user.id, view_session.id)
+    subject_ids = [subject.id for _, subject in teacher_subjects]
     
     # Get syllabus for those subjects
     syllabus_list = Syllabus.query.filter(
         Syllabus.subject_id.in_(subject_ids),
         Syllabus.session_id == view_session.id,
         Syllabus.is_active == True
+    ).options(
+        joinedload(Syllabus.subject),
+        joinedload(Syllabus.class_)
     ).order_by(Syllabus.uploaded_at.desc()).all()
     
     return render_template('teacher_syllabus.html',
                          syllabus_list=syllabus_list,
-                         assignments=assignments,
+                         teacher_subjects=teacher_subjects,
                          context=context)
 
 
@@ -833,27 +1127,13 @@ def upload_syllabus():
         flash('No active session', 'warning')
         return redirect(url_for('teacher_dashboard'))
     
-    # Get teacher's assignments for current session
-    assignments = TeacherAssignment.query.filter_by(
-        teacher_id=current_user.id,
-        session_id=view_session.id
-    ).all()
-    
-    # Build a list of subjects with class info
-    subject_choices = []
-    for ass in assignments:
-        subj = Subject.query.filter_by(
-            class_id=ass.class_id,
-            name=ass.subject,
-            session_id=view_session.id,
-            is_active=True
-        ).first()
-        if subj:
-            subject_choices.append({
-                'id': subj.id,
-                'name': subj.name,
-                'class_name': ass.class_.name
-            })
+    # Build a list of the teacher's subjects with class info
+    teacher_subjects = get_teacher_subjects(current_user.id, view_session.id)
+    subject_choices = [{
+        'id': subject.id,
+        'name': subject.name,
+        'class_name': class_obj.name
+    } for class_obj, subject in teacher_subjects]
     
     if request.method == 'POST':
         subject_id = request.form.get('subject_id')
@@ -882,20 +1162,9 @@ def upload_syllabus():
             flash('File size must be less than 2MB', 'danger')
             return redirect(request.url)
         
-        # Get subject and verify it belongs to teacher's assignment
-        subject = Subject.query.get(subject_id)
-        if not subject:
-            flash('Invalid subject', 'danger')
-            return redirect(request.url)
-        
         # Verify teacher is assigned to this subject in current session
-        assignment = TeacherAssignment.query.filter_by(
-            teacher_id=current_user.id,
-            class_id=subject.class_id,
-            session_id=view_session.id,
-            subject=subject.name
-        ).first()
-        if not assignment:
+        subject = next((s for _, s in teacher_subjects if str(s.id) == subject_id), None)
+        if not subject:
             flash('You are not authorized to upload syllabus for this subject', 'danger')
             return redirect(request.url)
         
@@ -1067,6 +1336,13 @@ def toggle_exam_marks_entry(exam_id):
     status = "OPENED" if exam.marks_entry_open else "CLOSED"
     flash(f'Marks entry portal has been {status} for {exam.name} ({exam.class_.name}).', 'success')
     
+    if not exam.marks_entry_open:
+        # Marks are final: build every class's report card ahead of report-card week
+        enqueue_job('generate_report_cards', {
+            'school_id': current_user.school_id,
+            'session_id': exam.session_id
+        })
+    
     return redirect(url_for('manage_exams'))
 
 class CreateReceptionistForm(FlaskForm):
@@ -1112,6 +1388,11 @@ class StudentMarks(db.Model):
     student = db.relationship('Student')
     exam = db.relationship('Exam', back_populates='marks')
     subject = db.relationship('Subject', back_populates='marks')
+    
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'exam_id', 'subject_id', name='uq_student_marks_student_exam_subject'),
+        db.Index('ix_student_marks_exam_subject', 'exam_id', 'subject_id'),
+    )
 
 
 class GradingScale(db.Model):
@@ -1173,215 +1454,659 @@ class GradingScaleForm(FlaskForm):
     description = StringField('Description', validators=[Optional()])
     submit = SubmitField('Save Grade')
 
-@app.route('/admin/class/<int:class_id>/report-card')
-@role_required(['admin', 'teacher'])
-@school_active_required
-def class_report_card(class_id):
-    """Generate professional final report card for all students in a class."""
-    if current_user.must_change_password:
-        return redirect(url_for('change_password'))
+# ==================== GRADING ENGINE ====================
+
+class CompiledGradingScale:
+    """A grading scale compiled into sorted lower bounds for binary search"""
+    
+    def __init__(self, bands):
+        # bands: (min_percentage, max_percentage, grade)
+        self.bands = sorted(tuple(band) for band in bands)
+        self.lower_bounds = [band[0] for band in self.bands]
+        # Highest upper bound among bands starting at or below each index,
+        # so percentages falling in a gap are rejected without scanning
+        self.reach = []
+        for band in self.bands:
+            self.reach.append(max(band[1], self.reach[-1]) if self.reach else band[1])
+    
+    def grade(self, percentage):
+        index = bisect_right(self.lower_bounds, percentage) - 1
+        if index < 0 or self.reach[index] < percentage:
+            return 'N/A'
+        # Overlapping bands: prefer the one with the highest lower bound
+        while self.bands[index][1] < percentage:
+            index -= 1
+        return self.bands[index][2]
+    
+    def grade_all(self, percentages):
+        return [self.grade(percentage) for percentage in percentages]
+
+def compile_grading_scale(school_id):
+    """A school's active grading scale, loaded and compiled once per request"""
+    def load():
+        return CompiledGradingScale(db.session.execute(
+            db.select(GradingScale.min_percentage, GradingScale.max_percentage, GradingScale.grade).where(
+                GradingScale.school_id == school_id,
+                GradingScale.is_active == True
+            )
+        ).all())
+    if has_request_context():
+        return request_memo(('grading_scale', school_id), load)
+    return load()
 
-    context = get_school_context()
-    view_session = context.get('view_session') or context['current_session']
-    if not view_session:
-        flash('No active session', 'warning')
-        return redirect(url_for('admin_dashboard'))
+def compute_results(student_ids, subject_ids, cells, scale):
+    """Totals, grades, ranks, percentiles and toppers for a students x subjects grid.
+    
+    `cells` maps (student_id, subject_id) to (obtained, max); missing cells
+    count as nothing out of nothing. Ranks are competition ranks (1, 2, 2, 4)
+    on the percentage as displayed, so equal percentages share a rank.
+    """
+    students = {}
+    cell_results = {}
+    subject_scores = {subject_id: [] for subject_id in subject_ids}
+    
+    for student_id in student_ids:
+        total_obtained = 0
+        total_max = 0
+        for subject_id in subject_ids:
+            obtained, maximum = cells.get((student_id, subject_id), (0, 0))
+            percentage = (obtained / maximum * 100) if maximum > 0 else 0
+            cell_results[(student_id, subject_id)] = {
+                'percentage': round(percentage, 2),
+                'grade': scale.grade(percentage)
+            }
+            if maximum > 0:
+                subject_scores[subject_id].append((percentage, student_id))
+            total_obtained += obtained
+            total_max += maximum
+        
+        percentage = (total_obtained / total_max * 100) if total_max > 0 else 0
+        students[student_id] = {
+            'total_obtained': total_obtained,
+            'total_max': total_max,
+            'percentage': round(percentage, 2),
+            'grade': scale.grade(percentage)
+        }
+    
+    ranking = sorted(student_ids, key=lambda student_id: students[student_id]['percentage'], reverse=True)
+    ordered = sorted(result['percentage'] for result in students.values())
+    rank, previous = 0, None
+    for position, student_id in enumerate(ranking, start=1):
+        result = students[student_id]
+        if result['percentage'] != previous:
+            rank, previous = position, result['percentage']
+        below = bisect_left(ordered, result['percentage'])
+        tied = bisect_right(ordered, result['percentage']) - below
+        result['rank'] = rank
+        result['percentile'] = round((below + tied / 2) / len(ordered) * 100, 1)
+    
+    subjects = {}
+    for subject_id, scores in subject_scores.items():
+        highest = max((percentage for percentage, _ in scores), default=None)
+        subjects[subject_id] = {
+            'highest': round(highest, 2) if scores else None,
+            'average': round(sum(percentage for percentage, _ in scores) / len(scores), 2) if scores else None,
+            'toppers': [student_id for percentage, student_id in scores if percentage == highest]
+        }
+    
+    return {'students': students, 'subjects': subjects, 'cells': cell_results, 'ranking': ranking}
 
-    # Verify class belongs to school and session
-    class_obj = Class.query.filter_by(
-        id=class_id,
-        school_id=current_user.school_id,
-        session_id=view_session.id,
-        is_active=True
-    ).first_or_404()
+# ==================== REPORT CARD SNAPSHOTS ====================
+# Class report cards are stored serialized per (class, session). Writes that
+# change a card bump marks_version in the same transaction (flush hook for
+# ORM writes, direct calls from the bulk upserts); a snapshot is served
+# only while its data_version matches, otherwise it is rebuilt on view.
+
+REPORT_CARD_TERMS = ['Term 1', 'Term 2', 'Final']
+REPORT_CARD_CLASS_MODELS = {'Exam', 'Subject', 'StudentEnrollment', 'AttendanceSummary'}
+REPORT_CARD_SCHOOL_MODELS = {'GradingScale', 'Student'}
+
+class ReportCardSnapshot(db.Model):
+    __tablename__ = 'report_card_snapshots'
+    id = db.Column(db.Integer, primary_key=True)
+    marks_version = db.Column(db.Integer, default=0, nullable=False)
+    data_version = db.Column(db.Integer)
+    data = db.Column(db.Text)
+    generated_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Foreign keys
+    class_id = db.Column(db.Integer, db.ForeignKey('classes.id', ondelete='CASCADE'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('academic_sessions.id', ondelete='CASCADE'), nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('class_id', 'session_id', name='uq_report_card_snapshot_class_session'),
+    )
+
+def report_card_invalidation(class_ids=(), exam_ids=(), school_ids=(), session_ids=(), all_classes=False):
+    """UPDATE bumping marks_version for the snapshots in scope, or None"""
+    snapshots = ReportCardSnapshot.__table__
+    conditions = [db.true()] if all_classes else []
+    if class_ids:
+        conditions.append(snapshots.c.class_id.in_(list(class_ids)))
+    if exam_ids:
+        conditions.append(snapshots.c.class_id.in_(
+            db.select(Exam.class_id).where(Exam.id.in_(list(exam_ids)))
+        ))
+    if school_ids:
+        conditions.append(snapshots.c.class_id.in_(
+            db.select(Class.id).where(Class.school_id.in_(list(school_ids)))
+        ))
+    if session_ids:
+        conditions.append(snapshots.c.session_id.in_(list(session_ids)))
+    if not conditions:
+        return None
+    return snapshots.update().where(or_(*conditions)).values(
+        marks_version=snapshots.c.marks_version + 1
+    )
 
-    # Get all exams for this class in the current session, ordered by term
+def invalidate_report_cards(**scope):
+    """Mark report card snapshots stale within the caller's transaction"""
+    statement = report_card_invalidation(**scope)
+    if statement is not None:
+        db.session.execute(statement)
+
+@event.listens_for(db.session, 'before_flush')
+def track_report_card_writes(session, flush_context, instances):
+    """Collect the classes whose report cards a flush will change"""
+    scope = session.info.setdefault('report_card_scope', {'class_ids': set(), 'exam_ids': set(), 'school_ids': set()})
+    for obj in chain(session.new, session.dirty, session.deleted):
+        model = type(obj).__name__
+        if model == 'StudentMarks' and obj.exam_id:
+            scope['exam_ids'].add(obj.exam_id)
+        elif model in REPORT_CARD_CLASS_MODELS and obj.class_id:
+            scope['class_ids'].add(obj.class_id)
+        elif model in REPORT_CARD_SCHOOL_MODELS and obj.school_id:
+            scope['school_ids'].add(obj.school_id)
+
+@event.listens_for(db.session, 'after_flush')
+def invalidate_flushed_report_cards(session, flush_context):
+    statement = report_card_invalidation(**session.info.pop('report_card_scope', {}))
+    if statement is not None:
+        session.connection().execute(statement)
+
+def build_class_report_card(class_obj, session_id):
+    """Compute a class's final report card as JSON-serializable data"""
+    # Get all exams for this class in the session, ordered by term
     exams = Exam.query.filter_by(
-        class_id=class_id,
-        session_id=view_session.id
+        class_id=class_obj.id,
+        session_id=session_id
     ).order_by(Exam.start_date).all()
 
     # Group exams by term (adjust terms as per your system)
-    term_order = ['Term 1', 'Term 2', 'Final']
     exam_by_term = {}
     for exam in exams:
-        if exam.term in term_order:
+        if exam.term in REPORT_CARD_TERMS:
             exam_by_term[exam.term] = exam
 
     # Get all subjects for this class in this session
     subjects = Subject.query.filter_by(
-        class_id=class_id,
-        session_id=view_session.id,
+        class_id=class_obj.id,
+        session_id=session_id,
         is_active=True
     ).order_by(Subject.name).all()
 
     # Get all students enrolled in this class
     enrollments = StudentEnrollment.query.filter_by(
-        class_id=class_id,
-        session_id=view_session.id,
+        class_id=class_obj.id,
+        session_id=session_id,
         is_active=True
-    ).order_by(StudentEnrollment.roll_number).all()
+    ).options(joinedload(StudentEnrollment.student)).order_by(StudentEnrollment.roll_number).all()
 
-    # Pre-fetch all marks for efficiency
-    # Build a nested dict: marks[student_id][exam_id][subject_id] = mark object
+    # Fetch all marks in one query: marks[student_id][exam_id][subject_id] = mark object
     marks = {}
-    for enrollment in enrollments:
-        student_id = enrollment.student_id
-        marks[student_id] = {}
-        for exam in exams:
-            marks[student_id][exam.id] = {}
-        # Get all marks for this student in this class
-        student_marks = StudentMarks.query.filter(
-            StudentMarks.student_id == student_id,
-            StudentMarks.exam_id.in_([e.id for e in exams])
-        ).all()
-        for m in student_marks:
-            marks[student_id][m.exam_id][m.subject_id] = m
+    for m in StudentMarks.query.filter(StudentMarks.exam_id.in_([e.id for e in exams])):
+        marks.setdefault(m.student_id, {}).setdefault(m.exam_id, {})[m.subject_id] = m
 
     # Fetch attendance summaries for all students in one query
     attendance_summaries = AttendanceSummary.query.filter(
         AttendanceSummary.student_id.in_([e.student_id for e in enrollments]),
-        AttendanceSummary.session_id == view_session.id
+        AttendanceSummary.session_id == session_id
     ).all()
     attendance_dict = {s.student_id: s for s in attendance_summaries}
 
-    # Get grading scales for the school
-    grading_scales = GradingScale.query.filter_by(
-        school_id=current_user.school_id,
-        is_active=True
-    ).all()
-
-    def get_grade(percentage):
-        for scale in grading_scales:
-            if scale.min_percentage <= percentage <= scale.max_percentage:
-                return scale.grade
-        return 'N/A'
-
-    # Build report data for each student
-    report_data = []
+    # Per-subject totals across terms feed the grading engine
+    term_marks = {}
+    cells = {}
     for enrollment in enrollments:
-        student = enrollment.student
-        attendance = attendance_dict.get(student.id)
-        student_marks = marks.get(student.id, {})
-        subject_rows = []
-        total_obtained_all = 0
-        total_max_all = 0
-
+        student_marks = marks.get(enrollment.student_id, {})
         for subject in subjects:
-            # Collect marks for each term
-            term_marks = {}
+            terms = {}
             for term_name, exam in exam_by_term.items():
                 mark_obj = student_marks.get(exam.id, {}).get(subject.id)
-                if mark_obj:
-                    term_marks[term_name] = {
-                        'obtained': mark_obj.marks_obtained,
-                        'max': mark_obj.max_marks,
-                        'grade': mark_obj.grade
-                    }
-                else:
-                    term_marks[term_name] = None
-
-            # Calculate subject total (sum of marks obtained across all terms)
-            subject_total_obtained = sum(
-                m['obtained'] for m in term_marks.values() if m
+                terms[term_name] = {
+                    'obtained': mark_obj.marks_obtained,
+                    'max': mark_obj.max_marks,
+                    'grade': mark_obj.grade
+                } if mark_obj else None
+            term_marks[(enrollment.student_id, subject.id)] = terms
+            cells[(enrollment.student_id, subject.id)] = (
+                sum(m['obtained'] for m in terms.values() if m),
+                sum(m['max'] for m in terms.values() if m)
             )
-            subject_total_max = sum(
-                m['max'] for m in term_marks.values() if m
-            )
-            subject_percentage = (subject_total_obtained / subject_total_max * 100) if subject_total_max > 0 else 0
-            subject_grade = get_grade(subject_percentage)
 
-            subject_rows.append({
-                'subject': subject,
-                'term1': term_marks.get('Term 1'),
-                'term2': term_marks.get('Term 2'),
-                'final': term_marks.get('Final'),
-                'total_obtained': subject_total_obtained,
-                'total_max': subject_total_max,
-                'percentage': round(subject_percentage, 2),
-                'grade': subject_grade
-            })
+    scale = compile_grading_scale(class_obj.school_id)
+    results = compute_results(
+        [e.student_id for e in enrollments],
+        [s.id for s in subjects],
+        cells,
+        scale
+    )
 
-            total_obtained_all += subject_total_obtained
-            total_max_all += subject_total_max
+    # Build report data for each student, best rank first
+    enrollment_by_student = {e.student_id: e for e in enrollments}
+    sorted_report = []
+    for student_id in results['ranking']:
+        enrollment = enrollment_by_student[student_id]
+        student = enrollment.student
+        attendance = attendance_dict.get(student_id)
+        result = results['students'][student_id]
 
-        overall_percentage = (total_obtained_all / total_max_all * 100) if total_max_all > 0 else 0
-        overall_grade = get_grade(overall_percentage)
+        subject_rows = []
+        for subject in subjects:
+            terms = term_marks[(student_id, subject.id)]
+            obtained, maximum = cells[(student_id, subject.id)]
+            cell = results['cells'][(student_id, subject.id)]
+            subject_rows.append({
+                'subject': {'id': subject.id, 'name': subject.name},
+                'term1': terms.get('Term 1'),
+                'term2': terms.get('Term 2'),
+                'final': terms.get('Final'),
+                'total_obtained': obtained,
+                'total_max': maximum,
+                'percentage': cell['percentage'],
+                'grade': cell['grade']
+            })
 
-        report_data.append({
-            'student': student,
+        sorted_report.append({
+            'student': {
+                'id': student.id,
+                'student_id': student.student_id,
+                'first_name': student.first_name,
+                'last_name': student.last_name,
+                'father_name': student.father_name,
+                'mother_name': student.mother_name
+            },
             'roll_number': enrollment.roll_number,
             'subjects': subject_rows,
-            'total_obtained': total_obtained_all,
-            'total_max': total_max_all,
-            'overall_percentage': round(overall_percentage, 2),
-            'overall_grade': overall_grade,
+            'total_obtained': result['total_obtained'],
+            'total_max': result['total_max'],
+            'overall_percentage': result['percentage'],
+            'overall_grade': result['grade'],
+            'rank': result['rank'],
+            'percentile': result['percentile'],
             'attendance': {
-                'total_days': attendance.total_days if attendance else 0,
-                'present_days': attendance.present_days if attendance else 0,
-                'percentage': attendance.attendance_percentage if attendance else 0
+                'total_days': attendance.total_days,
+                'present_days': attendance.present_days,
+                'percentage': attendance.attendance_percentage
             } if attendance else None
         })
 
-    # Calculate class rank based on overall percentage
-    sorted_report = sorted(report_data, key=lambda x: x['overall_percentage'], reverse=True)
-    for idx, data in enumerate(sorted_report, 1):
-        data['rank'] = idx
+    # Grading scale writes mark snapshots stale, so the legend stays current too
+    grading_scale = [
+        {'grade': grade, 'min_percentage': low, 'max_percentage': high}
+        for low, high, grade in reversed(scale.bands)
+    ]
+    return {'terms': REPORT_CARD_TERMS, 'report_data': sorted_report, 'grading_scale': grading_scale}
+
+def get_class_report_card(class_obj, session_id):
+    """A class's report card, served from its snapshot while it is current"""
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    
+    snapshots = ReportCardSnapshot.__table__
+    in_scope = and_(snapshots.c.class_id == class_obj.id, snapshots.c.session_id == session_id)
+    snapshot = db.session.execute(
+        db.select(snapshots.c.marks_version, snapshots.c.data_version, snapshots.c.data).where(in_scope)
+    ).first()
+    
+    if snapshot and snapshot.data is not None and snapshot.data_version == snapshot.marks_version:
+        return json.loads(snapshot.data)
+    
+    if snapshot:
+        version = snapshot.marks_version
+    else:
+        # Create the row before computing so writes made meanwhile bump its version
+        with db.engine.begin() as connection:
+            connection.execute(pg_insert(snapshots).values(
+                class_id=class_obj.id, session_id=session_id, marks_version=0, created_at=datetime.utcnow()
+            ).on_conflict_do_nothing(constraint='uq_report_card_snapshot_class_session'))
+            version = connection.execute(db.select(snapshots.c.marks_version).where(in_scope)).scalar()
+    
+    report = build_class_report_card(class_obj, session_id)
+    
+    # Stored under the version read above; if marks changed while building,
+    # the versions differ and the next view rebuilds it
+    with db.engine.begin() as connection:
+        connection.execute(snapshots.update().where(in_scope).values(
+            data=json.dumps(report), data_version=version, generated_at=datetime.utcnow()
+        ))
+    return report
+
+@app.route('/admin/class/<int:class_id>/report-card')
+@role_required(['admin', 'teacher'])
+@school_active_required
+def class_report_card(class_id):
+    """Generate professional final report card for all students in a class."""
+    if current_user.must_change_password:
+        return redirect(url_for('change_password'))
+
+    context = get_school_context()
+    view_session = context.get('view_session') or context['current_session']
+    if not view_session:
+        flash('No active session', 'warning')
+        return redirect(url_for('admin_dashboard'))
+
+    # Verify class belongs to school and session
+    class_obj = Class.query.filter_by(
+        id=class_id,
+        school_id=current_user.school_id,
+        session_id=view_session.id,
+        is_active=True
+    ).first_or_404()
+
+    report = get_class_report_card(class_obj, view_session.id)
 
     return render_template('admin_class_report_card.html',
                            class_obj=class_obj,
-                           report_data=sorted_report,
-                           terms=term_order,
+                           report_data=report['report_data'],
+                           terms=report['terms'],
                            context=context,
-                           grading_scales=grading_scales)
-
-def get_grade_from_percentage(school_id, percentage):
-    """Return grade letter based on school's grading scale."""
-    scale = GradingScale.query.filter(
-        GradingScale.school_id == school_id,
-        GradingScale.is_active == True,
-        GradingScale.min_percentage <= percentage,
-        GradingScale.max_percentage >= percentage
-    ).first()
-    return scale.grade if scale else 'N/A'
-# ==================== RESULT MANAGEMENT ROUTES ====================
+                           grading_scales=report['grading_scale'])
 
-@app.route('/admin/exams')
-@role_required(['admin'])
+@app.route('/admin/class/<int:class_id>/report-card/pdf', methods=['POST'])
+@role_required(['admin', 'teacher'])
 @school_active_required
-def manage_exams():
-    """List all exams for the current session"""
+def class_report_card_pdfs(class_id):
+    """Queue printable PDF report cards for one class"""
     if current_user.must_change_password:
         return redirect(url_for('change_password'))
-    
+
     context = get_school_context()
     view_session = context.get('view_session') or context['current_session']
-    
-    exams = Exam.query.filter_by(
-        session_id=view_session.id
-    ).order_by(Exam.start_date.desc()).all()
-    
-    return render_template('admin_manage_exams.html',
-                         context=context,
-                         exams=exams)
+    if not view_session:
+        flash('No active session', 'warning')
+        return redirect(url_for('admin_dashboard'))
+
+    class_obj = Class.query.filter_by(
+        id=class_id,
+        school_id=current_user.school_id,
+        session_id=view_session.id,
+        is_active=True
+    ).first_or_404()
 
+    job = enqueue_job('report_card_pdfs', {
+        'school_id': current_user.school_id,
+        'session_id': view_session.id,
+        'class_id': class_obj.id
+    }, school_id=current_user.school_id)
+    return job_status_redirect(job, url_for('class_report_card', class_id=class_obj.id))
 
-@app.route('/admin/exams/create', methods=['GET', 'POST'])
+@app.route('/admin/report-cards/pdf', methods=['POST'])
 @role_required(['admin'])
 @school_active_required
-def create_exam():
+def school_report_card_pdfs():
+    """Queue printable PDF report cards for every class in the session"""
     if current_user.must_change_password:
         return redirect(url_for('change_password'))
-    
-    form = ExamForm()
+
     context = get_school_context()
     view_session = context.get('view_session') or context['current_session']
+    if not view_session:
+        flash('No active session', 'warning')
+        return redirect(url_for('admin_dashboard'))
+
+    job = enqueue_job('report_card_pdfs', {
+        'school_id': current_user.school_id,
+        'session_id': view_session.id
+    }, school_id=current_user.school_id)
+    return job_status_redirect(job, url_for('manage_classes'))
+
+def get_grade_from_percentage(school_id, percentage):
+    """Return grade letter based on school's grading scale."""
+    return compile_grading_scale(school_id).grade(percentage)
+# ==================== PDF RENDERING ====================
+
+PDF_PENDING_PER_WORKER = 4  # documents queued ahead of each pool worker
+PDF_RETRY_AFTER = 5  # seconds, for downloads answered 503 while their PDF renders
+
+def pdf_process_context():
+    """Start pool processes fresh: a fork would copy the parent's database
+    connections and mail sender thread"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def render_pdfs(documents, workers=None):
+    """Render (name, html) pairs across a process pool, yielding (name, pdf) as each finishes.
     
-    # Populate class choices (all active classes in the current session)
-    classes = Class.query.filter_by(
-        school_id=current_user.school_id,
-        session_id=view_session.id,
-        is_active=True
+    Documents are pulled lazily and only a few per worker are in flight, so
+    the HTML for a whole school is never held in memory at once.
+    """
+    workers = workers or app.config['PDF_WORKERS']
+    documents = iter(documents)
+    pending = {}
+    
+    def submit(count):
+        for name, html in islice(documents, count):
+            pending[executor.submit(html_to_pdf, html, app.root_path)] = name
+    
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pdf_process_context()) as executor:
+        submit(workers * PDF_PENDING_PER_WORKER)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+            submit(workers * PDF_PENDING_PER_WORKER - len(pending))
+
+_pdf_executor = None
+_pdf_renders = {}  # digest -> future of a download's render in progress
+_pdf_executor_lock = threading.Lock()
+
+def cache_rendered_pdf(digest, path, future):
+    """Done callback: write a finished render to the cache, even if its request gave up waiting"""
+    with _pdf_executor_lock:
+        _pdf_renders.pop(digest, None)
+    if future.cancelled() or future.exception() is not None:
+        return
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(future.result())
+    os.replace(temp_path, path)
+
+def start_pdf_render(html, digest, path):
+    """Future for the PDF of `html`, joining a render of the same document
+    already in progress. Returns None when the download pool is full."""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        future = _pdf_renders.get(digest)
+        if future is not None:
+            return future
+        workers = app.config['PDF_REQUEST_WORKERS']
+        if len(_pdf_renders) >= workers * PDF_PENDING_PER_WORKER:
+            return None
+        if _pdf_executor is None:
+            _pdf_executor = ProcessPoolExecutor(max_workers=workers, mp_context=pdf_process_context())
+        future = _pdf_executor.submit(html_to_pdf, html, app.root_path)
+        _pdf_renders[digest] = future
+    future.add_done_callback(lambda done: cache_rendered_pdf(digest, path, done))
+    return future
+
+def pdf_busy_response(message):
+    response = make_response(message, 503)
+    response.headers['Retry-After'] = str(PDF_RETRY_AFTER)
+    return response
+
+def pdf_response(html, filename):
+    """Serve HTML as an inline PDF, cached on disk by content hash.
+    
+    The hash of the rendered HTML doubles as the ETag, so a client holding
+    the current version gets a 304 without any PDF work, and identical
+    documents are only ever converted once. A render still running after
+    PDF_RENDER_TIMEOUT is answered with a 503 and Retry-After; it carries on
+    in the pool and the retry is served from the cache.
+    """
+    digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(digest):
+        response = make_response('', 304)
+    else:
+        path = os.path.join(app.config['PDF_CACHE_FOLDER'], f'{digest}.pdf')
+        if os.path.exists(path):
+            response = send_file(os.path.abspath(path), mimetype='application/pdf', download_name=filename)
+        else:
+            if weasyprint is None:
+                abort(503, description='PDF rendering is not available on this server')
+            future = start_pdf_render(html, digest, path)
+            if future is None:
+                return pdf_busy_response('The PDF service is busy, please try again shortly.')
+            try:
+                pdf = future.result(timeout=app.config['PDF_RENDER_TIMEOUT'])
+            except FuturesTimeoutError:
+                return pdf_busy_response('Your PDF is still being prepared, please try again shortly.')
+            # The done callback writes the cache file; this response need not wait for it
+            response = send_file(BytesIO(pdf), mimetype='application/pdf', download_name=filename)
+    response.set_etag(digest)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.cli.command('prune-pdf-cache')
+@click.option('--max-age-days', default=7, help='Delete cached PDFs not read for this many days')
+def prune_pdf_cache_command(max_age_days):
+    """Delete stale files from PDF_CACHE_FOLDER"""
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    with os.scandir(app.config['PDF_CACHE_FOLDER']) as entries:
+        for entry in entries:
+            if entry.is_file() and max(entry.stat().st_atime, entry.stat().st_mtime) < cutoff:
+                os.remove(entry.path)
+                removed += 1
+    print(f"Removed {removed} cached PDFs")
+
+def report_card_documents(class_obj, session_obj, school):
+    """One printable report card page per student in a class, as (name, html)"""
+    report = get_class_report_card(class_obj, session_obj.id)
+    context = {'school': school, 'current_session': session_obj}
+    for data in report['report_data']:
+        html = render_template('admin_class_report_card.html',
+                               class_obj=class_obj,
+                               report_data=[data],
+                               terms=report['terms'],
+                               context=context,
+                               pdf=True)
+        name = secure_filename(f"{data['roll_number'] or 0:03d}_{data['student']['student_id']}.pdf")
+        yield f'{secure_filename(class_obj.name)}/{name}', html
+
+# ==================== MARKS MATRIX ====================
+
+def load_marks_matrix(exam_id, subject_ids=None):
+    """All marks for an exam in one query, keyed by (student_id, subject_id)"""
+    query = StudentMarks.query.filter(StudentMarks.exam_id == exam_id)
+    if subject_ids is not None:
+        query = query.filter(StudentMarks.subject_id.in_(subject_ids))
+    return {(mark.student_id, mark.subject_id): mark for mark in query}
+
+def upsert_marks(exam_id, rows):
+    """Write a grid of marks with one INSERT ... ON CONFLICT on (student, exam, subject).
+    
+    `rows` are dicts with student_id, subject_id, marks_obtained, max_marks
+    and grade. The caller commits. Returns the number of rows written.
+    """
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    
+    if not rows:
+        return 0
+    
+    now = datetime.utcnow()
+    statement = pg_insert(StudentMarks.__table__).values([
+        dict(row, exam_id=exam_id, created_at=now, updated_at=now) for row in rows
+    ])
+    db.session.execute(statement.on_conflict_do_update(
+        constraint='uq_student_marks_student_exam_subject',
+        set_={
+            'marks_obtained': statement.excluded.marks_obtained,
+            'max_marks': statement.excluded.max_marks,
+            'grade': statement.excluded.grade,
+            'updated_at': statement.excluded.updated_at
+        }
+    ))
+    invalidate_report_cards(exam_ids=[exam_id])
+    return len(rows)
+
+def parse_subject_marks_form(form, enrollments, subject_id, default_max):
+    """Parse a one-subject marks form in a single pass.
+    
+    Rows left blank are skipped. Each filled row is checked for numeric
+    values, a max mark no higher than the subject's default_max_marks and
+    marks within 0..max. Returns (rows, errors) where errors maps
+    student_id to a message.
+    """
+    rows, errors = [], {}
+    for enrollment in enrollments:
+        student_id = enrollment.student_id
+        obtained_str = (form.get(f'obtained_{student_id}') or '').strip()
+        max_str = (form.get(f'max_{student_id}') or '').strip()
+        if not obtained_str or not max_str:
+            continue
+        
+        try:
+            obtained = float(obtained_str)
+            max_marks = float(max_str)
+        except ValueError:
+            errors[student_id] = 'Marks must be numeric values.'
+            continue
+        
+        if not 0 < max_marks <= default_max:
+            errors[student_id] = f'Max marks must be between 0 and {default_max:g}.'
+        elif not 0 <= obtained <= max_marks:
+            errors[student_id] = f'Marks must be between 0 and {max_marks:g}.'
+        else:
+            grade_str = form.get(f'grade_{student_id}')
+            rows.append({
+                'student_id': student_id,
+                'subject_id': subject_id,
+                'marks_obtained': obtained,
+                'max_marks': max_marks,
+                'grade': grade_str.strip() if grade_str else None
+            })
+    return rows, errors
+
+# ==================== RESULT MANAGEMENT ROUTES ====================
+
+@app.route('/admin/exams')
+@role_required(['admin'])
+@school_active_required
+def manage_exams():
+    """List all exams for the current session"""
+    if current_user.must_change_password:
+        return redirect(url_for('change_password'))
+    
+    context = get_school_context()
+    view_session = context.get('view_session') or context['current_session']
+    
+    exams = Exam.query.filter_by(
+        session_id=view_session.id
+    ).order_by(Exam.start_date.desc()).all()
+    
+    return render_template('admin_manage_exams.html',
+                         context=context,
+                         exams=exams)
+
+
+@app.route('/admin/exams/create', methods=['GET', 'POST'])
+@role_required(['admin'])
+@school_active_required
+def create_exam():
+    if current_user.must_change_password:
+        return redirect(url_for('change_password'))
+    
+    form = ExamForm()
+    context = get_school_context()
+    view_session = context.get('view_session') or context['current_session']
+    
+    # Populate class choices (all active classes in the current session)
+    classes = Class.query.filter_by(
+        school_id=current_user.school_id,
+        session_id=view_session.id,
+        is_active=True
     ).all()
     form.class_ids.choices = [(c.id, f"{c.name} ({c.code})") for c in classes]
     
@@ -1430,49 +2155,31 @@ def teacher_exams():
         flash('No active session', 'warning')
         return redirect(url_for('teacher_dashboard'))
     
-    # Get teacher's assignments for this session
-    assignments = TeacherAssignment.query.filter_by(
-        teacher_id=current_user.id,
-        session_id=view_session.id
-    ).all()
+    # Subjects the teacher teaches, grouped by class (a class may have several)
+    subjects_by_class = {}
+    for class_obj, subject in get_teacher_subjects(current_user.id, view_session.id):
+        subjects_by_class.setdefault(class_obj.id, []).append(subject)
     
-    if not assignments:
+    if not subjects_by_class:
         flash('You are not assigned to any classes this session.', 'info')
         return redirect(url_for('teacher_dashboard'))
     
-    # Collect class ids and subjects the teacher teaches
-    class_ids = [a.class_id for a in assignments]
-    teacher_subjects = {a.class_id: a.subject for a in assignments}
-    
     # Get all exams for those classes
     exams = Exam.query.filter(
-        Exam.class_id.in_(class_ids),
+        Exam.class_id.in_(subjects_by_class),
         Exam.session_id == view_session.id
-    ).order_by(Exam.class_id, Exam.start_date).all()
+    ).options(joinedload(Exam.class_)).order_by(Exam.class_id, Exam.start_date).all()
     
-    # Build a structure: for each exam, list the subjects the teacher can enter
+    # Build a structure: one row per exam and subject the teacher can enter
     exam_data = []
     for exam in exams:
-        # Find subjects the teacher teaches in this exam's class
-        subject = teacher_subjects.get(exam.class_id)
-        if not subject:
-            continue
-        
-        # Get subject id(s) that match the teacher's subject name (case‑sensitive!)
-        subject_obj = Subject.query.filter_by(
-            class_id=exam.class_id,
-            name=subject,                # must exactly match Subject.name
-            session_id=view_session.id
-        ).first()
-        if not subject_obj:
-            continue
-        
-        exam_data.append({
-            'exam': exam,
-            'class': exam.class_,
-            'subject': subject_obj,
-            'subject_name': subject
-        })
+        for subject in subjects_by_class[exam.class_id]:
+            exam_data.append({
+                'exam': exam,
+                'class': exam.class_,
+                'subject': subject,
+                'subject_name': subject.name
+            })
     
     return render_template('teacher_exams.html', exam_data=exam_data, context=context)
 
@@ -1529,66 +2236,43 @@ def teacher_enter_marks(exam_id, subject_id):
         flash('Invalid exam or subject combination.', 'danger')
         return redirect(url_for('teacher_exams'))
 
+    # Only the subject's own teachers may enter its marks
+    if not any(s.id == subject.id for _, s in get_teacher_subjects(current_user.id, exam.session_id)):
+        flash('You are not assigned to teach this subject.', 'danger')
+        return redirect(url_for('teacher_exams'))
+
     # Fetch all students enrolled in this class for the current session
-    enrollments = StudentEnrollment.query.filter_by(
+    enrollment_query = StudentEnrollment.query.filter_by(
         class_id=exam.class_id,
         session_id=exam.session_id
-    ).order_by(StudentEnrollment.roll_number).all()
+    ).options(joinedload(StudentEnrollment.student)).order_by(StudentEnrollment.roll_number)
+    enrollments = enrollment_query.all()
+
+    # Default max marks (fallback)
+    default_max = subject.default_max_marks if subject.default_max_marks else 100
+    errors = {}
 
     if request.method == 'POST':
+        rows, errors = parse_subject_marks_form(request.form, enrollments, subject.id, default_max)
         try:
-            for enrollment in enrollments:
-                student_id = enrollment.student_id
-                obtained_str = request.form.get(f'obtained_{student_id}')
-                max_str = request.form.get(f'max_{student_id}')
-                grade_str = request.form.get(f'grade_{student_id}')
-                
-                if obtained_str and max_str:
-                    obtained = float(obtained_str)
-                    max_marks = float(max_str)
-                    grade = grade_str.strip() if grade_str else None
-                    
-                    mark = StudentMarks.query.filter_by(
-                        student_id=student_id,
-                        exam_id=exam_id,
-                        subject_id=subject_id
-                    ).first()
-                    
-                    if mark:
-                        mark.marks_obtained = obtained
-                        mark.max_marks = max_marks
-                        mark.grade = grade
-                    else:
-                        new_mark = StudentMarks(
-                            student_id=student_id,
-                            exam_id=exam_id,
-                            subject_id=subject_id,
-                            marks_obtained=obtained,
-                            max_marks=max_marks,
-                            grade=grade
-                        )
-                        db.session.add(new_mark)
-                        
+            upsert_marks(exam_id, rows)
             db.session.commit()
-            flash('Marks successfully saved!', 'success')
-            return redirect(url_for('teacher_exams'))
-            
-        except ValueError:
-            db.session.rollback()
-            flash('Invalid input. Marks must be numeric values.', 'danger')
         except Exception as e:
             db.session.rollback()
             flash(f'An error occurred while saving marks: {str(e)}', 'danger')
+        else:
+            if not errors:
+                flash('Marks successfully saved!', 'success')
+                return redirect(url_for('teacher_exams'))
+            flash(f'Saved marks for {len(rows)} students. {len(errors)} rows need correcting.', 'warning')
+            # The commit expired the enrollments; reload them in one query for the form
+            enrollments = enrollment_query.all()
 
     # GET: pre‑fill existing marks
-    existing_marks = StudentMarks.query.filter_by(
-        exam_id=exam_id,
-        subject_id=subject_id
-    ).all()
-    marks_dict = {m.student_id: m for m in existing_marks}
-
-    # Default max marks (fallback)
-    default_max = subject.default_max_marks if subject.default_max_marks else 100
+    marks_dict = {
+        student_id: mark
+        for (student_id, _), mark in load_marks_matrix(exam_id, subject_ids=[subject_id]).items()
+    }
 
     return render_template(
         'teacher_enter_marks.html',
@@ -1597,6 +2281,8 @@ def teacher_enter_marks(exam_id, subject_id):
         enrollments=enrollments,
         marks_dict=marks_dict,
         default_max=default_max,
+        errors=errors,
+        submitted=request.form,
         context=context
     )
 
@@ -1761,7 +2447,7 @@ def enter_marks(exam_id):
         class_id=exam.class_id,
         session_id=exam.session_id,
         is_active=True
-    ).order_by(StudentEnrollment.roll_number).all()
+    ).options(joinedload(StudentEnrollment.student)).order_by(StudentEnrollment.roll_number).all()
     
     # Get subjects for this class (from the same session)
     subjects = Subject.query.filter_by(
@@ -1776,55 +2462,28 @@ def enter_marks(exam_id):
     
     if request.method == 'POST':
         # Save marks for each student and subject
+        rows = []
         for enrollment in enrollments:
             student_id = enrollment.student_id
             for subject in subjects:
                 marks_key = f'marks_{student_id}_{subject.id}'
-                max_marks_key = f'max_{student_id}_{subject.id}'
-                grade_key = f'grade_{student_id}_{subject.id}'
                 if marks_key in request.form:
                     marks_obtained = request.form.get(marks_key, type=float)
-                    max_marks = request.form.get(max_marks_key, 100, type=float)
-                    grade = request.form.get(grade_key, '')
-                    
                     if marks_obtained is not None:
-                        # Check if record exists
-                        mark_record = StudentMarks.query.filter_by(
-                            student_id=student_id,
-                            exam_id=exam.id,
-                            subject_id=subject.id
-                        ).first()
-                        
-                        if mark_record:
-                            mark_record.marks_obtained = marks_obtained
-                            mark_record.max_marks = max_marks
-                            mark_record.grade = grade
-                            mark_record.updated_at = datetime.utcnow()
-                        else:
-                            mark_record = StudentMarks(
-                                student_id=student_id,
-                                exam_id=exam.id,
-                                subject_id=subject.id,
-                                marks_obtained=marks_obtained,
-                                max_marks=max_marks,
-                                grade=grade
-                            )
-                            db.session.add(mark_record)
+                        rows.append({
+                            'student_id': student_id,
+                            'subject_id': subject.id,
+                            'marks_obtained': marks_obtained,
+                            'max_marks': request.form.get(f'max_{student_id}_{subject.id}', 100, type=float),
+                            'grade': request.form.get(f'grade_{student_id}_{subject.id}', '')
+                        })
+        upsert_marks(exam.id, rows)
         db.session.commit()
         flash('Marks saved successfully.', 'success')
         return redirect(url_for('view_exam_results', exam_id=exam.id))
     
     # GET: pre‑fill existing marks
-    existing_marks = {}
-    for enrollment in enrollments:
-        for subject in subjects:
-            mark = StudentMarks.query.filter_by(
-                student_id=enrollment.student_id,
-                exam_id=exam.id,
-                subject_id=subject.id
-            ).first()
-            if mark:
-                existing_marks[(enrollment.student_id, subject.id)] = mark
+    existing_marks = load_marks_matrix(exam.id)
     
     return render_template('admin_enter_marks.html',
                          exam=exam,
@@ -1849,7 +2508,7 @@ def view_exam_results(exam_id):
         class_id=exam.class_id,
         session_id=exam.session_id,
         is_active=True
-    ).order_by(StudentEnrollment.roll_number).all()
+    ).options(joinedload(StudentEnrollment.student)).order_by(StudentEnrollment.roll_number).all()
     
     subjects = Subject.query.filter_by(
         class_id=exam.class_id,
@@ -1857,36 +2516,40 @@ def view_exam_results(exam_id):
         is_active=True
     ).all()
     
-    # Build marks matrix
+    # Build marks matrix and grade it in one pass
+    matrix = load_marks_matrix(exam.id)
+    results = compute_results(
+        [e.student_id for e in enrollments],
+        [s.id for s in subjects],
+        {key: (mark.marks_obtained, mark.max_marks) for key, mark in matrix.items()},
+        compile_grading_scale(exam.class_.school_id)
+    )
     marks_data = []
     for enrollment in enrollments:
-        student_marks = {}
-        total_obtained = 0
-        total_max = 0
-        for subject in subjects:
-            mark = StudentMarks.query.filter_by(
-                student_id=enrollment.student_id,
-                exam_id=exam.id,
-                subject_id=subject.id
-            ).first()
-            if mark:
-                student_marks[subject.id] = mark
-                total_obtained += mark.marks_obtained
-                total_max += mark.max_marks
-        percentage = (total_obtained / total_max * 100) if total_max > 0 else 0
+        result = results['students'][enrollment.student_id]
         marks_data.append({
             'student': enrollment.student,
             'roll_number': enrollment.roll_number,
-            'marks': student_marks,
-            'total_obtained': total_obtained,
-            'total_max': total_max,
-            'percentage': round(percentage, 2)
+            'marks': {subject.id: matrix[(enrollment.student_id, subject.id)]
+                      for subject in subjects if (enrollment.student_id, subject.id) in matrix},
+            'total_obtained': result['total_obtained'],
+            'total_max': result['total_max'],
+            'percentage': result['percentage'],
+            'grade': result['grade'],
+            'rank': result['rank']
         })
     
+    students_by_id = {e.student_id: e.student for e in enrollments}
+    subject_toppers = {
+        subject_id: {**summary, 'toppers': [students_by_id[sid] for sid in summary['toppers']]}
+        for subject_id, summary in results['subjects'].items()
+    }
+    
     return render_template('admin_view_results.html',
                          exam=exam,
                          subjects=subjects,
                          marks_data=marks_data,
+                         subject_toppers=subject_toppers,
                          context=context)
 
 
@@ -1935,6 +2598,7 @@ class Timetable(db.Model):
     school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), nullable=False)
     session_id = db.Column(db.Integer, db.ForeignKey('academic_sessions.id'), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
+    version = db.Column(db.Integer, default=0, nullable=False)  # bumped on every timetable write
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     school = db.relationship('School', backref='timetables')
@@ -1971,6 +2635,559 @@ class TimetableEntry(db.Model):
     period = db.relationship('TimetablePeriod', back_populates='entries')
     class_ = db.relationship('Class', foreign_keys=[class_id])
     teacher = db.relationship('User', foreign_keys=[teacher_id])
+    
+    __table_args__ = (
+        db.Index('ix_timetable_entries_slot', 'timetable_id', 'day_of_week', 'period_id'),
+    )
+
+# ==================== TIMETABLE VERSIONS ====================
+# Timetable.version backs the grid API's ETag. Flushes that touch periods or
+# entries bump their timetable; renaming a class or teacher bumps every
+# timetable of that school, since the grid carries their names.
+
+TIMETABLE_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+TIMETABLE_NAME_FIELDS = {'Class': 'name', 'User': 'full_name'}
+
+@event.listens_for(db.session, 'before_flush')
+def track_timetable_writes(session, flush_context, instances):
+    """Collect the timetables a flush will change"""
+    scope = session.info.setdefault('timetable_scope', {'timetable_ids': set(), 'school_ids': set()})
+    for obj in chain(session.new, session.dirty, session.deleted):
+        model = type(obj).__name__
+        if model in ('TimetablePeriod', 'TimetableEntry') and obj.timetable_id:
+            scope['timetable_ids'].add(obj.timetable_id)
+        elif model in TIMETABLE_NAME_FIELDS and obj in session.dirty and obj.school_id:
+            if getattr(db.inspect(obj).attrs, TIMETABLE_NAME_FIELDS[model]).history.has_changes():
+                scope['school_ids'].add(obj.school_id)
+
+@event.listens_for(db.session, 'after_flush')
+def bump_flushed_timetables(session, flush_context):
+    scope = session.info.pop('timetable_scope', {})
+    conditions = []
+    if scope.get('timetable_ids'):
+        conditions.append(Timetable.id.in_(scope['timetable_ids']))
+    if scope.get('school_ids'):
+        conditions.append(Timetable.school_id.in_(scope['school_ids']))
+    if conditions:
+        session.connection().execute(
+            Timetable.__table__.update().where(or_(*conditions)).values(version=Timetable.version + 1)
+        )
+
+def timetable_entry_rows(timetable_id, class_id=None):
+    """A timetable's entries with class and teacher names, in one query"""
+    query = db.session.query(
+        TimetableEntry.id, TimetableEntry.period_id, TimetableEntry.day_of_week,
+        TimetableEntry.class_id, TimetableEntry.teacher_id, TimetableEntry.subject, TimetableEntry.room,
+        Class.name.label('class_name'), User.full_name.label('teacher_name')
+    ).join(Class, Class.id == TimetableEntry.class_id)\
+     .join(User, User.id == TimetableEntry.teacher_id)\
+     .filter(TimetableEntry.timetable_id == timetable_id)
+    if class_id:
+        query = query.filter(TimetableEntry.class_id == class_id)
+    return query.order_by(TimetableEntry.day_of_week, TimetableEntry.period_id, TimetableEntry.class_id).all()
+
+def timetable_etag(timetable):
+    return f'timetable-{timetable.id}-v{timetable.version}'
+
+def build_timetable_grid(timetable, class_id=None):
+    """A timetable as one compact JSON structure for the grid UI.
+    
+    Cells are positional lists described by `cell_fields`; class and
+    teacher names are sent once in lookup tables rather than per cell.
+    """
+    periods = TimetablePeriod.query.filter_by(timetable_id=timetable.id)\
+                                   .order_by(TimetablePeriod.period_number).all()
+    
+    classes, teachers, cells = {}, {}, []
+    for row in timetable_entry_rows(timetable.id, class_id):
+        classes[row.class_id] = row.class_name
+        teachers[row.teacher_id] = row.teacher_name
+        cells.append([row.id, row.period_id, row.day_of_week, row.class_id,
+                      row.teacher_id, row.subject, row.room or ''])
+    
+    return {
+        'timetable_id': timetable.id,
+        'version': timetable.version,
+        'days': TIMETABLE_DAYS,
+        'periods': [{
+            'id': p.id,
+            'period_number': p.period_number,
+            'start_time': p.start_time.strftime('%H:%M'),
+            'end_time': p.end_time.strftime('%H:%M')
+        } for p in periods],
+        'classes': classes,
+        'teachers': teachers,
+        'cell_fields': ['id', 'period_id', 'day_of_week', 'class_id', 'teacher_id', 'subject', 'room'],
+        'cells': cells
+    }
+
+# ==================== TIMETABLE CONFLICTS ====================
+
+# A proposed or existing lesson; TimetableEntry objects and query rows fit too
+TimetableCell = namedtuple('TimetableCell', 'id period_id day_of_week class_id teacher_id room')
+
+CLASH_MESSAGES = {
+    'teacher': 'Teacher is already teaching another class in this period',
+    'room': 'Room is already in use in this period',
+    'class': 'Class already has a lesson in this period'
+}
+
+class TimetableOccupancy:
+    """Teacher, room and class bookings per (day, period) slot.
+    
+    Every booking key maps to the lessons holding it, so checking one cell
+    is three dict lookups however large the timetable, and a full report
+    is one pass over the map.
+    """
+    
+    def __init__(self, lessons=()):
+        self.bookings = {}
+        for lesson in lessons:
+            self.add(lesson)
+    
+    @staticmethod
+    def booking_keys(lesson):
+        slot = (lesson.day_of_week, lesson.period_id)
+        yield 'teacher', slot + ('teacher', lesson.teacher_id)
+        room = (lesson.room or '').strip().casefold()
+        if room:
+            yield 'room', slot + ('room', room)
+        yield 'class', slot + ('class', lesson.class_id)
+    
+    def add(self, lesson):
+        for _, key in self.booking_keys(lesson):
+            self.bookings.setdefault(key, []).append(lesson)
+    
+    def remove(self, lesson):
+        for _, key in self.booking_keys(lesson):
+            holders = self.bookings.get(key, [])
+            if lesson in holders:
+                holders.remove(lesson)
+    
+    def clashes(self, lesson):
+        """[(kind, other lessons)] that placing `lesson` would double-book"""
+        found = []
+        for kind, key in self.booking_keys(lesson):
+            others = [other for other in self.bookings.get(key, ())
+                      if other is not lesson and (lesson.id is None or other.id != lesson.id)]
+            if others:
+                found.append((kind, others))
+        return found
+    
+    def conflicts(self):
+        """Every double booking as (day, period_id, kind, value, lessons)"""
+        for (day, period_id, kind, value), holders in self.bookings.items():
+            if len(holders) > 1:
+                yield day, period_id, kind, value, holders
+
+def slot_entries(timetable_id, slots):
+    """Entries of every class in the given (day, period_id) slots, in one indexed query"""
+    if not slots:
+        return []
+    return TimetableEntry.query.filter(
+        TimetableEntry.timetable_id == timetable_id,
+        db.tuple_(TimetableEntry.day_of_week, TimetableEntry.period_id).in_(list(slots))
+    ).all()
+
+def clashes_message(clashes):
+    return '; '.join(CLASH_MESSAGES[kind] for kind, _ in clashes)
+
+def clash_errors(clashes):
+    return [{'type': kind, 'message': CLASH_MESSAGES[kind],
+             'entry_ids': [other.id for other in others if other.id],
+             'class_ids': [other.class_id for other in others]}
+            for kind, others in clashes]
+
+def timetable_conflict_report(timetable):
+    """All teacher, room and class double bookings in one pass over the entries"""
+    rows = timetable_entry_rows(timetable.id)
+    periods = dict(db.session.query(TimetablePeriod.id, TimetablePeriod.period_number)
+                   .filter_by(timetable_id=timetable.id))
+    
+    conflicts = []
+    summary = {kind: 0 for kind in CLASH_MESSAGES}
+    for day, period_id, kind, value, lessons in TimetableOccupancy(rows).conflicts():
+        summary[kind] += 1
+        conflicts.append({
+            'type': kind,
+            'message': CLASH_MESSAGES[kind],
+            'day_of_week': day,
+            'day': TIMETABLE_DAYS[day] if 0 <= day < len(TIMETABLE_DAYS) else str(day),
+            'period_id': period_id,
+            'period_number': periods.get(period_id),
+            'value': lessons[0].teacher_name if kind == 'teacher' else
+                     lessons[0].class_name if kind == 'class' else lessons[0].room,
+            'entries': [{
+                'id': lesson.id,
+                'class_id': lesson.class_id,
+                'class_name': lesson.class_name,
+                'teacher_name': lesson.teacher_name,
+                'subject': lesson.subject,
+                'room': lesson.room
+            } for lesson in lessons]
+        })
+    conflicts.sort(key=lambda c: (c['day_of_week'], c['period_number'] or 0, c['type']))
+    
+    return {
+        'timetable_id': timetable.id,
+        'version': timetable.version,
+        'entries': len(rows),
+        'summary': summary,
+        'conflicts': conflicts
+    }
+
+def apply_timetable_edits(timetable, edits):
+    """Apply a batch of cell edits to a timetable in the current transaction.
+    
+    A cell is keyed by (period_id, day_of_week, class_id); an edit either
+    sets its teacher/subject/room or, with "clear": true, empties it.
+    The batch is checked as a whole against teacher, room and class
+    bookings in the slots it touches, so swaps within one batch are fine.
+    Returns (counts, errors); nothing is applied if any edit is invalid or
+    leaves a double booking.
+    """
+    period_ids = {p for p, in db.session.query(TimetablePeriod.id).filter_by(timetable_id=timetable.id)}
+    class_ids = {c for c, in db.session.query(Class.id).filter_by(
+        school_id=timetable.school_id, session_id=timetable.session_id, is_active=True)}
+    teacher_ids = {t for t, in db.session.query(User.id).filter_by(
+        school_id=timetable.school_id, role='teacher', is_active=True)}
+    
+    errors = []
+    cells = []
+    for index, edit in enumerate(edits):
+        if not isinstance(edit, dict):
+            errors.append({'index': index, 'error': 'Edit must be an object'})
+            continue
+        key = (edit.get('period_id'), edit.get('day_of_week'), edit.get('class_id'))
+        subject = str(edit.get('subject') or '').strip()
+        if key[0] not in period_ids:
+            errors.append({'index': index, 'error': 'Unknown period'})
+        elif key[1] not in range(len(TIMETABLE_DAYS)):
+            errors.append({'index': index, 'error': 'Invalid day'})
+        elif key[2] not in class_ids:
+            errors.append({'index': index, 'error': 'Unknown class'})
+        elif not edit.get('clear') and edit.get('teacher_id') not in teacher_ids:
+            errors.append({'index': index, 'error': 'Unknown teacher'})
+        elif not edit.get('clear') and not subject:
+            errors.append({'index': index, 'error': 'Subject is required'})
+        else:
+            cells.append((index, key, edit, subject))
+    if errors:
+        return None, errors
+    
+    # Load every slot the batch touches (all classes) in one query
+    entries = slot_entries(timetable.id, {(day, period_id) for _, (period_id, day, _), _, _ in cells})
+    occupancy = TimetableOccupancy(entries)
+    existing = {(e.period_id, e.day_of_week, e.class_id): e for e in entries}
+    
+    counts = {'created': 0, 'updated': 0, 'cleared': 0}
+    edited = {}  # cell key -> (edit index, lesson now in the cell)
+    for index, key, edit, subject in cells:
+        entry = existing.get(key)
+        if entry:
+            occupancy.remove(entry)
+        if edit.get('clear'):
+            if entry:
+                if db.inspect(entry).pending:
+                    # Set earlier in this batch and not flushed: just drop it
+                    db.session.expunge(entry)
+                    counts['created'] -= 1
+                else:
+                    db.session.delete(entry)
+                    counts['cleared'] += 1
+                existing.pop(key)
+                edited.pop(key, None)
+            continue
+        
+        if entry:
+            entry.teacher_id = edit['teacher_id']
+            entry.subject = subject
+            entry.room = str(edit.get('room') or '').strip()
+            counts['updated'] += 1
+        else:
+            entry = existing[key] = TimetableEntry(
+                timetable_id=timetable.id,
+                period_id=key[0],
+                day_of_week=key[1],
+                class_id=key[2],
+                teacher_id=edit['teacher_id'],
+                subject=subject,
+                room=str(edit.get('room') or '').strip()
+            )
+            db.session.add(entry)
+            counts['created'] += 1
+        occupancy.add(entry)
+        edited[key] = (index, entry)
+    
+    # Check each edited cell against the slot as the whole batch leaves it
+    for index, entry in sorted(edited.values(), key=lambda item: item[0]):
+        clashes = occupancy.clashes(entry)
+        if clashes:
+            errors.append({'index': index, 'error': clashes_message(clashes), 'conflicts': clash_errors(clashes)})
+    
+    if errors:
+        return None, errors
+    return counts, []
+
+# ==================== TIMETABLE GENERATOR ====================
+
+TIMETABLE_GENERATE_MAX_BUDGET = 120  # seconds
+
+# One weekly period to place: which class, teacher, subject and room it needs
+Lesson = namedtuple('Lesson', 'class_id teacher_id subject room')
+
+class TimetableSolver:
+    """Min-conflicts local search placing weekly lessons into (day, period) slots.
+    
+    Hard constraints: a class, teacher or room holds at most one lesson per
+    slot. Lessons are placed greedily, busiest teacher first, then any
+    lesson still in a clash is moved to its least-clashing slot or swapped
+    with another lesson of its class, with a little random walk, until none
+    clash or the time budget runs out. A final pass swaps lessons within a
+    class to spread each subject across the week.
+    """
+    
+    NOISE = 0.1  # chance of a random move, to escape local minima
+    
+    def __init__(self, lessons, slots, seed=None):
+        self.lessons = lessons
+        self.slots = slots  # [(day, period_id)]
+        self.random = random.Random(seed)
+        self.placement = [None] * len(lessons)
+        self.holders = defaultdict(set)  # (kind, value, slot index) -> lesson indexes
+        self.daily = defaultdict(int)    # (class_id, subject, day) -> lessons that day
+        self.by_class = defaultdict(list)
+        for index, lesson in enumerate(lessons):
+            self.by_class[lesson.class_id].append(index)
+        self.resources = [
+            [('class', lesson.class_id), ('teacher', lesson.teacher_id)] + ([('room', lesson.room)] if lesson.room else [])
+            for lesson in lessons
+        ]
+    
+    def clashes(self, index, slot, ignore=None):
+        """Other lessons (besides `ignore`) sharing a class, teacher or room with `index` in `slot`"""
+        count = 0
+        for kind, value in self.resources[index]:
+            holders = self.holders.get((kind, value, slot))
+            if holders:
+                count += len(holders) - (index in holders) - (ignore in holders)
+        return count
+    
+    def day_count(self, index, day):
+        lesson = self.lessons[index]
+        return self.daily[(lesson.class_id, lesson.subject, day)]
+    
+    def move(self, index, slot):
+        lesson = self.lessons[index]
+        current = self.placement[index]
+        if current is not None:
+            for kind, value in self.resources[index]:
+                self.holders[(kind, value, current)].discard(index)
+            self.daily[(lesson.class_id, lesson.subject, self.slots[current][0])] -= 1
+        for kind, value in self.resources[index]:
+            self.holders[(kind, value, slot)].add(index)
+        self.daily[(lesson.class_id, lesson.subject, self.slots[slot][0])] += 1
+        self.placement[index] = slot
+    
+    def swap(self, index, other):
+        slot, other_slot = self.placement[index], self.placement[other]
+        self.move(index, other_slot)
+        self.move(other, slot)
+    
+    def best_move(self, index):
+        """(clashes, slot) for the least-clashing slot, preferring days without the subject"""
+        current = self.placement[index]
+        current_day = self.slots[current][0] if current is not None else None
+        cost, repeats, tiebreak, slot = min(
+            (self.clashes(index, slot),
+             self.day_count(index, day) - (day == current_day),
+             self.random.random(), slot)
+            for slot, (day, period_id) in enumerate(self.slots)
+        )
+        return cost, slot
+    
+    def best_swap(self, index):
+        """(clashes, other) for the best swap with another lesson of the same class"""
+        slot = self.placement[index]
+        best = (float('inf'), None)
+        for other in self.by_class[self.lessons[index].class_id]:
+            other_slot = self.placement[other]
+            if other_slot == slot:
+                continue
+            cost = self.clashes(index, other_slot, other) + self.clashes(other, slot, index)
+            if (cost, self.random.random()) < (best[0], 0.5):
+                best = (cost, other)
+        return best
+    
+    def affected(self, *indexes):
+        """Lessons sharing a resource and slot with any of `indexes`"""
+        found = set(indexes)
+        for index in indexes:
+            slot = self.placement[index]
+            for kind, value in self.resources[index]:
+                found |= self.holders.get((kind, value, slot), set())
+        return found
+    
+    def solve(self, deadline, on_progress=None):
+        """Search until clash-free or `deadline` (time.monotonic()); returns lessons still clashing"""
+        load = defaultdict(int)
+        for lesson in self.lessons:
+            load[lesson.teacher_id] += 1
+        order = sorted(range(len(self.lessons)),
+                       key=lambda i: (-load[self.lessons[i].teacher_id], self.random.random()))
+        for index in order:
+            self.move(index, self.best_move(index)[1])
+        
+        conflicted = {i for i in range(len(self.lessons)) if self.clashes(i, self.placement[i])}
+        last_report = time.monotonic()
+        while conflicted and time.monotonic() < deadline:
+            index = self.random.choice(tuple(conflicted))
+            touched = self.affected(index)
+            if self.random.random() < self.NOISE:
+                self.move(index, self.random.randrange(len(self.slots)))
+            else:
+                move_cost, slot = self.best_move(index)
+                swap_cost, other = self.best_swap(index)
+                if other is not None and swap_cost < move_cost:
+                    touched |= self.affected(other)
+                    self.swap(index, other)
+                else:
+                    self.move(index, slot)
+            touched |= self.affected(*touched)
+            for other in touched:
+                if self.clashes(other, self.placement[other]):
+                    conflicted.add(other)
+                else:
+                    conflicted.discard(other)
+            if on_progress and time.monotonic() - last_report > 1:
+                on_progress(len(conflicted))
+                last_report = time.monotonic()
+        
+        if not conflicted:
+            self.spread(deadline)
+        return len(conflicted)
+    
+    def spread(self, deadline):
+        """Swap lessons within each class, clash-free, while it evens out subjects per day"""
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            for indexes in self.by_class.values():
+                for index in indexes:
+                    day = self.slots[self.placement[index]][0]
+                    if self.day_count(index, day) < 2:
+                        continue
+                    for other in indexes:
+                        other_day = self.slots[self.placement[other]][0]
+                        if other_day == day or self.lessons[other].subject == self.lessons[index].subject:
+                            continue
+                        # Change in the sum over days of pairs of same-subject lessons
+                        gain = (self.day_count(index, day) - 1 - self.day_count(index, other_day)
+                                + self.day_count(other, other_day) - 1 - self.day_count(other, day))
+                        if gain > 0 and not (self.clashes(index, self.placement[other], other)
+                                             or self.clashes(other, self.placement[index], index)):
+                            self.swap(index, other)
+                            improved = True
+                            break
+
+def build_timetable_problem(timetable, subject_periods=None, rooms=None, days=None):
+    """Lessons and slots for a timetable from its periods and the session's teacher assignments.
+    
+    `subject_periods` maps a subject name to its weekly periods; other
+    subjects share a class's week evenly. `rooms` maps a subject to a shared
+    room (e.g. a lab); other lessons use the class's own room. Lesson rooms
+    are normalized the way TimetableOccupancy compares them, so "Lab" and
+    "lab " are one room; `room_names` maps each back to the first spelling
+    seen. Returns (lessons, slots, room_names). Raises ValueError when no
+    clash-free timetable can exist.
+    """
+    subject_periods = subject_periods or {}
+    rooms = rooms or {}
+    periods = TimetablePeriod.query.filter_by(timetable_id=timetable.id)\
+                                   .order_by(TimetablePeriod.period_number).all()
+    slots = [(day, period.id) for day in range(days or len(TIMETABLE_DAYS)) for period in periods]
+    if not slots:
+        raise ValueError('Add periods to the timetable before generating it')
+    
+    classes = {c.id: c for c in Class.query.filter_by(
+        school_id=timetable.school_id, session_id=timetable.session_id, is_active=True)}
+    teachers = {}  # (class_id, subject) -> teacher_id, first assignment wins
+    for assignment in TeacherAssignment.query.filter(
+        TeacherAssignment.class_id.in_(classes),
+        TeacherAssignment.session_id == timetable.session_id
+    ).order_by(TeacherAssignment.id):
+        teachers.setdefault((assignment.class_id, assignment.subject), assignment.teacher_id)
+    
+    subjects_by_class = defaultdict(list)
+    for class_id, subject in teachers:
+        subjects_by_class[class_id].append(subject)
+    
+    lessons = []
+    errors = []
+    room_names = {}
+    for class_id, subjects in subjects_by_class.items():
+        class_obj = classes[class_id]
+        even_share = len(slots) // len(subjects)
+        demand = 0
+        for subject in sorted(subjects):
+            count = int(subject_periods.get(subject, even_share))
+            demand += count
+            room_name = (rooms.get(subject) or class_obj.room_number or '').strip()
+            room = room_name.casefold()
+            room_names.setdefault(room, room_name)
+            lessons.extend([Lesson(class_id, teachers[(class_id, subject)], subject, room)] * count)
+        if demand > len(slots):
+            errors.append(f'{class_obj.name} needs {demand} periods but the week has {len(slots)}')
+    
+    overloaded = []  # (kind, teacher_id or room, periods needed)
+    for kind, key in (('Teacher', 'teacher_id'), ('Room', 'room')):
+        demand = defaultdict(int)
+        for lesson in lessons:
+            if getattr(lesson, key):
+                demand[getattr(lesson, key)] += 1
+        overloaded.extend((kind, value, count) for value, count in demand.items() if count > len(slots))
+    
+    teacher_ids = [value for kind, value, count in overloaded if kind == 'Teacher']
+    teacher_names = {user.id: user.full_name for user in User.query.filter(User.id.in_(teacher_ids))} \
+        if teacher_ids else {}
+    for kind, value, count in overloaded:
+        name = teacher_names[value] if kind == 'Teacher' else room_names[value]
+        errors.append(f'{kind} {name} is needed for {count} periods but the week has {len(slots)}')
+    
+    if errors:
+        raise ValueError('; '.join(errors))
+    return lessons, slots, room_names
+
+def generate_timetable(timetable, subject_periods=None, rooms=None, days=None, time_budget=20, on_progress=None):
+    """Solve and replace every entry of a timetable in one bulk insert.
+    
+    Nothing is written unless the solver finds a clash-free timetable.
+    """
+    lessons, slots, room_names = build_timetable_problem(timetable, subject_periods, rooms, days)
+    solver = TimetableSolver(lessons, slots)
+    remaining = solver.solve(time.monotonic() + min(time_budget, TIMETABLE_GENERATE_MAX_BUDGET), on_progress)
+    if remaining:
+        raise ValueError(f'No clash-free timetable found within {time_budget}s '
+                         f'({remaining} lessons still clash); allow more time or fewer periods')
+    
+    entries = TimetableEntry.__table__
+    db.session.execute(entries.delete().where(entries.c.timetable_id == timetable.id))
+    rows = [{
+        'timetable_id': timetable.id,
+        'period_id': slots[slot][1],
+        'day_of_week': slots[slot][0],
+        'class_id': lesson.class_id,
+        'teacher_id': lesson.teacher_id,
+        'subject': lesson.subject,
+        'room': room_names[lesson.room],
+        'created_at': datetime.utcnow()
+    } for lesson, slot in zip(lessons, solver.placement)]
+    if rows:
+        db.session.execute(entries.insert(), rows)
+    # Core statements skip the flush hooks, so bump the grid version here
+    db.session.execute(Timetable.__table__.update().where(Timetable.id == timetable.id)
+                       .values(version=Timetable.version + 1))
+    return {'entries': len(rows), 'classes': len({lesson.class_id for lesson in lessons})}
 
 # ==================== TIMETABLE ROUTES ====================
 @app.route('/student/timetable')
@@ -2087,14 +3304,14 @@ def admin_timetable():
             flash('Selected class not found.', 'warning')
             selected_class_id = None
 
-    # Get periods and all entries for this timetable
+    # Get periods and the chosen class's entries for this timetable
     periods = TimetablePeriod.query.filter_by(timetable_id=timetable.id)\
                                    .order_by(TimetablePeriod.period_number).all()
-    all_entries = TimetableEntry.query.filter_by(timetable_id=timetable.id).all()
-
-    # --- NEW: filter entries by the chosen class ---
     if selected_class_id:
-        entries = [e for e in all_entries if e.class_id == selected_class_id]
+        entries = TimetableEntry.query.filter_by(
+            timetable_id=timetable.id,
+            class_id=selected_class_id
+        ).options(joinedload(TimetableEntry.class_), joinedload(TimetableEntry.teacher)).all()
     else:
         entries = []   # No class selected → show empty grid
 
@@ -2186,7 +3403,9 @@ def api_timetable_entries():
     if request.method == 'GET':
         timetable_id = request.args.get('timetable_id', type=int)
         class_id = request.args.get('class_id', type=int)          # optional filter
-        query = TimetableEntry.query.filter_by(timetable_id=timetable_id)
+        query = TimetableEntry.query.filter_by(timetable_id=timetable_id).options(
+            joinedload(TimetableEntry.class_), joinedload(TimetableEntry.teacher)
+        )
         if class_id:
             query = query.filter_by(class_id=class_id)
         entries = query.all()
@@ -2205,13 +3424,23 @@ def api_timetable_entries():
     elif request.method == 'POST':
         data = request.get_json()
         try:
-            # Check if entry already exists for this period and day
+            # Check if entry already exists for this class, period and day
             existing = TimetableEntry.query.filter_by(
                 timetable_id=data['timetable_id'],
                 period_id=data['period_id'],
-                day_of_week=data['day_of_week']
+                day_of_week=data['day_of_week'],
+                class_id=data['class_id']
             ).first()
 
+            # Refuse to double-book the teacher or room in this slot
+            occupancy = TimetableOccupancy(slot_entries(data['timetable_id'], [(data['day_of_week'], data['period_id'])]))
+            clashes = occupancy.clashes(TimetableCell(
+                existing.id if existing else None, data['period_id'], data['day_of_week'],
+                data['class_id'], data['teacher_id'], data.get('room', '')
+            ))
+            if clashes:
+                return jsonify({'error': clashes_message(clashes), 'conflicts': clash_errors(clashes)}), 409
+
             if existing:
                 # Update existing entry
                 existing.class_id = data['class_id']
@@ -2245,6 +3474,107 @@ def api_timetable_entries():
         return jsonify({'message': 'Entry deleted'})
 
 
+@app.route('/admin/timetable/api/<int:timetable_id>/grid', methods=['GET', 'POST'])
+@role_required(['admin'])
+@school_active_required
+def api_timetable_grid(timetable_id):
+    """Whole timetable in one response (GET, with ETag) or a batch of cell edits (POST)"""
+    timetable = Timetable.query.filter_by(
+        id=timetable_id,
+        school_id=current_user.school_id
+    ).first_or_404()
+    
+    if request.method == 'GET':
+        etag = timetable_etag(timetable)
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = jsonify(build_timetable_grid(timetable, request.args.get('class_id', type=int)))
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    
+    # Optimistic concurrency: If-Match must name the version the edits were made against
+    if request.if_match and not request.if_match.contains(timetable_etag(timetable)):
+        return jsonify({'error': 'The timetable was changed by someone else. Reload and try again.',
+                        'version': timetable.version}), 412
+    
+    data = request.get_json(silent=True) or {}
+    edits = data.get('cells')
+    if not isinstance(edits, list) or not edits:
+        return jsonify({'error': 'No cells to update'}), 400
+    
+    try:
+        counts, errors = apply_timetable_edits(timetable, edits)
+        if errors:
+            db.session.rollback()
+            return jsonify({'error': 'Some cells are invalid; nothing was saved.', 'errors': errors}), 400
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    db.session.refresh(timetable)
+    response = jsonify({**counts, 'version': timetable.version, 'message': 'Timetable updated'})
+    response.set_etag(timetable_etag(timetable))
+    return response
+
+
+@app.route('/admin/timetable/<int:timetable_id>/generate', methods=['POST'])
+@role_required(['admin'])
+@school_active_required
+def generate_timetable_route(timetable_id):
+    """Queue automatic generation of a whole timetable.
+    
+    Accepts a form post from the timetable page or JSON with optional
+    subject_periods, rooms, days and time_budget.
+    """
+    if current_user.must_change_password:
+        return redirect(url_for('change_password'))
+    
+    timetable = Timetable.query.filter_by(
+        id=timetable_id,
+        school_id=current_user.school_id
+    ).first_or_404()
+    data = request.get_json(silent=True) or request.form
+    
+    try:
+        options = {
+            'subject_periods': {str(k): int(v) for k, v in dict(data.get('subject_periods') or {}).items()},
+            'rooms': {str(k): str(v) for k, v in dict(data.get('rooms') or {}).items()},
+            'days': int(data['days']) if data.get('days') else None,
+            'time_budget': min(int(data.get('time_budget') or 20), TIMETABLE_GENERATE_MAX_BUDGET)
+        }
+        if options['days'] is not None and not 1 <= options['days'] <= len(TIMETABLE_DAYS):
+            raise ValueError('days must be between 1 and 6')
+        if any(count < 0 for count in options['subject_periods'].values()):
+            raise ValueError('subject_periods must not be negative')
+    except (TypeError, ValueError) as e:
+        if request.is_json:
+            return jsonify({'error': f'Invalid options: {e}'}), 400
+        flash(f'Invalid options: {e}', 'danger')
+        return redirect(url_for('admin_timetable'))
+    
+    job = enqueue_job('generate_timetable', {'timetable_id': timetable.id, **options},
+                      school_id=current_user.school_id, max_attempts=1)
+    if request.is_json:
+        return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+    return job_status_redirect(job, url_for('admin_timetable'))
+
+
+@app.route('/admin/timetable/api/<int:timetable_id>/conflicts')
+@role_required(['admin'])
+@school_active_required
+def api_timetable_conflicts(timetable_id):
+    """Validation report: every teacher, room and class double booking"""
+    timetable = Timetable.query.filter_by(
+        id=timetable_id,
+        school_id=current_user.school_id
+    ).first_or_404()
+    return jsonify(timetable_conflict_report(timetable))
+
+
 @app.route('/admin/timetable/api/classes')
 @role_required(['admin'])
 @school_active_required
@@ -2340,6 +3670,11 @@ class Attendance(db.Model):
     class_ = db.relationship('Class', backref='attendance')
     session = db.relationship('AcademicSession', backref='attendance')
     marked_by_user = db.relationship('User', foreign_keys=[marked_by])
+    
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'class_id', 'date', name='uq_attendance_student_class_date'),
+        db.Index('ix_attendance_class_session_date', 'class_id', 'session_id', 'date'),
+    )
 
 class AttendanceSummary(db.Model):
     __tablename__ = 'attendance_summary'
@@ -2363,6 +3698,11 @@ class AttendanceSummary(db.Model):
     student = db.relationship('Student', backref='attendance_summaries')
     class_ = db.relationship('Class', backref='attendance_summaries')
     session = db.relationship('AcademicSession', backref='attendance_summaries')
+    
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'class_id', 'session_id', 'month', 'year',
+                            name='uq_attendance_summary_student_month'),
+    )
 
 # ==================== ATTENDANCE FORMS ====================
 
@@ -2632,7 +3972,7 @@ def take_attendance(class_id):
     form = TakeAttendanceForm()
     
     # Get students in this class
-    enrollments = StudentEnrollment.query.filter_by(
+    enrollments = StudentEnrollment.query.options(joinedload(StudentEnrollment.student)).filter_by(
         class_id=class_id,
         session_id=context['current_session'].id,
         is_active=True
@@ -2645,63 +3985,21 @@ def take_attendance(class_id):
     if form.validate_on_submit():
         try:
             attendance_date = form.date.data
-            today_attendance = date.today()
-            
-            # Check if attendance already taken for this date
-            existing_attendance = Attendance.query.filter_by(
-                class_id=class_id,
-                session_id=context['current_session'].id,
-                date=attendance_date
-            ).first()
             
-            if existing_attendance and attendance_date == today_attendance:
-                # Update existing attendance
-                for enrollment in enrollments:
-                    status_key = f"status_{enrollment.student_id}"
-                    if status_key in request.form:
-                        attendance = Attendance.query.filter_by(
-                            student_id=enrollment.student_id,
-                            class_id=class_id,
-                            session_id=context['current_session'].id,
-                            date=attendance_date
-                        ).first()
-                        
-                        if attendance:
-                            attendance.status = request.form[status_key]
-                            attendance.notes = request.form.get(f"notes_{enrollment.student_id}", '')
-                            attendance.updated_at = datetime.utcnow()
-                        else:
-                            attendance = Attendance(
-                                student_id=enrollment.student_id,
-                                class_id=class_id,
-                                session_id=context['current_session'].id,
-                                date=attendance_date,
-                                status=request.form[status_key],
-                                notes=request.form.get(f"notes_{enrollment.student_id}", ''),
-                                marked_by=current_user.id
-                            )
-                            db.session.add(attendance)
-            else:
-                # Create new attendance records
-                for enrollment in enrollments:
-                    status_key = f"status_{enrollment.student_id}"
-                    if status_key in request.form:
-                        attendance = Attendance(
-                            student_id=enrollment.student_id,
-                            class_id=class_id,
-                            session_id=context['current_session'].id,
-                            date=attendance_date,
-                            status=request.form[status_key],
-                            notes=request.form.get(f"notes_{enrollment.student_id}", ''),
-                            marked_by=current_user.id
-                        )
-                        db.session.add(attendance)
+            entries = {
+                enrollment.student_id: (
+                    request.form[f"status_{enrollment.student_id}"],
+                    request.form.get(f"notes_{enrollment.student_id}", '')
+                )
+                for enrollment in enrollments
+                if f"status_{enrollment.student_id}" in request.form
+            }
             
+            # Upsert the day's records and shift the monthly summaries
+            record_class_attendance(class_id, context['current_session'].id, attendance_date,
+                                    entries, marked_by=current_user.id)
             db.session.commit()
             
-            # Update attendance summary
-            update_attendance_summary(class_id, context['current_session'].id, attendance_date.month, attendance_date.year)
-            
             flash(f'Attendance for {attendance_date.strftime("%B %d, %Y")} saved successfully!', 'success')
             return redirect(url_for('view_class_attendance', class_id=class_id))
             
@@ -2982,66 +4280,274 @@ def student_attendance():
                            subject_attendance=subject_attendance,
                            date=date.today())
 
-def update_attendance_summary(class_id, session_id, month, year):
-    """Update attendance summary for a class"""
-    # Get all students in the class
-    enrollments = StudentEnrollment.query.filter_by(
-        class_id=class_id,
-        session_id=session_id,
-        is_active=True
+ATTENDANCE_SUMMARY_FIELDS = {
+    'present': 'present_days',
+    'absent': 'absent_days',
+    'late': 'late_days',
+    'half_day': 'half_days',
+}
+
+def month_bounds(start_date, end_date=None):
+    """First day of start_date's month and first day of the month after end_date"""
+    end_date = end_date or start_date
+    return (start_date.replace(day=1),
+            date(end_date.year + end_date.month // 12, end_date.month % 12 + 1, 1))
+
+def attendance_count_columns():
+    """Conditional counts shared by the attendance rollups"""
+    total = func.count(Attendance.id)
+    counts = {
+        field: func.count(Attendance.id).filter(Attendance.status == status)
+        for status, field in ATTENDANCE_SUMMARY_FIELDS.items()
+    }
+    return [
+        total.label('total_days'),
+        *[count.label(field) for field, count in counts.items()],
+        func.coalesce(counts['present_days'] * 100.0 / func.nullif(total, 0), 0).label('attendance_percentage')
+    ]
+
+def attendance_month_counts(class_id, session_id, month, year, student_ids=None):
+    """Per-student attendance counts for a month in one grouped query"""
+    month_start, month_end = month_bounds(date(year, month, 1))
+    
+    query = db.select(
+        Attendance.student_id,
+        *attendance_count_columns()
+    ).where(
+        Attendance.class_id == class_id,
+        Attendance.session_id == session_id,
+        Attendance.date >= month_start,
+        Attendance.date < month_end
+    ).group_by(Attendance.student_id)
+    
+    if student_ids is not None:
+        query = query.where(Attendance.student_id.in_(student_ids))
+    
+    return {row.student_id: row._asdict() for row in db.session.execute(query)}
+
+def record_class_attendance(class_id, session_id, attendance_date, entries, marked_by=None):
+    """Upsert a day's attendance for a class and adjust the monthly summaries.
+    
+    `entries` maps student_id to (status, notes). The students' summary rows
+    for the month are created if missing and locked first, so concurrent
+    submits for the class take turns and each sees the statuses the other
+    wrote. The day's existing records are then read once, all rows are
+    written with one INSERT ... ON CONFLICT, and AttendanceSummary counters
+    are shifted only for students whose status changed. The caller commits.
+    Returns the number of changed students.
+    """
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    
+    if not entries:
+        return 0
+    
+    now = datetime.utcnow()
+    month, year = attendance_date.month, attendance_date.year
+    summary = AttendanceSummary.__table__
+    student_ids = sorted(entries)
+    zeros = dict.fromkeys(['total_days', *ATTENDANCE_SUMMARY_FIELDS.values()], 0)
+    
+    # Rows created here start at zero and are filled with full counts below
+    created = set(db.session.execute(
+        pg_insert(summary).values([
+            dict(zeros, student_id=student_id, class_id=class_id, session_id=session_id,
+                 month=month, year=year, attendance_percentage=0, created_at=now)
+            for student_id in student_ids
+        ]).on_conflict_do_nothing(constraint='uq_attendance_summary_student_month')
+        .returning(summary.c.student_id)
+    ).scalars())
+    db.session.execute(
+        db.select(summary.c.id).where(
+            summary.c.class_id == class_id,
+            summary.c.session_id == session_id,
+            summary.c.month == month,
+            summary.c.year == year,
+            summary.c.student_id.in_(student_ids)
+        ).order_by(summary.c.student_id).with_for_update()
     ).all()
     
-    for enrollment in enrollments:
-        # Get attendance records for the month
-        attendance_records = Attendance.query.filter(
-            Attendance.student_id == enrollment.student_id,
+    previous = dict(db.session.execute(
+        db.select(Attendance.student_id, Attendance.status).where(
             Attendance.class_id == class_id,
-            Attendance.session_id == session_id,
-            db.extract('month', Attendance.date) == month,
-            db.extract('year', Attendance.date) == year
-        ).all()
-        
-        total_days = len(attendance_records)
-        present_days = len([r for r in attendance_records if r.status == 'present'])
-        absent_days = len([r for r in attendance_records if r.status == 'absent'])
-        late_days = len([r for r in attendance_records if r.status == 'late'])
-        half_days = len([r for r in attendance_records if r.status == 'half_day'])
-        
-        attendance_percentage = (present_days / total_days * 100) if total_days > 0 else 0
-        
-        # Update or create summary
-        summary = AttendanceSummary.query.filter_by(
-            student_id=enrollment.student_id,
-            class_id=class_id,
-            session_id=session_id,
-            month=month,
-            year=year
-        ).first()
-        
-        if summary:
-            summary.total_days = total_days
-            summary.present_days = present_days
-            summary.absent_days = absent_days
-            summary.late_days = late_days
-            summary.half_days = half_days
-            summary.attendance_percentage = attendance_percentage
-        else:
-            summary = AttendanceSummary(
-                student_id=enrollment.student_id,
-                class_id=class_id,
-                session_id=session_id,
-                month=month,
-                year=year,
-                total_days=total_days,
-                present_days=present_days,
-                absent_days=absent_days,
-                late_days=late_days,
-                half_days=half_days,
-                attendance_percentage=attendance_percentage
-            )
-            db.session.add(summary)
+            Attendance.date == attendance_date,
+            Attendance.student_id.in_(entries.keys())
+        )
+    ).all())
+    
+    statement = pg_insert(Attendance.__table__).values([
+        {
+            'student_id': student_id,
+            'class_id': class_id,
+            'session_id': session_id,
+            'date': attendance_date,
+            'status': status,
+            'notes': notes,
+            'marked_by': marked_by,
+            'created_at': now,
+            'updated_at': now
+        }
+        for student_id, (status, notes) in entries.items()
+    ])
+    db.session.execute(statement.on_conflict_do_update(
+        constraint='uq_attendance_student_class_date',
+        set_={
+            'status': statement.excluded.status,
+            'notes': statement.excluded.notes,
+            'updated_at': statement.excluded.updated_at
+        }
+    ))
+    
+    # Counter deltas for students whose status changed
+    deltas = {}
+    for student_id, (status, notes) in entries.items():
+        old_status = previous.get(student_id)
+        if old_status == status:
+            continue
+        delta = dict(zeros)
+        if old_status is None:
+            delta['total_days'] = 1
+        elif old_status in ATTENDANCE_SUMMARY_FIELDS:
+            delta[ATTENDANCE_SUMMARY_FIELDS[old_status]] -= 1
+        if status in ATTENDANCE_SUMMARY_FIELDS:
+            delta[ATTENDANCE_SUMMARY_FIELDS[status]] += 1
+        deltas[student_id] = delta
+    
+    changed = len(deltas)
+    
+    # New summary rows get full counts, which already include the rows
+    # written above
+    if created:
+        for student_id, counts in attendance_month_counts(class_id, session_id, month, year, created).items():
+            counts.pop('student_id')
+            deltas[student_id] = counts
+    
+    if not deltas:
+        return 0
     
+    statement = pg_insert(summary).values([
+        dict(delta, student_id=student_id, class_id=class_id, session_id=session_id,
+             month=month, year=year, created_at=now,
+             attendance_percentage=(delta['present_days'] / delta['total_days'] * 100)
+                                   if delta['total_days'] > 0 else 0)
+        for student_id, delta in deltas.items()
+    ])
+    counters = {
+        field: summary.c[field] + statement.excluded[field]
+        for field in ['total_days', *ATTENDANCE_SUMMARY_FIELDS.values()]
+    }
+    counters['attendance_percentage'] = func.coalesce(
+        counters['present_days'] * 100.0 / func.nullif(counters['total_days'], 0), 0
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        constraint='uq_attendance_summary_student_month',
+        set_=counters
+    ))
+    invalidate_report_cards(class_ids=[class_id])
+    return changed
+
+def rollup_attendance_summaries(school_id=None, session_id=None, class_id=None,
+                                start_date=None, end_date=None):
+    """Rebuild AttendanceSummary rows from Attendance in bulk.
+    
+    Every (student, class, session, month) in scope is counted in one
+    GROUP BY query and written with a single INSERT ... SELECT ... ON
+    CONFLICT. Summary rows in scope are deleted first, so months whose
+    attendance was since deleted or moved to another class don't keep their
+    old counts. Summaries cover whole months, so the date range is widened
+    to month boundaries. The caller commits. Returns the number of rows
+    written.
+    """
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    
+    year = func.cast(func.extract('year', Attendance.date), db.Integer)
+    month = func.cast(func.extract('month', Attendance.date), db.Integer)
+    
+    source = db.select(
+        Attendance.student_id,
+        Attendance.class_id,
+        Attendance.session_id,
+        month.label('month'),
+        year.label('year'),
+        *attendance_count_columns(),
+        db.literal(datetime.utcnow()).label('created_at')
+    ).group_by(
+        Attendance.student_id, Attendance.class_id, Attendance.session_id, year, month
+    )
+    stale = db.delete(AttendanceSummary)
+    
+    if school_id:
+        school_classes = db.select(Class.id).where(Class.school_id == school_id)
+        source = source.where(Attendance.class_id.in_(school_classes))
+        stale = stale.where(AttendanceSummary.class_id.in_(school_classes))
+    if session_id:
+        source = source.where(Attendance.session_id == session_id)
+        stale = stale.where(AttendanceSummary.session_id == session_id)
+    if class_id:
+        source = source.where(Attendance.class_id == class_id)
+        stale = stale.where(AttendanceSummary.class_id == class_id)
+    if start_date or end_date:
+        range_start, range_end = month_bounds(start_date or end_date, end_date)
+        summary_month = AttendanceSummary.year * 12 + AttendanceSummary.month
+        if start_date:
+            source = source.where(Attendance.date >= range_start)
+            stale = stale.where(summary_month >= range_start.year * 12 + range_start.month)
+        if end_date:
+            source = source.where(Attendance.date < range_end)
+            stale = stale.where(summary_month < range_end.year * 12 + range_end.month)
+    
+    db.session.execute(stale)
+    columns = ['student_id', 'class_id', 'session_id', 'month', 'year', 'total_days',
+               *ATTENDANCE_SUMMARY_FIELDS.values(), 'attendance_percentage', 'created_at']
+    statement = pg_insert(AttendanceSummary.__table__).from_select(columns, source)
+    result = db.session.execute(statement.on_conflict_do_update(
+        constraint='uq_attendance_summary_student_month',
+        set_={
+            column: statement.excluded[column]
+            for column in ['total_days', *ATTENDANCE_SUMMARY_FIELDS.values(), 'attendance_percentage']
+        }
+    ))
+    
+    # Report cards within the narrowest scope the rollup covered
+    if class_id:
+        invalidate_report_cards(class_ids=[class_id])
+    elif school_id:
+        invalidate_report_cards(school_ids=[school_id])
+    elif session_id:
+        invalidate_report_cards(session_ids=[session_id])
+    else:
+        invalidate_report_cards(all_classes=True)
+    return result.rowcount
+
+@app.cli.command('rebuild-attendance-summaries')
+@click.option('--school-id', type=int, help='Only rebuild this school')
+@click.option('--session-id', type=int, help='Only rebuild this academic session')
+@click.option('--class-id', type=int, help='Only rebuild this class')
+@click.option('--start', 'start_date', type=click.DateTime(formats=['%Y-%m-%d']), help='First day to rebuild (YYYY-MM-DD)')
+@click.option('--end', 'end_date', type=click.DateTime(formats=['%Y-%m-%d']), help='Last day to rebuild (YYYY-MM-DD)')
+@click.option('--queue', is_flag=True, help='Queue the rebuild for the job worker instead of running it now')
+def rebuild_attendance_summaries_command(school_id, session_id, class_id, start_date, end_date, queue):
+    """Rebuild monthly attendance summaries, e.g. after back-dated edits"""
+    filters = {
+        'school_id': school_id,
+        'session_id': session_id,
+        'class_id': class_id,
+        'start_date': start_date.date().isoformat() if start_date else None,
+        'end_date': end_date.date().isoformat() if end_date else None
+    }
+    if queue:
+        job = enqueue_job('rebuild_attendance_summaries', filters, school_id=school_id)
+        click.echo(f"Queued job {job.id}")
+        return
+    
+    rows = rollup_attendance_summaries(
+        school_id=school_id,
+        session_id=session_id,
+        class_id=class_id,
+        start_date=start_date.date() if start_date else None,
+        end_date=end_date.date() if end_date else None
+    )
     db.session.commit()
+    click.echo(f"Rebuilt {rows} attendance summaries")
 
 # ==================== UTILITY FUNCTIONS ====================
 
@@ -3056,156 +4562,110 @@ def get_today_attendance(class_id):
     
     return attendance is not None
 
-# Update the utility_processor to include this function
-@app.context_processor
-def utility_processor():
-    """Make utility functions available to templates"""
-    def get_overdue_fees_count(school_id):
-        """Get count of overdue fees for a school"""
-        try:
-            from datetime import date
-            
-            current_session = AcademicSession.query.filter_by(
-                school_id=school_id, 
-                is_current=True
-            ).first()
-            
-            if not current_session:
-                return 0
-                
-            count = db.session.query(StudentFee).join(Student).filter(
-                Student.school_id == school_id,
-                StudentFee.session_id == current_session.id,
-                StudentFee.due_date < date.today(),
-                StudentFee.status.in_(['pending', 'partial'])
-            ).count()
-            
-            return count
-        except Exception as e:
-            print(f"Error in get_overdue_fees_count: {e}")
-            return 0
-    
-    def get_overdue_fees(school_id, limit=5):
-        """Get overdue fees for a school"""
-        try:
-            from datetime import date
-            
-            current_session = AcademicSession.query.filter_by(
-                school_id=school_id, 
-                is_current=True
-            ).first()
-            
-            if not current_session:
-                return []
-                
-            overdue_fees = StudentFee.query.join(Student).filter(
-                Student.school_id == school_id,
-                StudentFee.session_id == current_session.id,
-                StudentFee.due_date < date.today(),
-                StudentFee.status.in_(['pending', 'partial'])
-            ).order_by(StudentFee.due_date).limit(limit).all()
-            
-            return overdue_fees
-        except Exception as e:
-            print(f"Error in get_overdue_fees: {e}")
-            return []
-    
-    def get_student_overdue_fees(student_id):
-        """Get overdue fee count for a specific student"""
-        try:
-            from datetime import date
-            
-            student = Student.query.get(student_id)
-            if not student:
-                return 0
-                
-            current_session = AcademicSession.query.filter_by(
-                school_id=student.school_id, 
-                is_current=True
-            ).first()
-            
-            if not current_session:
-                return 0
-                
-            count = StudentFee.query.filter_by(
-                student_id=student_id,
-                session_id=current_session.id
-            ).filter(
-                StudentFee.due_date < date.today(),
-                StudentFee.status.in_(['pending', 'partial'])
-            ).count()
-            
-            return count
-        except Exception as e:
-            print(f"Error in get_student_overdue_fees: {e}")
-            return 0
-    
-    def get_monthly_collection(school_id, session_id):
-        """Get monthly collection data for charts"""
-        try:
-            from datetime import datetime
-            import calendar
-            
-            session = AcademicSession.query.get(session_id)
-            if not session:
-                return []
-            
-            year = session.start_date.year
-            monthly_data = []
-            
-            for month in range(1, 13):
-                month_start = datetime(year, month, 1)
-                if month == 12:
-                    month_end = datetime(year + 1, 1, 1)
-                else:
-                    month_end = datetime(year, month + 1, 1)
-                
-                total = db.session.query(db.func.coalesce(db.func.sum(FeeTransaction.amount), 0)).join(
-                    Student
-                ).filter(
-                    Student.school_id == school_id,
-                    FeeTransaction.transaction_date >= month_start,
-                    FeeTransaction.transaction_date < month_end,
-                    FeeTransaction.transaction_type == 'payment',
-                    FeeTransaction.status == 'success'
-                ).scalar()
-                
-                monthly_data.append({
-                    'month': calendar.month_abbr[month],
-                    'amount': float(total or 0)
-                })
-            
-            return monthly_data
-        except Exception as e:
-            print(f"Error in get_monthly_collection: {e}")
-            return [{'month': m, 'amount': 0} for m in ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 
-                                                       'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']]
-    
-    # ADD THE get_today_attendance FUNCTION HERE
-    def get_today_attendance_helper(class_id):
-        """Helper function for templates to check today's attendance"""
-        try:
-            from datetime import date
-            
-            # Check if attendance exists for today
-            attendance = Attendance.query.filter_by(
-                class_id=class_id,
-                date=date.today()
-            ).first()
-            
-            return attendance is not None
-        except Exception as e:
-            print(f"Error in get_today_attendance_helper: {e}")
-            return False
-    
-    return {
-        'get_overdue_fees_count': get_overdue_fees_count,
-        'get_overdue_fees': get_overdue_fees,
-        'get_student_overdue_fees': get_student_overdue_fees,
-        'get_monthly_collection': get_monthly_collection,
-        'get_today_attendance': get_today_attendance_helper,  # ADD THIS LINE
-        'date': date  # Add date module for templates
-    }
+# ==================== TEMPLATE CONTEXT CACHE ====================
+# Context processors run on every render, including error pages and modals.
+# Their values are wrapped in lazy proxies so nothing is queried unless the
+# template reads it, memoized per request in flask.g, and plain values are
+# kept in a short per-school TTL cache. The TTL cache is per process, so
+# invalidation on commit only clears the local worker; the TTL bounds how
+# stale other workers can get.
+
+_context_cache = {}
+_context_cache_lock = threading.Lock()
+
+# Models whose writes change sidebar/navbar numbers
+CONTEXT_CACHE_MODELS = (
+    'Student', 'User', 'FeeStructure', 'StudentFee', 'FeeTransaction',
+    'TeacherAssignment', 'Class', 'AcademicSession', 'Attendance'
+)
+
+def lazy_context_value(loader):
+    """Defer a template variable until the template actually reads it"""
+    return LocalProxy(loader)
+
+def request_memo(key, loader):
+    """Evaluate loader at most once per request"""
+    memo = g.setdefault('context_memo', {})
+    if key not in memo:
+        memo[key] = loader()
+    return memo[key]
+
+def cached_school_value(school_id, key, loader):
+    """Memoize per request and keep plain values per school for CONTEXT_CACHE_TTL seconds.
+    
+    Only cache plain data here - ORM instances must not outlive their session.
+    """
+    cache_key = (school_id, key)
+    
+    def load():
+        now = time.monotonic()
+        with _context_cache_lock:
+            entry = _context_cache.get(cache_key)
+        if entry and entry[0] > now:
+            return entry[1]
+        
+        value = loader()
+        with _context_cache_lock:
+            _context_cache[cache_key] = (now + app.config['CONTEXT_CACHE_TTL'], value)
+        return value
+    
+    return request_memo(cache_key, load)
+
+def invalidate_context_cache(school_id):
+    """Drop every cached context value for a school"""
+    with _context_cache_lock:
+        for cache_key in [k for k in _context_cache if k[0] == school_id]:
+            del _context_cache[cache_key]
+    if has_request_context():
+        memo = g.get('context_memo') or {}
+        for cache_key in [k for k in memo if isinstance(k, tuple) and k[0] == school_id]:
+            del memo[cache_key]
+
+def mark_context_cache_dirty(school_id):
+    """Invalidate a school's context cache once the current transaction commits"""
+    if school_id:
+        db.session.info.setdefault('context_cache_schools', set()).add(school_id)
+
+@event.listens_for(db.session, 'before_flush')
+def track_context_cache_writes(session, flush_context, instances):
+    """Remember which schools had sidebar-relevant rows written"""
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if type(obj).__name__ not in CONTEXT_CACHE_MODELS:
+            continue
+        school_id = getattr(obj, 'school_id', None)
+        if school_id is None and has_request_context() and current_user.is_authenticated:
+            school_id = current_user.school_id
+        if school_id:
+            session.info.setdefault('context_cache_schools', set()).add(school_id)
+
+@event.listens_for(db.session, 'after_commit')
+def flush_context_cache(session):
+    for school_id in session.info.pop('context_cache_schools', ()):
+        invalidate_context_cache(school_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_context_cache_marks(session):
+    session.info.pop('context_cache_schools', None)
+
+def get_cached_current_session_id(school_id):
+    """Current session id for a school, served from the context cache"""
+    def load():
+        current_session = get_current_session(school_id)
+        return current_session.id if current_session else None
+    return cached_school_value(school_id, 'current_session_id', load)
+
+def get_cached_view_session_id(school_id):
+    """Same resolution as get_view_session, without querying on a warm cache"""
+    active_session_ids = cached_school_value(school_id, 'active_session_ids', lambda: {
+        row.id for row in db.session.query(AcademicSession.id).filter_by(
+            school_id=school_id,
+            is_active=True
+        )
+    })
+    view_session_id = session.get(f'view_session_{school_id}')
+    if view_session_id in active_session_ids:
+        return view_session_id
+    return get_cached_current_session_id(school_id)
 
 class StudentFee(db.Model):
     __tablename__ = 'student_fees'
@@ -3235,6 +4695,13 @@ class StudentFee(db.Model):
     session = db.relationship('AcademicSession', backref='student_fees')
     class_ = db.relationship('Class', backref='fee_records')
     
+    # One fee record per student per fee structure per session
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'fee_structure_id', 'session_id',
+                            name='uq_student_fee_structure_session'),
+        db.Index('ix_student_fees_session_status_due', 'session_id', 'status', 'due_date'),
+    )
+    
     # Property for balance
     @property
     def balance(self):
@@ -3259,6 +4726,192 @@ class StudentFee(db.Model):
         else:
             self.status = 'pending'
 
+class SchoolFeeStats(db.Model):
+    """Materialized fee totals per (school, session), kept current by the fee write paths"""
+    __tablename__ = 'school_fee_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    total_fees = db.Column(db.Float, default=0.0)
+    total_paid = db.Column(db.Float, default=0.0)
+    total_discount = db.Column(db.Float, default=0.0)
+    total_fine = db.Column(db.Float, default=0.0)
+    fee_count = db.Column(db.Integer, default=0)
+    paid_count = db.Column(db.Integer, default=0)
+    pending_count = db.Column(db.Integer, default=0)
+    partial_count = db.Column(db.Integer, default=0)
+    overdue_count = db.Column(db.Integer, default=0)
+    overdue_as_of = db.Column(db.Date)
+    students_with_fees = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Foreign keys
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('academic_sessions.id'), nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('school_id', 'session_id', name='uq_school_fee_stats_school_session'),
+    )
+
+# ==================== CSV EXPORTS ====================
+
+CSV_EXPORT_BATCH_SIZE = 1000
+CSV_EXPORT_CHUNK_SIZE = 64 * 1024
+
+def gzip_chunks(chunks):
+    """Gzip-compress a stream of text chunks incrementally"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def stream_csv_response(filename, header, rows, compress=False):
+    """Stream rows as a CSV attachment while they are fetched.
+    
+    The header is sent immediately and rows are flushed in ~64KB chunks, so
+    memory stays flat regardless of export size.
+    """
+    def generate_csv():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() >= CSV_EXPORT_CHUNK_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue()
+    
+    chunks = generate_csv()
+    mimetype = 'text/csv'
+    if compress:
+        chunks = gzip_chunks(chunks)
+        filename = f'{filename}.gz'
+        mimetype = 'application/gzip'
+    
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+def stream_query_rows(query):
+    """Execute a select on a server-side cursor, fetching CSV_EXPORT_BATCH_SIZE rows at a time"""
+    return db.session.execute(query.execution_options(yield_per=CSV_EXPORT_BATCH_SIZE))
+
+def student_fees_export(school_id, session_id, status_filter='all', student_id='', class_id=None):
+    """Filename, header, select and row formatter for the student fees export"""
+    query = db.select(
+        Student.student_id,
+        Student.first_name,
+        Student.last_name,
+        Class.name.label('class_name'),
+        FeeStructure.name.label('fee_type'),
+        StudentFee.fee_amount,
+        StudentFee.discount_amount,
+        StudentFee.paid_amount,
+        fee_balance_expr().label('balance'),
+        StudentFee.due_date,
+        StudentFee.status
+    ).select_from(StudentFee).join(
+        Student, Student.id == StudentFee.student_id
+    ).join(
+        FeeStructure, FeeStructure.id == StudentFee.fee_structure_id
+    ).outerjoin(
+        Class, Class.id == StudentFee.class_id
+    ).where(
+        Student.school_id == school_id,
+        StudentFee.session_id == session_id
+    )
+    
+    if status_filter != 'all':
+        query = query.where(StudentFee.status == status_filter)
+    if student_id:
+        query = query.where(Student.student_id.like(f'%{student_id}%'))
+    if class_id:
+        enrollments = db.select(StudentEnrollment.student_id).where(
+            StudentEnrollment.class_id == class_id,
+            StudentEnrollment.session_id == session_id,
+            StudentEnrollment.is_active == True
+        )
+        query = query.where(Student.id.in_(enrollments))
+    
+    def format_row(row):
+        return [
+            row.student_id,
+            f"{row.first_name} {row.last_name}",
+            row.class_name or 'All Classes',
+            row.fee_type,
+            row.fee_amount,
+            row.discount_amount,
+            row.paid_amount,
+            row.balance,
+            row.due_date.strftime('%Y-%m-%d'),
+            row.status.upper()
+        ]
+    
+    header = ['Student ID', 'Student Name', 'Class', 'Fee Type',
+              'Total Amount', 'Discount', 'Paid', 'Balance', 'Due Date', 'Status']
+    return 'student_fees.csv', header, query.order_by(StudentFee.due_date), format_row
+
+def fee_transactions_export(school_id, start_date, end_date):
+    """Filename, header, select and row formatter for the fee transactions export"""
+    query = db.select(
+        FeeTransaction.transaction_date,
+        Student.student_id,
+        Student.first_name,
+        Student.last_name,
+        FeeStructure.name.label('fee_type'),
+        FeeTransaction.amount,
+        FeeTransaction.payment_method,
+        FeeTransaction.receipt_number,
+        FeeTransaction.transaction_id
+    ).select_from(FeeTransaction).join(
+        Student, Student.id == FeeTransaction.student_id
+    ).outerjoin(
+        StudentFee, StudentFee.id == FeeTransaction.student_fee_id
+    ).outerjoin(
+        FeeStructure, FeeStructure.id == StudentFee.fee_structure_id
+    ).where(
+        Student.school_id == school_id,
+        FeeTransaction.transaction_date >= start_date,
+        FeeTransaction.transaction_date <= end_date,
+        FeeTransaction.transaction_type == 'payment',
+        FeeTransaction.status == 'success'
+    ).order_by(FeeTransaction.transaction_date.desc())
+    
+    def format_row(row):
+        return [
+            row.transaction_date.strftime('%Y-%m-%d'),
+            row.student_id,
+            f"{row.first_name} {row.last_name}",
+            row.fee_type or 'Fee Payment',
+            row.amount,
+            row.payment_method,
+            row.receipt_number,
+            row.transaction_id
+        ]
+    
+    header = ['Date', 'Student ID', 'Student Name', 'Fee Type',
+              'Amount', 'Payment Method', 'Receipt Number', 'Transaction ID']
+    return 'fee_transactions.csv', header, query, format_row
+
+def export_csv(export, filters, compress=False):
+    """Stream an export, or queue it as a background job when ?background=1"""
+    if request.args.get('background'):
+        payload = {key: value.isoformat() if isinstance(value, date) else value
+                   for key, value in filters.items()}
+        job = enqueue_job('export_csv', dict(payload, export=export, compress=compress))
+        return job_status_redirect(job, next_url=url_for('manage_fees'))
+    
+    builder = student_fees_export if export == 'student_fees' else fee_transactions_export
+    filename, header, query, format_row = builder(**filters)
+    rows = (format_row(row) for row in stream_query_rows(query))
+    return stream_csv_response(filename, header, rows, compress=compress)
+
 @app.route('/admin/fees/export')
 @role_required(['admin'])
 @school_active_required
@@ -3274,61 +4927,14 @@ def export_student_fees():
         return redirect(url_for('admin_dashboard'))
     
     # Get filters from request (same as manage_student_fees)
-    status_filter = request.args.get('status', 'all')
-    student_id = request.args.get('student_id', '')
-    class_id = request.args.get('class_id', type=int)
-    
-    # Build query
-    query = StudentFee.query.join(Student).join(FeeStructure).filter(
-        Student.school_id == current_user.school_id,
-        StudentFee.session_id == view_session.id
-    )
-    
-    if status_filter != 'all':
-        query = query.filter(StudentFee.status == status_filter)
-    if student_id:
-        query = query.filter(Student.student_id.like(f'%{student_id}%'))
-    if class_id:
-        enrollments = StudentEnrollment.query.filter_by(
-            class_id=class_id,
-            session_id=view_session.id,
-            is_active=True
-        ).subquery()
-        query = query.filter(Student.id == enrollments.c.student_id)
-    
-    student_fees = query.order_by(StudentFee.due_date).all()
-    
-    # Prepare CSV in memory
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow([
-        'Student ID', 'Student Name', 'Class', 'Fee Type',
-        'Total Amount', 'Discount', 'Paid', 'Balance', 'Due Date', 'Status'
-    ])
-    
-    for fee in student_fees:
-        # Get class name (if applicable)
-        class_name = fee.class_.name if fee.class_ else 'All Classes'
-        if not class_name and fee.student.current_class:
-            class_name = fee.student.current_class.name
-        
-        writer.writerow([
-            fee.student.student_id,
-            f"{fee.student.first_name} {fee.student.last_name}",
-            class_name,
-            fee.fee_structure.name,
-            fee.fee_amount,
-            fee.discount_amount,
-            fee.paid_amount,
-            fee.balance,
-            fee.due_date.strftime('%Y-%m-%d'),
-            fee.status.upper()
-        ])
-    
-    output = make_response(si.getvalue())
-    output.headers["Content-Disposition"] = "attachment; filename=student_fees.csv"
-    output.headers["Content-type"] = "text/csv"
-    return output
+    filters = {
+        'school_id': current_user.school_id,
+        'session_id': view_session.id,
+        'status_filter': request.args.get('status', 'all'),
+        'student_id': request.args.get('student_id', ''),
+        'class_id': request.args.get('class_id', type=int)
+    }
+    return export_csv('student_fees', filters, compress=request.args.get('compress') == 'gzip')
 
 
 @app.route('/admin/fees/export-reports')
@@ -3356,100 +4962,303 @@ def export_fee_reports():
         start_date = date.today().replace(day=1)
         end_date = date.today()
     
-    transactions = FeeTransaction.query.join(Student).filter(
-        Student.school_id == current_user.school_id,
-        FeeTransaction.transaction_date >= start_date,
-        FeeTransaction.transaction_date <= end_date,
-        FeeTransaction.transaction_type == 'payment',
-        FeeTransaction.status == 'success'
-    ).order_by(FeeTransaction.transaction_date.desc()).all()
+    filters = {
+        'school_id': current_user.school_id,
+        'start_date': start_date,
+        'end_date': end_date
+    }
+    return export_csv('fee_transactions', filters, compress=request.args.get('compress') == 'gzip')
+
+# ==================== FEE STATISTICS ====================
+
+FEE_STATS_STATUS_FIELDS = {
+    'paid': 'paid_count',
+    'pending': 'pending_count',
+    'partial': 'partial_count',
+}
+
+def fee_stats_snapshot(fee):
+    """Contribution of a single student fee (a StudentFee or a student_fees
+    row) to its school's SchoolFeeStats row"""
+    if fee is None:
+        return {}
+    
+    balance = ((fee.fee_amount or 0) - (fee.discount_amount or 0)
+               + (fee.fine_amount or 0) - (fee.paid_amount or 0))
+    snapshot = {
+        'total_fees': fee.fee_amount or 0,
+        'total_paid': fee.paid_amount or 0,
+        'total_discount': fee.discount_amount or 0,
+        'total_fine': fee.fine_amount or 0,
+        'fee_count': 1,
+        'overdue_count': 1 if fee.due_date and fee.due_date < date.today() and balance > 0 else 0,
+    }
+    status_field = FEE_STATS_STATUS_FIELDS.get(fee.status)
+    if status_field:
+        snapshot[status_field] = 1
+    return snapshot
+
+def fee_stats_delta(before=None, after=None, into=None):
+    """Accumulate (after - before) snapshot differences into a delta dict"""
+    delta = into if into is not None else {}
+    for key, value in (after or {}).items():
+        delta[key] = delta.get(key, 0) + value
+    for key, value in (before or {}).items():
+        delta[key] = delta.get(key, 0) - value
+    return delta
+
+def create_school_fee_stats_row(connection, school_id, session_id, lock=False):
+    """Insert an empty stats row unless one exists. Returns True if this call
+    created it. The new row, or with lock=True an existing one, stays locked
+    until the transaction ends, so a writer and a rebuild never overlap."""
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    
+    stats_table = SchoolFeeStats.__table__
+    created = connection.execute(
+        pg_insert(stats_table).values(school_id=school_id, session_id=session_id)
+        .on_conflict_do_nothing(index_elements=['school_id', 'session_id'])
+        .returning(stats_table.c.id)
+    ).first() is not None
+    if lock and not created:
+        connection.execute(
+            db.select(stats_table.c.id)
+            .where(stats_table.c.school_id == school_id, stats_table.c.session_id == session_id)
+            .with_for_update()
+        )
+    return created
+
+def apply_school_fee_stats(connection, school_id, session_id, delta, refresh_students=False):
+    """Apply a fee stats delta on the caller's transaction.
     
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow([
-        'Date', 'Student ID', 'Student Name', 'Fee Type',
-        'Amount', 'Payment Method', 'Receipt Number', 'Transaction ID'
-    ])
+    The UPDATE uses column arithmetic so concurrent writers never lose each
+    other's increments. If the row has not been built yet it is built here,
+    from student_fees as this transaction sees them, instead of the delta.
+    """
+    stats_table = SchoolFeeStats.__table__
+    values = {key: stats_table.c[key] + value for key, value in delta.items() if value}
+    
+    if refresh_students:
+        values['students_with_fees'] = (
+            db.select(func.count(func.distinct(StudentFee.student_id)))
+            .join(Student, Student.id == StudentFee.student_id)
+            .where(Student.school_id == school_id, StudentFee.session_id == session_id)
+            .scalar_subquery()
+        )
+    
+    if not values:
+        return
+    
+    mark_context_cache_dirty(school_id)
+    if create_school_fee_stats_row(connection, school_id, session_id):
+        values = compute_school_fee_stats(school_id, session_id, connection)
+    values['updated_at'] = datetime.utcnow()
+    connection.execute(
+        stats_table.update()
+        .where(stats_table.c.school_id == school_id,
+               stats_table.c.session_id == session_id)
+        .values(values)
+    )
+
+def update_school_fee_stats(school_id, session_id, delta, refresh_students=False):
+    """Apply the delta of a set-based student_fees write the flush listener
+    below cannot see. The caller commits."""
+    db.session.flush()
+    apply_school_fee_stats(db.session.connection(), school_id, session_id, delta, refresh_students)
+
+@event.listens_for(db.session, 'before_flush')
+def track_student_fee_writes(session, flush_context, instances):
+    """Work out how a flush changes each school's fee stats.
+    
+    Updated and deleted fees are read back as they stand before the flush,
+    so their old contribution is exact however their attributes were set.
+    """
+    new = [obj for obj in session.new if isinstance(obj, StudentFee)]
+    dirty = [obj for obj in session.dirty if isinstance(obj, StudentFee) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, StudentFee)]
+    deltas = session.info['fee_stats_deltas'] = {}
+    # Stats whose distinct student count a new or deleted fee may change
+    refresh = session.info['fee_stats_refresh'] = set()
+    if not (new or dirty or deleted):
+        return
+    
+    fees = StudentFee.__table__
+    deleted_ids = {fee.id for fee in deleted}
+    with session.no_autoflush:
+        if dirty or deleted:
+            previous = session.execute(
+                db.select(fees, Student.school_id)
+                .join(Student, Student.id == fees.c.student_id)
+                .where(fees.c.id.in_([fee.id for fee in dirty] + list(deleted_ids)))
+            ).all()
+            for row in previous:
+                key = (row.school_id, row.session_id)
+                fee_stats_delta(before=fee_stats_snapshot(row), into=deltas.setdefault(key, {}))
+                if row.id in deleted_ids:
+                    refresh.add(key)
+        
+        student_ids = {fee.student_id for fee in new + dirty if fee.student_id}
+        schools = dict(session.execute(
+            db.select(Student.id, Student.school_id).where(Student.id.in_(student_ids))
+        ).all()) if student_ids else {}
+        for fee in new + dirty:
+            school_id = schools.get(fee.student_id) or (fee.student.school_id if fee.student else None)
+            key = (school_id, fee.session_id)
+            fee_stats_delta(after=fee_stats_snapshot(fee), into=deltas.setdefault(key, {}))
+            if fee in session.new:
+                refresh.add(key)
+
+@event.listens_for(db.session, 'after_flush')
+def apply_flushed_fee_stats(session, flush_context):
+    refresh = session.info.pop('fee_stats_refresh', set())
+    for (school_id, session_id), delta in session.info.pop('fee_stats_deltas', {}).items():
+        if school_id and session_id:
+            apply_school_fee_stats(session.connection(), school_id, session_id, delta,
+                                   refresh_students=(school_id, session_id) in refresh)
+
+def compute_school_fee_stats(school_id, session_id, connection=None):
+    """Compute fee totals for a school session with one grouped query"""
+    today = date.today()
+    balance = (StudentFee.fee_amount - StudentFee.discount_amount
+               + StudentFee.fine_amount - StudentFee.paid_amount)
+    query = (
+        db.select(
+            func.coalesce(func.sum(StudentFee.fee_amount), 0),
+            func.coalesce(func.sum(StudentFee.paid_amount), 0),
+            func.coalesce(func.sum(StudentFee.discount_amount), 0),
+            func.coalesce(func.sum(StudentFee.fine_amount), 0),
+            func.count(StudentFee.id),
+            func.count(StudentFee.id).filter(StudentFee.status == 'paid'),
+            func.count(StudentFee.id).filter(StudentFee.status == 'pending'),
+            func.count(StudentFee.id).filter(StudentFee.status == 'partial'),
+            func.count(StudentFee.id).filter(and_(StudentFee.due_date < today, balance > 0)),
+            func.count(func.distinct(StudentFee.student_id)),
+        )
+        .select_from(StudentFee)
+        .join(Student, Student.id == StudentFee.student_id)
+        .where(Student.school_id == school_id, StudentFee.session_id == session_id)
+    )
+    row = (connection or db.session).execute(query).one()
+    
+    return {
+        'total_fees': row[0],
+        'total_paid': row[1],
+        'total_discount': row[2],
+        'total_fine': row[3],
+        'fee_count': row[4],
+        'paid_count': row[5],
+        'pending_count': row[6],
+        'partial_count': row[7],
+        'overdue_count': row[8],
+        'students_with_fees': row[9],
+        'overdue_as_of': today,
+    }
+
+def rebuild_school_fee_stats(school_id, session_id):
+    """Recompute and store the SchoolFeeStats row for a school session.
     
-    for txn in transactions:
-        fee_type = txn.student_fee.fee_structure.name if txn.student_fee else 'Fee Payment'
-        writer.writerow([
-            txn.transaction_date.strftime('%Y-%m-%d'),
-            txn.student.student_id,
-            f"{txn.student.first_name} {txn.student.last_name}",
-            fee_type,
-            txn.amount,
-            txn.payment_method,
-            txn.receipt_number,
-            txn.transaction_id
-        ])
-    
-    output = make_response(si.getvalue())
-    output.headers["Content-Disposition"] = "attachment; filename=fee_transactions.csv"
-    output.headers["Content-type"] = "text/csv"
-    return output
+    Runs on its own connection so it never commits the caller's pending
+    ORM changes. The row is locked before counting: a writer that already
+    applied a delta is waited for and counted, one that comes later adds its
+    delta after this commits.
+    """
+    stats_table = SchoolFeeStats.__table__
+    with db.engine.begin() as connection:
+        create_school_fee_stats_row(connection, school_id, session_id, lock=True)
+        values = compute_school_fee_stats(school_id, session_id, connection)
+        values['updated_at'] = datetime.utcnow()
+        connection.execute(
+            stats_table.update()
+            .where(stats_table.c.school_id == school_id,
+                   stats_table.c.session_id == session_id)
+            .values(values)
+        )
+    return values
+
+def refresh_overdue_fee_count(school_id, session_id):
+    """Overdue depends on today's date, so recount it once per day"""
+    today = date.today()
+    balance = (StudentFee.fee_amount - StudentFee.discount_amount
+               + StudentFee.fine_amount - StudentFee.paid_amount)
+    overdue_count = (
+        db.select(func.count(StudentFee.id))
+        .join(Student, Student.id == StudentFee.student_id)
+        .where(Student.school_id == school_id,
+               StudentFee.session_id == session_id,
+               StudentFee.due_date < today,
+               balance > 0)
+        .scalar_subquery()
+    )
+    stats_table = SchoolFeeStats.__table__
+    with db.engine.begin() as connection:
+        return connection.execute(
+            stats_table.update()
+            .where(stats_table.c.school_id == school_id,
+                   stats_table.c.session_id == session_id)
+            .values(overdue_count=overdue_count, overdue_as_of=today)
+            .returning(stats_table.c.overdue_count)
+        ).scalar()
 
 def get_school_fee_statistics(school_id, session_id):
     """Get comprehensive fee statistics for a school"""
-    try:
-        # Get all student fees for the session
-        student_fees = StudentFee.query.join(Student).filter(
-            Student.school_id == school_id,
-            StudentFee.session_id == session_id
-        ).all()
-        
-        # Get all students
-        all_students = Student.query.filter_by(
-            school_id=school_id,
-            is_active=True
-        ).all()
-        
-        # Get all fee structures
-        fee_structures = FeeStructure.query.filter_by(
-            school_id=school_id,
-            session_id=session_id,
-            is_active=True
-        ).all()
-        
-        # Calculate which students have fees assigned
-        students_with_fees = set([f.student_id for f in student_fees])
-        
-        return {
-            'total_fees': sum(f.fee_amount for f in student_fees),
-            'total_paid': sum(f.paid_amount for f in student_fees),
-            'total_due': sum(f.net_amount - f.paid_amount for f in student_fees),
-            'total_discount': sum(f.discount_amount for f in student_fees),
-            'total_fine': sum(f.fine_amount for f in student_fees),
-            'total_net': sum(f.net_amount for f in student_fees),
-            'paid_count': len([f for f in student_fees if f.status == 'paid']),
-            'pending_count': len([f for f in student_fees if f.status == 'pending']),
-            'partial_count': len([f for f in student_fees if f.status == 'partial']),
-            'overdue_count': len([f for f in student_fees if f.due_date < date.today() and f.balance > 0]),
-            'student_fees_count': len(student_fees),
-            'total_students': len(all_students),
-            'students_without_fees': len(all_students) - len(students_with_fees),
-            'fee_structures_count': len(fee_structures),
-            'has_unassigned_fees': len(fee_structures) > 0 and len(students_with_fees) == 0
-        }
-    except Exception as e:
-        print(f"Error in get_school_fee_statistics: {e}")
-        return {
-            'total_fees': 0,
-            'total_paid': 0,
-            'total_due': 0,
-            'total_discount': 0,
-            'total_fine': 0,
-            'total_net': 0,
-            'paid_count': 0,
-            'pending_count': 0,
-            'partial_count': 0,
-            'overdue_count': 0,
-            'student_fees_count': 0,
-            'total_students': 0,
-            'students_without_fees': 0,
-            'fee_structures_count': 0,
-            'has_unassigned_fees': False
-        }
+    stats = db.session.execute(
+        db.select(SchoolFeeStats.__table__).where(
+            SchoolFeeStats.school_id == school_id,
+            SchoolFeeStats.session_id == session_id
+        )
+    ).mappings().first()
+    
+    if stats is None:
+        stats = rebuild_school_fee_stats(school_id, session_id)
+    elif stats['overdue_as_of'] != date.today():
+        stats = dict(stats)
+        stats['overdue_count'] = refresh_overdue_fee_count(school_id, session_id)
+    
+    total_students = db.session.query(func.count(Student.id)).filter(
+        Student.school_id == school_id,
+        Student.is_active == True
+    ).scalar()
+    
+    fee_structures_count = db.session.query(func.count(FeeStructure.id)).filter(
+        FeeStructure.school_id == school_id,
+        FeeStructure.session_id == session_id,
+        FeeStructure.is_active == True
+    ).scalar()
+    
+    total_net = stats['total_fees'] - stats['total_discount'] + stats['total_fine']
+    
+    return {
+        'total_fees': stats['total_fees'],
+        'total_paid': stats['total_paid'],
+        'total_due': total_net - stats['total_paid'],
+        'total_discount': stats['total_discount'],
+        'total_fine': stats['total_fine'],
+        'total_net': total_net,
+        'paid_count': stats['paid_count'],
+        'pending_count': stats['pending_count'],
+        'partial_count': stats['partial_count'],
+        'overdue_count': stats['overdue_count'],
+        'student_fees_count': stats['fee_count'],
+        'total_students': total_students,
+        'students_without_fees': total_students - stats['students_with_fees'],
+        'fee_structures_count': fee_structures_count,
+        'has_unassigned_fees': fee_structures_count > 0 and stats['students_with_fees'] == 0
+    }
+
+@app.cli.command('reconcile-fee-stats')
+@click.option('--school-id', type=int, default=None, help='Only rebuild this school')
+def reconcile_fee_stats_command(school_id):
+    """Rebuild the school_fee_stats table from student_fees"""
+    query = AcademicSession.query
+    if school_id:
+        query = query.filter_by(school_id=school_id)
+    
+    sessions = query.all()
+    for academic_session in sessions:
+        stats = rebuild_school_fee_stats(academic_session.school_id, academic_session.id)
+        print(f"School {academic_session.school_id} / {academic_session.name}: "
+              f"{stats['fee_count']} fees, ₹{stats['total_paid']:.2f} paid")
+        invalidate_context_cache(academic_session.school_id)
+    print(f"Rebuilt fee stats for {len(sessions)} session(s).")
     
 
 @app.route('/admin/debug/classes')
@@ -3537,56 +5346,135 @@ def debug_fee_data():
                          fee_assignment_status=fee_assignment_status,
                          view_session=view_session)
 
+def bulk_assign_fee_structure(fee_structure, due_date, class_ids=None, all_students=False):
+    """Assign a fee structure to many students with one INSERT ... SELECT.
+    
+    Targets the students enrolled in class_ids, every active student of the
+    school when all_students is set, or otherwise the structure's applicable
+    students (its class, or every active student).
+    Class, active discounts and status are resolved in SQL, existing
+    (student, structure, session) rows are skipped through the unique
+    constraint, and school fee stats are updated in the same transaction.
+    The caller commits. Returns {'inserted': n, 'skipped': n}.
+    """
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    
+    session_id = fee_structure.session_id
+    amount = fee_structure.amount
+    now = datetime.utcnow()
+    
+    # Class the student is enrolled in for the fee's session
+    enrollment = db.select(
+        StudentEnrollment.student_id,
+        func.min(StudentEnrollment.class_id).label('class_id')
+    ).where(
+        StudentEnrollment.session_id == session_id,
+        StudentEnrollment.is_active == True
+    ).group_by(StudentEnrollment.student_id).subquery('enrollment')
+    
+    # Active discounts for this structure valid on the due date
+    discount = db.select(
+        FeeDiscount.student_id,
+        func.sum(db.case(
+            (FeeDiscount.discount_type == 'percentage', amount * FeeDiscount.value / 100),
+            else_=FeeDiscount.value
+        )).label('discount_amount')
+    ).where(
+        FeeDiscount.fee_structure_id == fee_structure.id,
+        FeeDiscount.is_active == True,
+        FeeDiscount.valid_from <= due_date,
+        FeeDiscount.valid_to >= due_date
+    ).group_by(FeeDiscount.student_id).subquery('discount')
+    
+    if class_ids is None and fee_structure.class_id and not all_students:
+        class_ids = [fee_structure.class_id]
+    
+    if class_ids is None:
+        targets = db.select(Student.id).where(
+            Student.school_id == fee_structure.school_id,
+            Student.is_active == True
+        )
+    else:
+        targets = db.select(StudentEnrollment.student_id).join(
+            Student, Student.id == StudentEnrollment.student_id
+        ).where(
+            Student.school_id == fee_structure.school_id,
+            StudentEnrollment.class_id.in_(class_ids),
+            StudentEnrollment.session_id == session_id,
+            StudentEnrollment.is_active == True
+        )
+    
+    discount_amount = func.coalesce(discount.c.discount_amount, 0)
+    is_overdue = due_date < date.today()
+    # Same rules as StudentFee.update_status for an unpaid fee
+    status = db.case(
+        (amount - discount_amount <= 0, 'paid'),
+        else_='overdue' if is_overdue else 'pending'
+    )
+    
+    candidates = db.select(
+        Student.id.label('student_id'),
+        db.literal(fee_structure.id).label('fee_structure_id'),
+        db.literal(session_id).label('session_id'),
+        enrollment.c.class_id,
+        db.literal(amount).label('fee_amount'),
+        discount_amount.label('discount_amount'),
+        db.literal(0.0).label('fine_amount'),
+        db.literal(0.0).label('paid_amount'),
+        db.literal(due_date).label('due_date'),
+        status.label('status'),
+        db.literal(now).label('created_at'),
+        db.literal(now).label('updated_at')
+    ).select_from(Student).outerjoin(
+        enrollment, enrollment.c.student_id == Student.id
+    ).outerjoin(
+        discount, discount.c.student_id == Student.id
+    ).where(Student.id.in_(targets)).cte('candidates')
+    
+    columns = ['student_id', 'fee_structure_id', 'session_id', 'class_id', 'fee_amount',
+               'discount_amount', 'fine_amount', 'paid_amount', 'due_date', 'status',
+               'created_at', 'updated_at']
+    inserted = pg_insert(StudentFee.__table__).from_select(
+        columns, db.select(*[candidates.c[name] for name in columns])
+    ).on_conflict_do_nothing(
+        index_elements=['student_id', 'fee_structure_id', 'session_id']
+    ).returning(
+        StudentFee.fee_amount, StudentFee.discount_amount, StudentFee.status
+    ).cte('inserted')
+    
+    # Report counts and the stats delta from the same statement
+    result = db.session.execute(db.select(
+        db.select(func.count()).select_from(candidates).scalar_subquery().label('candidates'),
+        db.select(func.count()).select_from(inserted).scalar_subquery().label('inserted'),
+        db.select(func.coalesce(func.sum(inserted.c.fee_amount), 0)).scalar_subquery().label('total_fees'),
+        db.select(func.coalesce(func.sum(inserted.c.discount_amount), 0)).scalar_subquery().label('total_discount'),
+        db.select(func.count()).select_from(inserted).where(
+            inserted.c.status == 'paid'
+        ).scalar_subquery().label('paid_count')
+    )).one()
+    
+    if result.inserted:
+        unpaid_count = result.inserted - result.paid_count
+        update_school_fee_stats(fee_structure.school_id, session_id, {
+            'total_fees': result.total_fees,
+            'total_discount': result.total_discount,
+            'fee_count': result.inserted,
+            'paid_count': result.paid_count,
+            'pending_count': 0 if is_overdue else unpaid_count,
+            'overdue_count': unpaid_count if is_overdue else 0,
+        }, refresh_students=True)
+    
+    return {'inserted': result.inserted, 'skipped': result.candidates - result.inserted}
+
 def assign_fee_to_all_students(fee_structure_id, due_date):
     """Assign fee structure to all applicable students"""
     fee_structure = FeeStructure.query.get(fee_structure_id)
     if not fee_structure:
-        return 0
-    
-    students = fee_structure.get_applicable_students()
-    assigned_count = 0
-    
-    for student in students:
-        # Check if fee already exists
-        existing = StudentFee.query.filter_by(
-            student_id=student.id,
-            fee_structure_id=fee_structure.id,
-            session_id=fee_structure.session_id
-        ).first()
-        
-        if not existing:
-            # Create student fee record
-            student_fee = StudentFee(
-                student_id=student.id,
-                fee_structure_id=fee_structure.id,
-                session_id=fee_structure.session_id,
-                class_id=student.current_class.id if student.current_class else None,
-                fee_amount=fee_structure.amount,
-                due_date=due_date,
-                status='pending'
-            )
-            
-            # Apply any active discounts
-            discounts = FeeDiscount.query.filter(
-                FeeDiscount.student_id == student.id,
-                FeeDiscount.fee_structure_id == fee_structure.id,
-                FeeDiscount.is_active == True,
-                FeeDiscount.valid_from <= due_date,
-                FeeDiscount.valid_to >= due_date
-            ).all()
-            
-            for discount in discounts:
-                if discount.discount_type == 'percentage':
-                    student_fee.discount_amount += fee_structure.amount * (discount.value / 100)
-                else:
-                    student_fee.discount_amount += discount.value
-            
-            student_fee.update_status()
-            db.session.add(student_fee)
-            assigned_count += 1
+        return {'inserted': 0, 'skipped': 0}
     
+    result = bulk_assign_fee_structure(fee_structure, due_date)
     db.session.commit()
-    return assigned_count
+    return result
 
 class FeeTransaction(db.Model):
     __tablename__ = 'fee_transactions'
@@ -3609,6 +5497,10 @@ class FeeTransaction(db.Model):
     student_fee = db.relationship('StudentFee', backref='transactions')
     student = db.relationship('Student', back_populates='transactions')
     created_by_user = db.relationship('User', foreign_keys=[created_by])
+    
+    __table_args__ = (
+        db.Index('ix_fee_transactions_student_date', 'student_id', 'transaction_date'),
+    )
 
 class FeeDiscount(db.Model):
     __tablename__ = 'fee_discounts'
@@ -3847,10 +5739,11 @@ def assign_fee_to_students(fee_id):
     
     if form.validate_on_submit():
         try:
-            assigned_count = assign_fee_to_all_students(fee_structure.id, form.due_date.data)
-            
-            flash(f'Fee assigned to {assigned_count} students successfully!', 'success')
-            return redirect(url_for('manage_student_fees'))
+            job = enqueue_job('assign_fee_structure', {
+                'fee_structure_id': fee_structure.id,
+                'due_date': form.due_date.data.isoformat()
+            })
+            return job_status_redirect(job, next_url=url_for('manage_student_fees'))
             
         except Exception as e:
             db.session.rollback()
@@ -4375,58 +6268,209 @@ def fee_reports():
         start_date = date.today().replace(day=1)
         end_date = date.today()
     
-    # Get ALL student fees (not just transactions) for the view session
-    all_student_fees = StudentFee.query.join(Student).join(FeeStructure).filter(
-        Student.school_id == current_user.school_id,
-        StudentFee.session_id == view_session.id  # Filter by view_session
-    ).all()
+    # Summary statistics for the view session, computed in SQL
+    summary = summarize_student_fees(current_user.school_id, view_session.id)
     
-    # Get payment transactions in date range
-    transactions = FeeTransaction.query.join(Student).filter(
+    # Get recent payment transactions in date range for display
+    recent_transactions = FeeTransaction.query.join(Student).options(
+        joinedload(FeeTransaction.student),
+        joinedload(FeeTransaction.student_fee).joinedload(StudentFee.fee_structure)
+    ).filter(
         Student.school_id == current_user.school_id,
         FeeTransaction.transaction_date >= start_date,
         FeeTransaction.transaction_date <= end_date,
         FeeTransaction.transaction_type == 'payment',
         FeeTransaction.status == 'success'
-    ).order_by(FeeTransaction.transaction_date.desc()).all()
-    
-    # Get summary statistics from all_student_fees
-    total_fees = sum([f.fee_amount for f in all_student_fees])
-    total_paid = sum([f.paid_amount for f in all_student_fees])
-    total_discount = sum([f.discount_amount for f in all_student_fees])
-    total_fine = sum([f.fine_amount for f in all_student_fees])
-    total_due = sum([f.net_amount - f.paid_amount for f in all_student_fees])
-    
-    # Get pending fees (unpaid or partially paid)
-    pending_fees = [f for f in all_student_fees if f.status in ['pending', 'partial']]
-    total_pending = sum([f.net_amount - f.paid_amount for f in pending_fees])
-    
-    # Get overdue fees
-    overdue_fees = [f for f in pending_fees if f.due_date < date.today()]
-    total_overdue = sum([f.net_amount - f.paid_amount for f in overdue_fees])
-    
-    # Get recent transactions for display
-    recent_transactions = transactions[:20]  # Limit to 20 for display
+    ).order_by(FeeTransaction.transaction_date.desc()).limit(20).all()  # Limit to 20 for display
     
     return render_template('admin_fee_reports.html',
                          context=context,
-                         all_student_fees=all_student_fees,
+                         student_fees_count=summary['fee_records_count'],
                          transactions=recent_transactions,
-                         total_fees=total_fees,
-                         total_paid=total_paid,
-                         total_discount=total_discount,
-                         total_fine=total_fine,
-                         total_due=total_due,
-                         total_pending=total_pending,
-                         total_overdue=total_overdue,
-                         pending_fees_count=len(pending_fees),
-                         overdue_fees_count=len(overdue_fees),
+                         total_fees=summary['total_fees'],
+                         total_paid=summary['total_paid'],
+                         total_discount=summary['total_discount'],
+                         total_fine=summary['total_fine'],
+                         total_due=summary['total_due'],
+                         total_pending=summary['total_pending'],
+                         total_overdue=summary['total_overdue'],
+                         pending_fees_count=summary['pending_count'],
+                         overdue_fees_count=summary['overdue_count'],
                          start_date=start_date,
                          end_date=end_date,
                          view_session=view_session,
                          date=date.today())  # ADD THIS LINE
 
 
+# ==================== FEE AGGREGATION ====================
+# Dashboard numbers are computed in the database: one grouped query per
+# figure, returning plain rows instead of hydrated StudentFee /
+# FeeTransaction objects, so page time does not grow with fee volume.
+
+OPEN_FEE_STATUSES = ('pending', 'partial')
+
+def fee_balance_expr():
+    """SQL expression matching StudentFee.balance"""
+    return (StudentFee.fee_amount - StudentFee.discount_amount
+            + StudentFee.fine_amount - StudentFee.paid_amount)
+
+def summarize_student_fees(school_id, session_id):
+    """Totals, status buckets and overdue figures for a school session in one query"""
+    today = date.today()
+    balance = fee_balance_expr()
+    is_open = StudentFee.status.in_(OPEN_FEE_STATUSES)
+    is_overdue = and_(is_open, StudentFee.due_date < today)
+    
+    def total(column, *conditions):
+        column = func.sum(column)
+        if conditions:
+            column = column.filter(and_(*conditions))
+        return func.coalesce(column, 0)
+    
+    def distinct_students(*conditions):
+        return func.count(func.distinct(StudentFee.student_id)).filter(and_(*conditions))
+    
+    row = db.session.execute(
+        db.select(
+            total(StudentFee.fee_amount).label('total_fees'),
+            total(StudentFee.paid_amount).label('total_paid'),
+            total(StudentFee.discount_amount).label('total_discount'),
+            total(StudentFee.fine_amount).label('total_fine'),
+            total(balance).label('total_due'),
+            total(balance, balance > 0).label('total_outstanding'),
+            total(balance, is_open).label('total_pending'),
+            total(balance, is_overdue).label('total_overdue'),
+            func.count(StudentFee.id).label('fee_records_count'),
+            func.count(StudentFee.id).filter(is_open).label('pending_count'),
+            func.count(StudentFee.id).filter(is_overdue).label('overdue_count'),
+            func.count(func.distinct(StudentFee.student_id)).label('student_count'),
+            distinct_students(StudentFee.status == 'paid').label('paid_students'),
+            distinct_students(StudentFee.status == 'partial').label('partial_students'),
+            distinct_students(StudentFee.status == 'pending').label('pending_students'),
+        )
+        .select_from(StudentFee)
+        .join(Student, Student.id == StudentFee.student_id)
+        .where(Student.school_id == school_id, StudentFee.session_id == session_id)
+    ).one()
+    
+    summary = row._asdict()
+    summary['total_net'] = summary['total_fees'] - summary['total_discount'] + summary['total_fine']
+    if summary['total_net'] > 0:
+        summary['collection_rate'] = (summary['total_paid'] / summary['total_net']) * 100
+    else:
+        summary['collection_rate'] = 0
+    return summary
+
+def get_class_fee_rollup(school_id, session_id):
+    """Per-class fee totals for active classes in one round trip.
+    
+    Fees are attributed to a class through the student's active enrollment
+    for the session. Each item carries the Class plus fee, paid, discount,
+    fine, net, due and collection rate, the enrolled student count and
+    the number of fee records.
+    """
+    enrollment_join = and_(
+        StudentEnrollment.class_id == Class.id,
+        StudentEnrollment.session_id == session_id,
+        StudentEnrollment.is_active == True
+    )
+    fee_join = and_(
+        StudentFee.student_id == StudentEnrollment.student_id,
+        StudentFee.session_id == session_id
+    )
+    rows = db.session.execute(
+        db.select(
+            Class,
+            func.coalesce(func.sum(StudentFee.fee_amount), 0).label('total_fees'),
+            func.coalesce(func.sum(StudentFee.paid_amount), 0).label('total_paid'),
+            func.coalesce(func.sum(StudentFee.discount_amount), 0).label('total_discount'),
+            func.coalesce(func.sum(StudentFee.fine_amount), 0).label('total_fine'),
+            func.count(func.distinct(StudentEnrollment.id)).label('student_count'),
+            func.count(StudentFee.id).label('fee_count'),
+        )
+        .outerjoin(StudentEnrollment, enrollment_join)
+        .outerjoin(StudentFee, fee_join)
+        .where(Class.school_id == school_id,
+               Class.session_id == session_id,
+               Class.is_active == True)
+        .group_by(Class.id)
+        .order_by(Class.id)
+    ).all()
+    
+    rollup = []
+    for row in rows:
+        total_net = row.total_fees - row.total_discount + row.total_fine
+        rollup.append({
+            'class': row.Class,
+            'total_fees': row.total_fees,
+            'total_paid': row.total_paid,
+            'total_discount': row.total_discount,
+            'total_fine': row.total_fine,
+            'total_net': total_net,
+            'total_due': max(0, total_net - row.total_paid),
+            'collection_rate': (row.total_paid / total_net * 100) if total_net > 0 else 0,
+            'student_count': row.student_count,
+            'fee_count': row.fee_count
+        })
+    return rollup
+
+def _collection_select(columns, school_id, start, end, payment_only=True):
+    """Select columns over successful transactions of a school between start and end (inclusive)"""
+    conditions = [
+        Student.school_id == school_id,
+        FeeTransaction.transaction_date >= start,
+        FeeTransaction.transaction_date <= end,
+        FeeTransaction.status == 'success'
+    ]
+    if payment_only:
+        conditions.append(FeeTransaction.transaction_type == 'payment')
+    
+    return (
+        db.select(*columns)
+        .select_from(FeeTransaction)
+        .join(Student, Student.id == FeeTransaction.student_id)
+        .where(*conditions)
+    )
+
+def collection_by_day(school_id, start, end, payment_only=True):
+    """Rows of (day, amount) for successful transactions"""
+    day = db.cast(FeeTransaction.transaction_date, db.Date).label('day')
+    query = _collection_select(
+        [day, func.sum(FeeTransaction.amount).label('amount')],
+        school_id, start, end, payment_only
+    )
+    return db.session.execute(query.group_by(day).order_by(day)).all()
+
+def collection_by_month(school_id, start, end, payment_only=True):
+    """Rows of (month, amount); month is the first instant of the month"""
+    month = func.date_trunc('month', FeeTransaction.transaction_date).label('month')
+    query = _collection_select(
+        [month, func.sum(FeeTransaction.amount).label('amount')],
+        school_id, start, end, payment_only
+    )
+    return db.session.execute(query.group_by(month).order_by(month)).all()
+
+def collection_by_payment_method(school_id, start, end, payment_only=True):
+    """Rows of (payment_method, amount); missing methods are reported as 'unknown'"""
+    method = func.coalesce(FeeTransaction.payment_method, 'unknown').label('payment_method')
+    query = _collection_select(
+        [method, func.sum(FeeTransaction.amount).label('amount')],
+        school_id, start, end, payment_only
+    )
+    return db.session.execute(query.group_by(method).order_by(method)).all()
+
+def collection_by_class(school_id, start, end, payment_only=True):
+    """Rows of (class_name, amount) using the class recorded on the student fee"""
+    class_name = func.coalesce(Class.name, 'Unknown').label('class_name')
+    query = _collection_select(
+        [class_name, func.sum(FeeTransaction.amount).label('amount')],
+        school_id, start, end, payment_only
+    )
+    query = (query
+             .outerjoin(StudentFee, StudentFee.id == FeeTransaction.student_fee_id)
+             .outerjoin(Class, Class.id == StudentFee.class_id))
+    return db.session.execute(query.group_by(class_name).order_by(class_name)).all()
+
 # ==================== DATA AGGREGATION FUNCTIONS ====================
 
 def get_daily_collection_data(school_id, session_id, days=7):
@@ -4446,20 +6490,11 @@ def get_daily_collection_data(school_id, session_id, days=7):
         }
         current_date += timedelta(days=1)
     
-    # Get actual transactions
-    transactions = FeeTransaction.query.join(Student).filter(
-        Student.school_id == school_id,
-        FeeTransaction.transaction_date >= start_date,
-        FeeTransaction.transaction_date <= end_date,
-        FeeTransaction.transaction_type == 'payment',
-        FeeTransaction.status == 'success'
-    ).all()
-    
-    # Aggregate by date
-    for transaction in transactions:
-        date_str = transaction.transaction_date.strftime('%Y-%m-%d')
+    # Fill in actual collections
+    for row in collection_by_day(school_id, start_date, end_date):
+        date_str = row.day.strftime('%Y-%m-%d')
         if date_str in daily_data:
-            daily_data[date_str]['amount'] += float(transaction.amount)
+            daily_data[date_str]['amount'] += float(row.amount)
     
     # Convert to list and sort by date
     result = list(daily_data.values())
@@ -4473,21 +6508,10 @@ def get_payment_method_distribution(school_id, session_id):
     if not session:
         return {'labels': [], 'data': [], 'colors': []}
     
-    distribution = {}
-    
-    transactions = FeeTransaction.query.join(Student).filter(
-        Student.school_id == school_id,
-        FeeTransaction.transaction_date >= session.start_date,
-        FeeTransaction.transaction_date <= session.end_date,
-        FeeTransaction.transaction_type == 'payment',
-        FeeTransaction.status == 'success'
-    ).all()
-    
-    for transaction in transactions:
-        method = transaction.payment_method or 'unknown'
-        if method not in distribution:
-            distribution[method] = 0
-        distribution[method] += float(transaction.amount)
+    distribution = {
+        row.payment_method: float(row.amount)
+        for row in collection_by_payment_method(school_id, session.start_date, session.end_date)
+    }
     
     # Format for chart
     chart_data = {
@@ -4524,20 +6548,11 @@ def get_monthly_collection_data(school_id, session_id):
         else:
             current_date = current_date.replace(month=current_date.month + 1)
     
-    # Get transactions for the session
-    transactions = FeeTransaction.query.join(Student).filter(
-        Student.school_id == school_id,
-        FeeTransaction.transaction_date >= session.start_date,
-        FeeTransaction.transaction_date <= session.end_date,
-        FeeTransaction.transaction_type == 'payment',
-        FeeTransaction.status == 'success'
-    ).all()
-    
-    # Aggregate by month
-    for transaction in transactions:
-        month_key = transaction.transaction_date.strftime('%Y-%m')
+    # Aggregate collections by month
+    for row in collection_by_month(school_id, session.start_date, session.end_date):
+        month_key = row.month.strftime('%Y-%m')
         if month_key in monthly_data:
-            monthly_data[month_key] += float(transaction.amount)
+            monthly_data[month_key] += float(row.amount)
     
     # Create sorted data list
     data = []
@@ -4557,51 +6572,8 @@ def get_monthly_collection_data(school_id, session_id):
 
 def get_class_collection_rates(school_id, session_id):
     """Get collection rates for all classes"""
-    classes = Class.query.filter_by(
-        school_id=school_id,
-        session_id=session_id,
-        is_active=True
-    ).all()
-    
-    class_data = []
-    
-    for class_obj in classes:
-        # Get students in this class
-        enrollments = StudentEnrollment.query.filter_by(
-            class_id=class_obj.id,
-            session_id=session_id,
-            is_active=True
-        ).all()
-        
-        student_ids = [e.student_id for e in enrollments]
-        
-        # Get fees for these students
-        if student_ids:
-            student_fees = StudentFee.query.filter(
-                StudentFee.student_id.in_(student_ids),
-                StudentFee.session_id == session_id
-            ).all()
-            
-            # Calculate totals
-            total_fees = sum([f.fee_amount for f in student_fees])
-            total_paid = sum([f.paid_amount for f in student_fees])
-            total_discount = sum([f.discount_amount for f in student_fees])
-            total_fine = sum([f.fine_amount for f in student_fees])
-            total_net = total_fees - total_discount + total_fine
-            
-            if total_net > 0:
-                collection_rate = (total_paid / total_net) * 100
-            else:
-                collection_rate = 0
-            
-            class_data.append({
-                'class': class_obj,
-                'total_fees': total_fees,
-                'total_paid': total_paid,
-                'total_net': total_net,
-                'collection_rate': collection_rate,
-                'student_count': len(enrollments)
-            })
+    class_data = [item for item in get_class_fee_rollup(school_id, session_id)
+                  if item['student_count'] > 0]
     
     # Sort by collection rate descending
     class_data.sort(key=lambda x: x['collection_rate'], reverse=True)
@@ -4612,17 +6584,20 @@ def get_class_collection_rates(school_id, session_id):
 @app.context_processor
 def inject_stats():
     """Inject stats into all templates"""
-    stats = {}
-    
-    if current_user.is_authenticated:
-        if current_user.is_school_admin or current_user.is_teacher:
-            context = get_school_context()
-            view_session = context.get('view_session') or context.get('current_session')
-            
-            if view_session and current_user.school_id:
-                stats = get_school_fee_statistics(current_user.school_id, view_session.id)
+    def load_stats():
+        if not current_user.is_authenticated:
+            return {}
+        if not (current_user.is_school_admin or current_user.is_teacher) or not current_user.school_id:
+            return {}
+        
+        school_id = current_user.school_id
+        view_session_id = get_cached_view_session_id(school_id)
+        if not view_session_id:
+            return {}
+        return cached_school_value(school_id, ('fee_stats', view_session_id),
+                                   lambda: get_school_fee_statistics(school_id, view_session_id))
     
-    return {'stats': stats}
+    return {'stats': lazy_context_value(load_stats)}
 
 
 def check_fee_assignment_status(school_id, session_id):
@@ -4816,42 +6791,32 @@ def fee_dashboard():
         flash('No active session found', 'warning')
         return redirect(url_for('admin_dashboard'))
     
-    # Get all student fees for the session
-    student_fees = StudentFee.query.join(Student).filter(
-        Student.school_id == current_user.school_id,
-        StudentFee.session_id == view_session.id
-    ).all()
-    
-    # Calculate comprehensive statistics
+    # Calculate comprehensive statistics in SQL
+    summary = summarize_student_fees(current_user.school_id, view_session.id)
     fee_stats = {
-        'total_fees': sum([f.fee_amount for f in student_fees]),
-        'total_paid': sum([f.paid_amount for f in student_fees]),
-        'total_discount': sum([f.discount_amount for f in student_fees]),
-        'total_fine': sum([f.fine_amount for f in student_fees]),
-        'total_due': sum([f.fee_amount - f.discount_amount + f.fine_amount - f.paid_amount 
-                         for f in student_fees if f.fee_amount - f.discount_amount + f.fine_amount - f.paid_amount > 0]),
-        'student_count': len(set([f.student_id for f in student_fees])),
-        'fee_records_count': len(student_fees),
-        'paid_students': len(set([f.student_id for f in student_fees if f.status == 'paid'])),
-        'partial_students': len(set([f.student_id for f in student_fees if f.status == 'partial'])),
-        'pending_students': len(set([f.student_id for f in student_fees if f.status == 'pending'])),
-        'overdue_count': len([f for f in student_fees if f.due_date < date.today() and f.status in ['pending', 'partial']])
+        'total_fees': summary['total_fees'],
+        'total_paid': summary['total_paid'],
+        'total_discount': summary['total_discount'],
+        'total_fine': summary['total_fine'],
+        'total_due': summary['total_outstanding'],
+        'student_count': summary['student_count'],
+        'fee_records_count': summary['fee_records_count'],
+        'paid_students': summary['paid_students'],
+        'partial_students': summary['partial_students'],
+        'pending_students': summary['pending_students'],
+        'overdue_count': summary['overdue_count'],
+        'collection_rate': summary['collection_rate']
     }
     
-    # Calculate collection rate
-    total_net = fee_stats['total_fees'] - fee_stats['total_discount'] + fee_stats['total_fine']
-    if total_net > 0:
-        fee_stats['collection_rate'] = (fee_stats['total_paid'] / total_net) * 100
-    else:
-        fee_stats['collection_rate'] = 0
-    
     # Get real chart data
     monthly_collection = get_monthly_collection_data(current_user.school_id, view_session.id)
     payment_methods = get_payment_method_distribution(current_user.school_id, view_session.id)
     class_collection = get_class_collection_rates(current_user.school_id, view_session.id)
     
     # Get recent transactions
-    recent_transactions = FeeTransaction.query.join(Student).filter(
+    recent_transactions = FeeTransaction.query.join(Student).options(
+        joinedload(FeeTransaction.student)
+    ).filter(
         Student.school_id == current_user.school_id,
         FeeTransaction.transaction_date >= date.today() - timedelta(days=30)
     ).order_by(FeeTransaction.transaction_date.desc()).limit(10).all()
@@ -4873,92 +6838,86 @@ def utility_processor():
     # ----- Helper functions (defined inside to capture app context) -----
     def get_overdue_fees_count(school_id):
         """Get count of overdue fees for a school"""
-        try:
-            from datetime import date
-            current_session = get_current_session(school_id)
-            if not current_session:
+        def load():
+            current_session_id = get_cached_current_session_id(school_id)
+            if not current_session_id:
                 return 0
-            count = db.session.query(StudentFee).join(Student).filter(
+            return db.session.query(func.count(StudentFee.id)).join(Student).filter(
                 Student.school_id == school_id,
-                StudentFee.session_id == current_session.id,
+                StudentFee.session_id == current_session_id,
                 StudentFee.due_date < date.today(),
                 StudentFee.status.in_(['pending', 'partial'])
-            ).count()
-            return count
+            ).scalar()
+        
+        try:
+            return cached_school_value(school_id, 'overdue_fees_count', load)
         except Exception as e:
             app.logger.error(f"Error in get_overdue_fees_count: {e}")
             return 0
 
     def get_overdue_fees(school_id, limit=5):
         """Get overdue fees for a school"""
-        try:
-            from datetime import date
-            current_session = get_current_session(school_id)
-            if not current_session:
+        def load():
+            current_session_id = get_cached_current_session_id(school_id)
+            if not current_session_id:
                 return []
-            overdue_fees = StudentFee.query.join(Student).filter(
+            return StudentFee.query.join(Student).filter(
                 Student.school_id == school_id,
-                StudentFee.session_id == current_session.id,
+                StudentFee.session_id == current_session_id,
                 StudentFee.due_date < date.today(),
                 StudentFee.status.in_(['pending', 'partial'])
             ).order_by(StudentFee.due_date).limit(limit).all()
-            return overdue_fees
+        
+        try:
+            # ORM rows: memoize for this request only
+            return request_memo(('overdue_fees', school_id, limit), load)
         except Exception as e:
             app.logger.error(f"Error in get_overdue_fees: {e}")
             return []
 
     def get_student_overdue_fees(student_id):
         """Get overdue fee count for a specific student"""
-        try:
-            from datetime import date
+        def load():
             student = Student.query.get(student_id)
             if not student:
                 return 0
-            current_session = get_current_session(student.school_id)
-            if not current_session:
+            current_session_id = get_cached_current_session_id(student.school_id)
+            if not current_session_id:
                 return 0
-            count = StudentFee.query.filter_by(
+            return StudentFee.query.filter_by(
                 student_id=student_id,
-                session_id=current_session.id
+                session_id=current_session_id
             ).filter(
                 StudentFee.due_date < date.today(),
                 StudentFee.status.in_(['pending', 'partial'])
             ).count()
-            return count
+        
+        try:
+            return request_memo(('student_overdue_fees', student_id), load)
         except Exception as e:
             app.logger.error(f"Error in get_student_overdue_fees: {e}")
             return 0
 
     def get_monthly_collection(school_id, session_id):
         """Get monthly collection data for charts"""
-        try:
-            from datetime import datetime
+        def load():
             import calendar
-            session = AcademicSession.query.get(session_id)
-            if not session:
+            academic_session = AcademicSession.query.get(session_id)
+            if not academic_session:
                 return []
-            year = session.start_date.year
-            monthly_data = []
-            for month in range(1, 13):
-                month_start = datetime(year, month, 1)
-                if month == 12:
-                    month_end = datetime(year + 1, 1, 1)
-                else:
-                    month_end = datetime(year, month + 1, 1)
-                total = db.session.query(db.func.coalesce(db.func.sum(FeeTransaction.amount), 0)).join(
-                    Student
-                ).filter(
-                    Student.school_id == school_id,
-                    FeeTransaction.transaction_date >= month_start,
-                    FeeTransaction.transaction_date < month_end,
-                    FeeTransaction.transaction_type == 'payment',
-                    FeeTransaction.status == 'success'
-                ).scalar()
-                monthly_data.append({
-                    'month': calendar.month_abbr[month],
-                    'amount': float(total or 0)
-                })
-            return monthly_data
+            year = academic_session.start_date.year
+            totals = {
+                row.month.month: float(row.amount)
+                for row in collection_by_month(school_id, datetime(year, 1, 1),
+                                               datetime(year + 1, 1, 1) - timedelta(microseconds=1))
+            }
+            return [
+                {'month': calendar.month_abbr[month], 'amount': totals.get(month, 0.0)}
+                for month in range(1, 13)
+            ]
+        
+        try:
+            return cached_school_value(school_id, ('monthly_collection', session_id), load)
         except Exception as e:
             app.logger.error(f"Error in get_monthly_collection: {e}")
             return [{'month': m, 'amount': 0} for m in ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 
@@ -4967,12 +6926,7 @@ def utility_processor():
     def get_today_attendance_helper(class_id):
         """Helper function to check if attendance is taken for a class today"""
         try:
-            from datetime import date
-            attendance = Attendance.query.filter_by(
-                class_id=class_id,
-                date=date.today()
-            ).first()
-            return attendance is not None
+            return request_memo(('today_attendance', class_id), lambda: get_today_attendance(class_id))
         except Exception as e:
             app.logger.error(f"Error in get_today_attendance_helper: {e}")
             return False
@@ -4981,38 +6935,51 @@ def utility_processor():
     def inject_global_vars():
         data = {}
         if current_user.is_authenticated:
+            school_id = current_user.school_id
             # Admin sidebar needs total_students, total_teachers, fee_structures_count
-            if current_user.role == 'admin' and current_user.school_id:
-                school_id = current_user.school_id
-                data['total_students'] = Student.query.filter_by(school_id=school_id, is_active=True).count()
-                data['total_teachers'] = User.query.filter_by(school_id=school_id, role='teacher', is_active=True).count()
-                current_session = get_current_session(school_id)
-                if current_session:
-                    data['fee_structures_count'] = FeeStructure.query.filter_by(
-                        school_id=school_id, session_id=current_session.id, is_active=True
+            if current_user.role == 'admin' and school_id:
+                def load_fee_structures_count():
+                    current_session_id = get_cached_current_session_id(school_id)
+                    if not current_session_id:
+                        return 0
+                    return FeeStructure.query.filter_by(
+                        school_id=school_id, session_id=current_session_id, is_active=True
                     ).count()
-                else:
-                    data['fee_structures_count'] = 0
+                
+                data['total_students'] = lazy_context_value(lambda: cached_school_value(
+                    school_id, 'total_students',
+                    lambda: Student.query.filter_by(school_id=school_id, is_active=True).count()
+                ))
+                data['total_teachers'] = lazy_context_value(lambda: cached_school_value(
+                    school_id, 'total_teachers',
+                    lambda: User.query.filter_by(school_id=school_id, role='teacher', is_active=True).count()
+                ))
+                data['fee_structures_count'] = lazy_context_value(lambda: cached_school_value(
+                    school_id, 'fee_structures_count', load_fee_structures_count
+                ))
             # Teacher sidebar needs assigned_classes
-            elif current_user.role == 'teacher' and current_user.school_id:
-                current_session = get_current_session(current_user.school_id)
-                if current_session:
-                    assignments = TeacherAssignment.query.filter_by(
-                        teacher_id=current_user.id,
-                        session_id=current_session.id
+            elif current_user.role == 'teacher' and school_id:
+                teacher_id = current_user.id
+                
+                def load_assigned_classes():
+                    current_session_id = get_cached_current_session_id(school_id)
+                    if not current_session_id:
+                        return []
+                    rows = db.session.query(TeacherAssignment, Class).join(
+                        Class, Class.id == TeacherAssignment.class_id
+                    ).filter(
+                        TeacherAssignment.teacher_id == teacher_id,
+                        TeacherAssignment.session_id == current_session_id
                     ).all()
-                    assigned_classes = []
-                    for assign in assignments:
-                        class_obj = Class.query.get(assign.class_id)
-                        if class_obj:
-                            assigned_classes.append({
-                                'class': class_obj,
-                                'assignment': assign,
-                                'subject': assign.subject
-                            })
-                    data['assigned_classes'] = assigned_classes
-                else:
-                    data['assigned_classes'] = []
+                    return [
+                        {'class': class_obj, 'assignment': assign, 'subject': assign.subject}
+                        for assign, class_obj in rows
+                    ]
+                
+                # ORM rows: memoize for this request only
+                data['assigned_classes'] = lazy_context_value(
+                    lambda: request_memo(('assigned_classes', teacher_id), load_assigned_classes)
+                )
         return data
 
     # Merge helper functions and global variables
@@ -5359,6 +7326,14 @@ class StudentEnrollment(db.Model):
     student = db.relationship('Student', back_populates='enrollments')
     class_ = db.relationship('Class', back_populates='student_enrollments')
     session = db.relationship('AcademicSession', back_populates='student_enrollments')
+    
+    __table_args__ = (
+        db.Index('ix_student_enrollments_class_session_active', 'class_id', 'session_id', 'is_active'),
+        db.Index('ix_student_enrollments_student_session', 'student_id', 'session_id'),
+        # At most one active enrollment per student and session
+        db.Index('uq_student_enrollments_active_student_session', 'student_id', 'session_id',
+                 unique=True, postgresql_where=db.text('is_active')),
+    )
 
 class TeacherAssignment(db.Model):
     __tablename__ = 'teacher_assignments'
@@ -5565,24 +7540,54 @@ def student_pay_fee():
 @login_required
 @role_required(['student'])
 def student_fee_statement_pdf():
-    student = Student.query.get(current_user.student_id)
-    fees = StudentFee.query.filter_by(student_id=student.id, session_id=current_session.id).all()
-    html = render_template('pdf_fee_statement.html', student=student, fees=fees)
-    pdf = weasyprint.HTML(string=html).write_pdf()
-    response = make_response(pdf)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'inline; filename=fee_statement_{student.student_id}.pdf'
-    return response
+    student = Student.query.get_or_404(current_user.student_id)
+    current_session = get_current_session(student.school_id)
+    if not current_session:
+        flash('No active session found', 'warning')
+        return redirect(url_for('student_fees'))
+    fees = StudentFee.query.filter_by(
+        student_id=student.id,
+        session_id=current_session.id
+    ).options(joinedload(StudentFee.fee_structure)).order_by(StudentFee.due_date).all()
+    html = render_template('pdf_fee_statement.html',
+                           student=student,
+                           school=student.school,
+                           current_session=current_session,
+                           fees=fees)
+    return pdf_response(html, f'fee_statement_{student.student_id}.pdf')
 
 @app.route('/student/attendance/report/pdf')
 @login_required
 @role_required(['student'])
 def student_attendance_pdf():
-    student = Student.query.get(current_user.student_id)
-    records = Attendance.query.filter_by(student_id=student.id).order_by(Attendance.date.desc()).all()
-    html = render_template('pdf_attendance_report.html', student=student, records=records)
-    pdf = weasyprint.HTML(string=html).write_pdf()
-    return pdf_response
+    student = Student.query.get_or_404(current_user.student_id)
+    current_session = get_current_session(student.school_id)
+    if not current_session:
+        flash('No active session found', 'warning')
+        return redirect(url_for('student_attendance'))
+
+    # Date range from request (default to the current session so far)
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        start_date = current_session.start_date
+    try:
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        end_date = min(date.today(), current_session.end_date)
+
+    records = Attendance.query.filter(
+        Attendance.student_id == student.id,
+        Attendance.date >= start_date,
+        Attendance.date <= end_date
+    ).order_by(Attendance.date.desc()).all()
+    html = render_template('pdf_attendance_report.html',
+                           student=student,
+                           school=student.school,
+                           records=records,
+                           start_date=start_date,
+                           end_date=end_date)
+    return pdf_response(html, f'attendance_{student.student_id}_{start_date}_{end_date}.pdf')
 
 @app.route('/student/attendance/calendar-data')
 @login_required
@@ -6142,6 +8147,305 @@ def view_student_details(student_id):
 
 
 
+# ==================== REQUEST PROFILING ====================
+# With PROFILING_ENABLED, every request records its wall time, time spent in
+# SQL, statement count and repeated statements (the usual sign of an N+1
+# loop). Results go out as a Server-Timing header, into a sampled JSON log
+# and into a per-process ring buffer summarised on /developer/perf.
+
+PROFILE_SLOWEST_STATEMENTS = 5
+PROFILE_STATEMENT_CHARS = 300
+
+perf_logger = logging.getLogger('school_erp.perf')
+_profile_buffer = deque(maxlen=app.config['PROFILING_BUFFER_SIZE'])
+_profile_buffer_lock = threading.Lock()
+
+ProfiledRequest = namedtuple('ProfiledRequest', 'at endpoint method status total_ms db_ms statements duplicates slowest')
+
+class RequestProfile:
+    """SQL activity of one request"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.seen = defaultdict(int)   # statement text -> executions
+        self.slowest = []              # (seconds, statement), longest first
+    
+    def record(self, statement, seconds):
+        self.db_seconds += seconds
+        self.statements += 1
+        self.seen[statement] += 1
+        if len(self.slowest) < PROFILE_SLOWEST_STATEMENTS or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[PROFILE_SLOWEST_STATEMENTS:]
+    
+    def duplicates(self):
+        """(executions, statement) for statements run more than once, most repeated first"""
+        return sorted(((count, statement) for statement, count in self.seen.items() if count > 1), reverse=True)
+
+def current_profile():
+    return g.get('request_profile') if has_request_context() else None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_profile():
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    started = conn.info.get('profile_started')
+    if profile and started:
+        profile.record(statement, time.perf_counter() - started.pop())
+
+@app.before_request
+def start_request_profile():
+    if app.config['PROFILING_ENABLED']:
+        g.request_profile = RequestProfile()
+
+@app.after_request
+def finish_request_profile(response):
+    profile = current_profile()
+    if not profile:
+        return response
+    
+    total_ms = (time.perf_counter() - profile.started) * 1000
+    db_ms = profile.db_seconds * 1000
+    duplicates = profile.duplicates()
+    repeated = sum(count - 1 for count, statement in duplicates)
+    response.headers.add('Server-Timing', f'db;dur={db_ms:.1f};desc="{profile.statements} queries"')
+    response.headers.add('Server-Timing', f'app;dur={total_ms - db_ms:.1f}')
+    response.headers.add('Server-Timing', f'total;dur={total_ms:.1f}')
+    
+    slowest = [(round(seconds * 1000, 2), statement[:PROFILE_STATEMENT_CHARS]) for seconds, statement in profile.slowest]
+    with _profile_buffer_lock:
+        _profile_buffer.append(ProfiledRequest(
+            datetime.utcnow(), request.endpoint or 'unmatched', request.method, response.status_code,
+            total_ms, db_ms, profile.statements, repeated, slowest[0] if slowest else None
+        ))
+    
+    if total_ms >= app.config['PROFILING_SLOW_MS'] or random.random() < app.config['PROFILING_SAMPLE_RATE']:
+        perf_logger.info(json.dumps({
+            'at': datetime.utcnow().isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'user_id': current_user.get_id() if current_user else None,
+            'total_ms': round(total_ms, 2),
+            'db_ms': round(db_ms, 2),
+            'statements': profile.statements,
+            'repeated_statements': repeated,
+            'most_repeated': [{'count': count, 'sql': statement[:PROFILE_STATEMENT_CHARS]}
+                              for count, statement in duplicates[:3]],
+            'slowest': [{'ms': ms, 'sql': sql} for ms, sql in slowest]
+        }))
+    return response
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))]
+
+def profile_summary():
+    """Per-endpoint latency percentiles and SQL load from this process's ring buffer"""
+    with _profile_buffer_lock:
+        samples = list(_profile_buffer)
+    
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample.endpoint].append(sample)
+    
+    endpoints = []
+    for endpoint, rows in by_endpoint.items():
+        totals = sorted(row.total_ms for row in rows)
+        endpoints.append({
+            'endpoint': endpoint,
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if row.status >= 500),
+            'p50': percentile(totals, 50),
+            'p95': percentile(totals, 95),
+            'p99': percentile(totals, 99),
+            'db_ms': sum(row.db_ms for row in rows) / len(rows),
+            'statements': sum(row.statements for row in rows) / len(rows),
+            'max_repeated': max(row.duplicates for row in rows)
+        })
+    endpoints.sort(key=lambda row: row['p95'] * row['requests'], reverse=True)
+    
+    return {
+        'requests': len(samples),
+        'since': samples[0].at if samples else None,
+        'endpoints': endpoints,
+        'slowest': sorted(samples, key=lambda sample: sample.total_ms, reverse=True)[:20]
+    }
+
+@app.route('/developer/perf')
+@role_required(['developer'])
+def developer_perf():
+    """Request latency and SQL load per endpoint, from the profiling ring buffer"""
+    if current_user.must_change_password:
+        return redirect(url_for('change_password'))
+    
+    summary = profile_summary()
+    if request.args.get('format') == 'json':
+        summary['slowest'] = [sample._asdict() for sample in summary['slowest']]
+        return jsonify(summary)
+    
+    return render_template('developer_perf.html',
+                         summary=summary,
+                         enabled=app.config['PROFILING_ENABLED'],
+                         buffer_size=app.config['PROFILING_BUFFER_SIZE'],
+                         worker_pid=os.getpid())
+
+# ==================== METRICS ====================
+# Prometheus metrics, always on. Every gunicorn worker and the run-worker
+# process write their samples to PROMETHEUS_MULTIPROC_DIR (set in
+# gunicorn.conf.py and the Procfile) and /metrics adds them up; elsewhere
+# they live in this process. Queue depths are counted from the database at
+# scrape time.
+
+# The job worker may start before gunicorn has created the directory
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+REQUEST_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_SECONDS = Histogram('school_erp_http_request_duration_seconds', 'Request latency by endpoint and role',
+                            ['endpoint', 'role'], buckets=REQUEST_LATENCY_BUCKETS)
+REQUESTS = Counter('school_erp_http_requests_total', 'Requests by endpoint, method and status',
+                   ['endpoint', 'method', 'status'])
+DB_QUERIES = Counter('school_erp_db_queries_total', 'SQL statements executed, by endpoint', ['endpoint'])
+DB_POOL_CONNECTIONS = Gauge('school_erp_db_pool_connections', 'Open pooled database connections',
+                            multiprocess_mode='livesum')
+DB_POOL_CHECKED_OUT = Gauge('school_erp_db_pool_checked_out', 'Pooled database connections in use',
+                            multiprocess_mode='livesum')
+SMTP_SEND_SECONDS = Histogram('school_erp_smtp_send_duration_seconds', 'Time to hand one email to the SMTP server',
+                              buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+SMTP_SEND_FAILURES = Counter('school_erp_smtp_send_failures_total', 'Emails the SMTP server did not accept')
+PROCESS_STARTED = Gauge('school_erp_process_start_time_seconds', 'Start time of the oldest process, as a Unix time',
+                        multiprocess_mode='min')
+PROCESS_STARTED.set(time.time())
+
+def metrics_endpoint():
+    if not has_request_context():
+        return 'background'
+    return request.endpoint or 'unmatched'
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERIES.labels(metrics_endpoint()).inc()
+
+@event.listens_for(Pool, 'connect')
+def count_pool_connect(dbapi_connection, connection_record):
+    DB_POOL_CONNECTIONS.inc()
+
+@event.listens_for(Pool, 'close')
+def count_pool_close(dbapi_connection, connection_record):
+    DB_POOL_CONNECTIONS.dec()
+
+@event.listens_for(Pool, 'checkout')
+def count_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+@event.listens_for(Pool, 'checkin')
+def count_pool_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+@app.before_request
+def start_request_timer():
+    g.metrics_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('metrics_started')
+    if started is None:
+        return response
+    # Only a user Flask-Login already loaded; asking current_user here would
+    # add a query to every static file
+    role = getattr(g.get('_login_user'), 'role', None) or 'anonymous'
+    endpoint = metrics_endpoint()
+    REQUEST_SECONDS.labels(endpoint, role).observe(time.perf_counter() - started)
+    REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    return response
+
+class QueueDepthCollector:
+    """Background jobs and outbound emails by status, counted when scraped"""
+
+    def collect(self):
+        jobs = GaugeMetricFamily('school_erp_background_jobs', 'Background jobs by status', labels=['status'])
+        emails = GaugeMetricFamily('school_erp_outbound_emails', 'Outbound emails by status', labels=['status'])
+        for family, model in ((jobs, BackgroundJob), (emails, OutboundEmail)):
+            counts = dict(db.session.query(model.status, func.count(model.id))
+                          .filter(model.status.in_(['queued', 'running', 'sending']))
+                          .group_by(model.status).all())
+            for status in (['queued', 'running'] if model is BackgroundJob else ['queued', 'sending']):
+                family.add_metric([status], counts.get(status, 0))
+            yield family
+
+_queue_registry = CollectorRegistry(auto_describe=False)
+_queue_registry.register(QueueDepthCollector())
+
+def metrics_registry():
+    """Request, SQL and SMTP metrics of every worker when multiprocess, else of this process"""
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def request_metrics_summary():
+    """Uptime, mean and p95 latency and 5xx rate across all requests so far"""
+    count = total_seconds = errors = 0
+    buckets = defaultdict(float)
+    started = None
+    for family in metrics_registry().collect():
+        for sample in family.samples:
+            if sample.name == 'school_erp_http_request_duration_seconds_count':
+                count += sample.value
+            elif sample.name == 'school_erp_http_request_duration_seconds_sum':
+                total_seconds += sample.value
+            elif sample.name == 'school_erp_http_request_duration_seconds_bucket':
+                buckets[float(sample.labels['le'])] += sample.value
+            elif sample.name == 'school_erp_http_requests_total' and sample.labels['status'].startswith('5'):
+                errors += sample.value
+            elif sample.name == 'school_erp_process_start_time_seconds':
+                started = sample.value if started is None else min(started, sample.value)
+
+    # Buckets are cumulative: p95 is the first upper bound holding 95% of requests
+    p95 = next((bound for bound in sorted(buckets) if buckets[bound] >= 0.95 * count), None) if count else None
+    return {
+        'requests': int(count),
+        'uptime': timedelta(seconds=int(time.time() - started)) if started else None,
+        'response_ms': total_seconds / count * 1000 if count else None,
+        'p95_ms': p95 * 1000 if p95 is not None and p95 != float('inf') else None,
+        'error_rate': errors / count * 100 if count else None
+    }
+
+def format_uptime(uptime):
+    if uptime is None:
+        return None
+    hours, seconds = divmod(uptime.seconds, 3600)
+    if uptime.days:
+        return f"{uptime.days}d {hours}h"
+    if hours:
+        return f"{hours}h {seconds // 60}m"
+    return f"{seconds // 60}m"
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition; scrapers send METRICS_TOKEN as a bearer token"""
+    token = app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    authorized = bool(token) and secrets.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+    if not authorized and not (current_user.is_authenticated and current_user.role == 'developer'):
+        return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'}, mimetype='text/plain')
+
+    body = generate_latest(metrics_registry()) + generate_latest(_queue_registry)
+    return Response(body, content_type=CONTENT_TYPE_LATEST)
+
 # ==================== DEVELOPER ROUTES ====================
 
 @app.route('/developer/dashboard')
@@ -6342,16 +8646,15 @@ def developer_dashboard():
         db.extract('year', Class.created_at) == current_year
     ).count()
     
-    # Performance metrics
+    # Performance metrics, from the same counters /metrics exports
+    request_metrics = request_metrics_summary()
     performance_metrics = {
-        'uptime': 99.8,
-        'uptime_trend': 0.1,
-        'response_time': 120,
-        'response_trend': -5,
+        'uptime': format_uptime(request_metrics['uptime']),
+        'requests': request_metrics['requests'],
+        'response_time': request_metrics['response_ms'],
+        'response_p95': request_metrics['p95_ms'],
         'active_users': active_sessions_count,
-        'user_growth': 12,
-        'error_rate': 0.2,
-        'error_trend': -0.1
+        'error_rate': request_metrics['error_rate']
     }
     
     stats = {
@@ -6722,56 +9025,9 @@ def admin_dashboard():
         is_active=True
     ).count()
     
-    # Get class-wise distribution (unchanged)
-    classes = Class.query.filter_by(
-        school_id=school_id,
-        session_id=view_session.id,
-        is_active=True
-    ).all()
-    
-    class_distribution = []
-    for class_obj in classes:
-        enrollments = StudentEnrollment.query.filter_by(
-            class_id=class_obj.id,
-            session_id=view_session.id,
-            is_active=True
-        ).all()
-        
-        student_ids = [e.student_id for e in enrollments]
-        
-        class_total_fees = 0
-        class_total_paid = 0
-        class_total_discount = 0
-        class_total_fine = 0
-        class_total_net = 0
-        class_total_due = 0
-        class_collection_rate = 0
-
-        if student_ids:
-            class_fees = StudentFee.query.filter(
-                StudentFee.student_id.in_(student_ids),
-                StudentFee.session_id == view_session.id
-            ).all()
-            
-            if class_fees:
-                class_total_fees = sum(f.fee_amount for f in class_fees)
-                class_total_paid = sum(f.paid_amount for f in class_fees)
-                class_total_discount = sum(f.discount_amount for f in class_fees)
-                class_total_fine = sum(f.fine_amount for f in class_fees)
-                class_total_net = class_total_fees - class_total_discount + class_total_fine
-                class_total_due = max(0, class_total_net - class_total_paid)
-                class_collection_rate = (class_total_paid / class_total_net * 100) if class_total_net > 0 else 0
-
-        class_distribution.append({
-            'class': class_obj,
-            'total_fees': class_total_fees,
-            'total_paid': class_total_paid,
-            'total_discount': class_total_discount,
-            'total_fine': class_total_fine,
-            'total_due': class_total_due,
-            'student_count': len(enrollments),
-            'collection_rate': class_collection_rate
-        })
+    # Get class-wise distribution
+    class_distribution = get_class_fee_rollup(school_id, view_session.id)
+    classes = [item['class'] for item in class_distribution]
     
     # Get recent fee transactions
     recent_transactions = FeeTransaction.query.join(Student).filter(
@@ -6918,82 +9174,34 @@ def manage_fees():
         is_active=True
     ).all()
     
-    # Get all student fees for the session
-    student_fees = StudentFee.query.join(Student).filter(
-        Student.school_id == current_user.school_id,
-        StudentFee.session_id == view_session.id
-    ).all()
-    
-    # Calculate statistics
-    total_fees = sum([f.fee_amount for f in student_fees])
-    total_collected = sum([f.paid_amount for f in student_fees])
-    total_discount = sum([f.discount_amount for f in student_fees])
-    total_fine = sum([f.fine_amount for f in student_fees])
-    total_pending = sum([(f.fee_amount - f.discount_amount + f.fine_amount - f.paid_amount) 
-                        for f in student_fees if f.status in ['pending', 'partial']])
-    
-    # Calculate overdue fees
-    overdue_fees = [f for f in student_fees if f.due_date < date.today() and f.status in ['pending', 'partial']]
-    total_overdue = sum([(f.fee_amount - f.discount_amount + f.fine_amount - f.paid_amount) 
-                        for f in overdue_fees])
-    
-    # Calculate collection rate
-    collection_rate = (total_collected / (total_fees - total_discount + total_fine) * 100) if (total_fees - total_discount + total_fine) > 0 else 0
+    # Calculate statistics in SQL
+    summary = summarize_student_fees(current_user.school_id, view_session.id)
     
     # Get class-wise fee summary
-    classes = Class.query.filter_by(
-        school_id=current_user.school_id,
-        session_id=view_session.id,
-        is_active=True
-    ).all()
-    
     class_fee_summary = []
-    for class_obj in classes:
-        # Get students in this class
-        enrollments = StudentEnrollment.query.filter_by(
-            class_id=class_obj.id,
-            session_id=view_session.id,
-            is_active=True
-        ).all()
-        
-        student_ids = [e.student_id for e in enrollments]
-        
-        # Get fees for these students
-        class_student_fees = StudentFee.query.filter(
-            StudentFee.student_id.in_(student_ids),
-            StudentFee.session_id == view_session.id
-        ).all()
-        
-        if class_student_fees:
-            class_total_fees = sum([f.fee_amount for f in class_student_fees])
-            class_total_collected = sum([f.paid_amount for f in class_student_fees])
-            class_total_discount = sum([f.discount_amount for f in class_student_fees])
-            class_total_fine = sum([f.fine_amount for f in class_student_fees])
-            class_total_due = class_total_fees - class_total_collected - class_total_discount + class_total_fine
-            
-            class_collection_rate = (class_total_collected / (class_total_fees - class_total_discount + class_total_fine) * 100) if (class_total_fees - class_total_discount + class_total_fine) > 0 else 0
-            
+    for item in get_class_fee_rollup(current_user.school_id, view_session.id):
+        if item['fee_count']:
             class_fee_summary.append({
-                'id': class_obj.id,
-                'name': class_obj.name,
-                'code': class_obj.code,
-                'total_students': len(enrollments),
-                'total_fees': class_total_fees,
-                'total_collected': class_total_collected,
-                'total_due': class_total_due,
-                'collection_rate': class_collection_rate
+                'id': item['class'].id,
+                'name': item['class'].name,
+                'code': item['class'].code,
+                'total_students': item['student_count'],
+                'total_fees': item['total_fees'],
+                'total_collected': item['total_paid'],
+                'total_due': item['total_net'] - item['total_paid'],
+                'collection_rate': item['collection_rate']
             })
     
     return render_template('admin_fee_management.html',
                          context=context,
                          fee_structures=fee_structures,
-                         total_fees=total_fees,
-                         total_collected=total_collected,
-                         total_pending=total_pending,
-                         total_overdue=total_overdue,
-                         pending_count=len([f for f in student_fees if f.status in ['pending', 'partial']]),
-                         overdue_count=len(overdue_fees),
-                         collection_rate=collection_rate,
+                         total_fees=summary['total_fees'],
+                         total_collected=summary['total_paid'],
+                         total_pending=summary['total_pending'],
+                         total_overdue=summary['total_overdue'],
+                         pending_count=summary['pending_count'],
+                         overdue_count=summary['overdue_count'],
+                         collection_rate=summary['collection_rate'],
                          class_fee_summary=class_fee_summary)
 
 @app.route('/admin/fees/assign/bulk', methods=['GET', 'POST'])
@@ -7028,83 +9236,17 @@ def assign_fee_to_students_bulk():
                 session_id=view_session.id
             ).first_or_404()
             
-            # Parse date
-            due_date_obj = datetime.strptime(due_date, '%Y-%m-%d').date()
-            
-            assigned_count = 0
-            
-            if 'all' in class_ids:
-                # Assign to all active students
-                students = Student.query.filter_by(
-                    school_id=current_user.school_id,
-                    is_active=True
-                ).all()
-                
-                for student in students:
-                    # Check if fee already assigned
-                    existing_fee = StudentFee.query.filter_by(
-                        student_id=student.id,
-                        fee_structure_id=fee_structure.id,
-                        session_id=view_session.id
-                    ).first()
-                    
-                    if not existing_fee:
-                        student_fee = StudentFee(
-                            student_id=student.id,
-                            fee_structure_id=fee_structure.id,
-                            session_id=view_session.id,
-                            fee_amount=fee_structure.amount,
-                            discount_amount=0,
-                            fine_amount=0,
-                            paid_amount=0,
-                            due_date=due_date_obj,
-                            status='pending'
-                        )
-                        db.session.add(student_fee)
-                        assigned_count += 1
-            
-            else:
-                # Assign to specific classes
-                for class_id in class_ids:
-                    if class_id == 'all':
-                        continue
-                    
-                    # Get all students in this class
-                    enrollments = StudentEnrollment.query.filter_by(
-                        class_id=class_id,
-                        session_id=view_session.id,
-                        is_active=True
-                    ).all()
-                    
-                    for enrollment in enrollments:
-                        student = enrollment.student
-                        
-                        # Check if fee already assigned
-                        existing_fee = StudentFee.query.filter_by(
-                            student_id=student.id,
-                            fee_structure_id=fee_structure.id,
-                            session_id=view_session.id
-                        ).first()
-                        
-                        if not existing_fee:
-                            student_fee = StudentFee(
-                                student_id=student.id,
-                                fee_structure_id=fee_structure.id,
-                                session_id=view_session.id,
-                                fee_amount=fee_structure.amount,
-                                discount_amount=0,
-                                fine_amount=0,
-                                paid_amount=0,
-                                due_date=due_date_obj,
-                                status='pending'
-                            )
-                            db.session.add(student_fee)
-                            assigned_count += 1
-            
-            db.session.commit()
+            # Validate date
+            datetime.strptime(due_date, '%Y-%m-%d')
             
-            flash(f'Fee assigned to {assigned_count} students successfully!', 'success')
-            return redirect(url_for('manage_fees'))
+            job = enqueue_job('assign_fee_structure', {
+                'fee_structure_id': fee_structure.id,
+                'due_date': due_date,
+                # "All Classes" means every active student, whatever the structure's class
+                'class_ids': None if 'all' in class_ids else [int(class_id) for class_id in class_ids],
+                'all_students': 'all' in class_ids
+            })
+            return job_status_redirect(job, next_url=url_for('manage_fees'))
             
         except Exception as e:
             db.session.rollback()
@@ -7233,63 +9375,36 @@ def fee_analytics():
         start_date = date.today().replace(day=1)
         end_date = date.today()
     
-    # Get all student fees
-    student_fees = StudentFee.query.join(Student).filter(
-        Student.school_id == current_user.school_id,
-        StudentFee.session_id == view_session.id
-    ).all()
-    
-    # Calculate statistics
-    total_fees = sum(f.fee_amount for f in student_fees)
-    total_paid = sum(f.paid_amount for f in student_fees)
-    total_discount = sum(f.discount_amount for f in student_fees)
-    total_fine = sum(f.fine_amount for f in student_fees)
-    total_due = total_fees - total_paid - total_discount + total_fine
-    
-    # Get transactions for date range
-    transactions = FeeTransaction.query.join(Student).filter(
-        Student.school_id == current_user.school_id,
-        FeeTransaction.transaction_date >= start_date,
-        FeeTransaction.transaction_date <= end_date,
-        FeeTransaction.status == 'success'
-    ).order_by(FeeTransaction.transaction_date).all()
+    # Calculate statistics in SQL
+    summary = summarize_student_fees(current_user.school_id, view_session.id)
     
-    # Prepare data for charts
-    # Daily collection data
-    daily_data = {}
-    for txn in transactions:
-        date_str = txn.transaction_date.strftime('%Y-%m-%d')
-        daily_data[date_str] = daily_data.get(date_str, 0) + txn.amount
-    
-    # Payment method distribution
-    method_data = {}
-    for txn in transactions:
-        method = txn.payment_method or 'unknown'
-        method_data[method] = method_data.get(method, 0) + txn.amount
-    
-    # Class-wise collection
-    class_data = {}
-    for txn in transactions:
-        # Safely get class name
-        if txn.student_fee and txn.student_fee.class_:
-            class_name = txn.student_fee.class_.name
-        else:
-            class_name = 'Unknown'
-        class_data[class_name] = class_data.get(class_name, 0) + txn.amount
+    # Prepare data for charts (all successful transactions in range, not only payments)
+    school_id = current_user.school_id
+    daily_data = {
+        row.day.strftime('%Y-%m-%d'): row.amount
+        for row in collection_by_day(school_id, start_date, end_date, payment_only=False)
+    }
+    method_data = {
+        row.payment_method: row.amount
+        for row in collection_by_payment_method(school_id, start_date, end_date, payment_only=False)
+    }
+    class_data = {
+        row.class_name: row.amount
+        for row in collection_by_class(school_id, start_date, end_date, payment_only=False)
+    }
     
     return render_template('admin_fee_analytics.html',
                          context=context,
                          start_date=start_date,
                          end_date=end_date,
-                         total_fees=total_fees,
-                         total_paid=total_paid,
-                         total_due=total_due,
-                         total_discount=total_discount,
-                         total_fine=total_fine,
+                         total_fees=summary['total_fees'],
+                         total_paid=summary['total_paid'],
+                         total_due=summary['total_due'],
+                         total_discount=summary['total_discount'],
+                         total_fine=summary['total_fine'],
                          daily_data=daily_data,
                          method_data=method_data,
-                         class_data=class_data,
-                         transactions=transactions)
+                         class_data=class_data)
 
 # Update the CreateFeeStructureForm to handle class selection better
 class EnhancedCreateFeeStructureForm(FlaskForm):
@@ -7877,15 +9992,11 @@ def manage_students():
     students = query.order_by(Student.created_at.desc()).all()
     
     # Count siblings
-    from collections import defaultdict
-    parent_email_counts = defaultdict(int)
-    all_students = Student.query.filter_by(
-        school_id=current_user.school_id,
-        is_active=True
-    ).all()
-    for s in all_students:
-        if s.parent_email:
-            parent_email_counts[s.parent_email] += 1
+    parent_email_counts = dict(db.session.query(Student.parent_email, func.count(Student.id)).filter(
+        Student.school_id == current_user.school_id,
+        Student.is_active == True,
+        Student.parent_email.isnot(None)
+    ).group_by(Student.parent_email).all())
     
     # Get classes for dropdown
     classes = Class.query.filter_by(
@@ -7894,15 +10005,20 @@ def manage_students():
         is_active=True
     ).all()
     
+    # Every active enrollment of the session in one query, with its class
+    enrollments = {
+        enrollment.student_id: enrollment
+        for enrollment in StudentEnrollment.query.options(joinedload(StudentEnrollment.class_)).filter_by(
+            session_id=context['current_session'].id,
+            is_active=True
+        ).join(Student).filter(Student.school_id == current_user.school_id)
+    }
+    
     student_data = []
     enrolled_count = not_enrolled_count = 0
     
     for student in students:
-        enrollment = StudentEnrollment.query.filter_by(
-            student_id=student.id,
-            session_id=context['current_session'].id,
-            is_active=True
-        ).first()
+        enrollment = enrollments.get(student.id)
         
         enrolled = enrollment is not None
         siblings_count = parent_email_counts.get(student.parent_email, 0) if student.parent_email else 0
@@ -8336,46 +10452,59 @@ def forbidden_error(error):
 
 # ==================== NEW SCHOOL DELETE/DEACTIVATE ROUTES ====================
 
+def delete_school_data(school):
+    """Delete a school and all associated data. The caller commits."""
+    school_id = school.id
+    
+    # Get all associated data
+    users = User.query.filter_by(school_id=school_id).all()
+    sessions = AcademicSession.query.filter_by(school_id=school_id).all()
+    classes = Class.query.filter_by(school_id=school_id).all()
+    students = Student.query.filter_by(school_id=school_id).all()
+    
+    # Delete all related data
+    for user in users:
+        # Delete teacher assignments first
+        TeacherAssignment.query.filter_by(teacher_id=user.id).delete()
+        db.session.delete(user)
+    
+    for session in sessions:
+        StudentEnrollment.query.filter_by(session_id=session.id).delete()
+        db.session.delete(session)
+    
+    for class_obj in classes:
+        StudentEnrollment.query.filter_by(class_id=class_obj.id).delete()
+        TeacherAssignment.query.filter_by(class_id=class_obj.id).delete()
+        db.session.delete(class_obj)
+    
+    for student in students:
+        StudentEnrollment.query.filter_by(student_id=student.id).delete()
+        db.session.delete(student)
+    
+    # Deleting students' fees above updates the stats rows, so they go last
+    SchoolFeeStats.query.filter_by(school_id=school_id).delete()
+    
+    # Finally delete the school
+    db.session.delete(school)
+
 @app.route('/developer/schools/<int:school_id>/delete', methods=['POST'])
 @role_required(['developer'])
 def delete_school(school_id):
-    """Delete a school and all associated data"""
+    """Suspend a school and queue the deletion of all associated data"""
     if current_user.must_change_password:
         return redirect(url_for('change_password'))
     
+    school = School.query.get_or_404(school_id)
+    
     try:
-        school = School.query.get_or_404(school_id)
-        
-        # Get all associated data
-        users = User.query.filter_by(school_id=school_id).all()
-        sessions = AcademicSession.query.filter_by(school_id=school_id).all()
-        classes = Class.query.filter_by(school_id=school_id).all()
-        students = Student.query.filter_by(school_id=school_id).all()
-        
-        # Delete all related data
-        for user in users:
-            # Delete teacher assignments first
-            TeacherAssignment.query.filter_by(teacher_id=user.id).delete()
-            db.session.delete(user)
-        
-        for session in sessions:
-            StudentEnrollment.query.filter_by(session_id=session.id).delete()
-            db.session.delete(session)
-        
-        for class_obj in classes:
-            StudentEnrollment.query.filter_by(class_id=class_obj.id).delete()
-            TeacherAssignment.query.filter_by(class_id=class_obj.id).delete()
-            db.session.delete(class_obj)
-        
-        for student in students:
-            StudentEnrollment.query.filter_by(student_id=student.id).delete()
-            db.session.delete(student)
-        
-        # Finally delete the school
-        db.session.delete(school)
+        # Lock the school out straight away; the worker removes the data
+        school.is_active = False
+        User.query.filter_by(school_id=school_id).update({'is_active': False})
         db.session.commit()
         
-        flash(f'School "{school.name}" has been permanently deleted along with all associated data.', 'success')
+        job = enqueue_job('delete_school', {'school_id': school_id}, school_id=school_id)
+        flash(f'School "{school.name}" has been suspended and is being deleted along with all associated data.', 'info')
+        return job_status_redirect(job, next_url=url_for('manage_schools'))
         
     except Exception as e:
         db.session.rollback()
@@ -8468,6 +10597,262 @@ def school_details(school_id):
                          recent_students=recent_students,
                          recent_admins=recent_admins)
 
+# ==================== SYNTHETIC DATA ====================
+# Production-sized fake schools for local profiling and load tests. Rows go
+# in through COPY (or multi-row INSERT ... RETURNING where ids are needed),
+# bypassing the ORM, so derived tables are rebuilt once at the end.
+
+SYNTHETIC_SUBJECTS = ['Mathematics', 'English', 'Science', 'Hindi', 'Social Studies', 'Computer']
+SYNTHETIC_FIRST_NAMES = ['Aarav', 'Vivaan', 'Aditya', 'Arjun', 'Reyansh', 'Ishaan', 'Ananya', 'Diya',
+                         'Saanvi', 'Aadhya', 'Kavya', 'Myra', 'Rohan', 'Kabir', 'Meera', 'Zara']
+SYNTHETIC_LAST_NAMES = ['Sharma', 'Verma', 'Gupta', 'Singh', 'Patel', 'Reddy', 'Nair', 'Iyer',
+                        'Khan', 'Das', 'Joshi', 'Mehta', 'Rao', 'Bose', 'Kapoor', 'Malhotra']
+SYNTHETIC_ATTENDANCE = ['present'] * 17 + ['absent', 'late', 'half_day']
+COPY_CHUNK_ROWS = 100000
+
+def copy_rows(table, columns, rows):
+    """Stream an iterable of tuples into `table` with COPY on the session's connection. Returns the row count."""
+    cursor = db.session.connection().connection.cursor()
+    statement = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    rows = iter(rows)
+    total = 0
+    while True:
+        chunk = list(islice(rows, COPY_CHUNK_ROWS))
+        if not chunk:
+            return total
+        buffer = StringIO()
+        csv.writer(buffer).writerows(['\\N' if value is None else value for value in row] for row in chunk)
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+        total += len(chunk)
+
+def insert_returning_ids(model, rows):
+    """Multi-row insert of dicts, returning the new ids in the order given"""
+    if not rows:
+        return []
+    table = model.__table__
+    result = db.session.execute(table.insert().returning(table.c.id, sort_by_parameter_order=True), rows)
+    return [row.id for row in result]
+
+def school_days(start, end):
+    """Monday to Saturday between two dates, inclusive"""
+    day = start
+    while day <= end:
+        if day.weekday() < 6:
+            yield day
+        day += timedelta(days=1)
+
+def generate_synthetic_school(index, prefix, rng, sessions=2, classes=10, students_per_class=40,
+                              teachers=15, exams=3, password='password123', password_hash=None):
+    """Create one fake school with its sessions, staff, students and a year of activity.
+    
+    Returns row counts per table and the login emails by role.
+    """
+    now = datetime.utcnow()
+    today = date.today()
+    code = f'{prefix}{index:03d}'
+    domain = f'{code.lower()}.example.com'
+    password_hash = password_hash or generate_password_hash(password)
+    counts = defaultdict(int)
+    
+    school_id = insert_returning_ids(School, [{
+        'name': f'{prefix.title()} School {index}', 'code': code, 'email': f'office@{domain}',
+        'is_active': True, 'created_at': now
+    }])[0]
+    
+    first_year = (today.year if today.month >= 4 else today.year - 1) - (sessions - 1)
+    session_ids = insert_returning_ids(AcademicSession, [{
+        'name': f'{year}-{str(year + 1)[-2:]}', 'start_date': date(year, 4, 1), 'end_date': date(year + 1, 3, 31),
+        'is_current': year == first_year + sessions - 1, 'is_active': True, 'school_id': school_id, 'created_at': now
+    } for year in range(first_year, first_year + sessions)])
+    session_dates = {session_id: (date(year, 4, 1), date(year + 1, 3, 31))
+                     for session_id, year in zip(session_ids, range(first_year, first_year + sessions))}
+    
+    staff = [{'email': f'admin@{domain}', 'role': 'admin', 'full_name': f'Admin {code}'}] + [{
+        'email': f'teacher{n}@{domain}', 'role': 'teacher',
+        'full_name': f'{rng.choice(SYNTHETIC_FIRST_NAMES)} {rng.choice(SYNTHETIC_LAST_NAMES)}'
+    } for n in range(1, teachers + 1)]
+    staff_ids = insert_returning_ids(User, [dict(
+        user, password_hash=password_hash, is_active=True, must_change_password=False,
+        school_id=school_id, created_at=now
+    ) for user in staff])
+    teacher_ids = staff_ids[1:]
+    counts['users'] += len(staff_ids)
+    
+    student_count = classes * students_per_class
+    student_rows = [{
+        'student_id': f'{code}-{n:05d}',
+        'first_name': rng.choice(SYNTHETIC_FIRST_NAMES),
+        'last_name': rng.choice(SYNTHETIC_LAST_NAMES),
+        'date_of_birth': date(today.year - 6 - (n % classes), 1 + n % 12, 1 + n % 28),
+        'gender': rng.choice(['Male', 'Female']),
+        'email': f'{code.lower()}-{n:05d}@{domain}',
+        'parent_email': f'parent{n // 2}@{domain}',  # pairs of siblings
+        'is_active': True, 'school_id': school_id, 'created_at': now
+    } for n in range(1, student_count + 1)]
+    student_ids = insert_returning_ids(Student, student_rows)
+    counts['students'] += len(student_ids)
+    counts['users'] += copy_rows('users', [
+        'email', 'password_hash', 'role', 'full_name', 'is_active', 'must_change_password',
+        'school_id', 'student_id', 'created_at'
+    ], ((row['email'], password_hash, 'student', f"{row['first_name']} {row['last_name']}",
+         True, False, school_id, student_id, now) for row, student_id in zip(student_rows, student_ids)))
+    
+    for session_id in session_ids:
+        start, end = session_dates[session_id]
+        last_day = min(end, today - timedelta(days=1))
+        class_ids = insert_returning_ids(Class, [{
+            'name': f'Class {n // 2 + 1}{"AB"[n % 2]}', 'code': f'C{n + 1}', 'capacity': students_per_class,
+            'room_number': f'R{101 + n}', 'is_active': True, 'school_id': school_id,
+            'session_id': session_id, 'created_at': now
+        } for n in range(classes)])
+        
+        # Students keep their section across sessions
+        enrollments = [(student_id, class_ids[n // students_per_class], n % students_per_class + 1)
+                       for n, student_id in enumerate(student_ids)]
+        counts['student_enrollments'] += copy_rows('student_enrollments', [
+            'student_id', 'class_id', 'session_id', 'roll_number', 'enrollment_date', 'is_active', 'created_at'
+        ], ((student_id, class_id, session_id, roll, start, True, now) for student_id, class_id, roll in enrollments))
+        
+        counts['teacher_assignments'] += copy_rows('teacher_assignments', [
+            'teacher_id', 'class_id', 'session_id', 'subject', 'is_class_teacher', 'created_at'
+        ], ((teacher_ids[(n * len(SYNTHETIC_SUBJECTS) + k) % len(teacher_ids)], class_id, session_id, subject, k == 0, now)
+            for n, class_id in enumerate(class_ids) for k, subject in enumerate(SYNTHETIC_SUBJECTS)))
+        
+        counts['attendance'] += copy_rows('attendance', [
+            'student_id', 'class_id', 'session_id', 'date', 'status', 'created_at', 'updated_at'
+        ], ((student_id, class_id, session_id, day, rng.choice(SYNTHETIC_ATTENDANCE), now, now)
+            for day in school_days(start, last_day) for student_id, class_id, roll in enrollments))
+        
+        # Exams, spread over the part of the session that has happened
+        subject_ids = insert_returning_ids(Subject, [{
+            'name': subject, 'code': subject[:3].upper(), 'class_id': class_id, 'session_id': session_id,
+            'is_active': True, 'default_max_marks': 100.0, 'created_at': now
+        } for class_id in class_ids for subject in SYNTHETIC_SUBJECTS])
+        subjects_by_class = defaultdict(list)
+        for subject_id, class_id in zip(subject_ids, (c for c in class_ids for _ in SYNTHETIC_SUBJECTS)):
+            subjects_by_class[class_id].append(subject_id)
+        span = max((last_day - start).days, 0)
+        exam_dates = [start + timedelta(days=span * (k + 1) // (exams + 1)) for k in range(exams)]
+        exam_rows = [{
+            'name': f'Term {k + 1} Exam', 'term': f'Term {k + 1}', 'session_id': session_id, 'class_id': class_id,
+            'start_date': exam_date, 'end_date': exam_date + timedelta(days=5),
+            'marks_entry_open': False, 'created_at': now
+        } for class_id in class_ids for k, exam_date in enumerate(exam_dates)]
+        exam_ids = insert_returning_ids(Exam, exam_rows)
+        exams_by_class = defaultdict(list)
+        for exam_id, row in zip(exam_ids, exam_rows):
+            exams_by_class[row['class_id']].append(exam_id)
+        # Each student has a steady ability so ranks and grades look plausible
+        ability = {student_id: rng.gauss(65, 15) for student_id in student_ids}
+        counts['student_marks'] += copy_rows('student_marks', [
+            'student_id', 'exam_id', 'subject_id', 'marks_obtained', 'max_marks', 'created_at', 'updated_at'
+        ], ((student_id, exam_id, subject_id, round(min(100, max(0, rng.gauss(ability[student_id], 10))), 1), 100, now, now)
+            for student_id, class_id, roll in enrollments
+            for exam_id in exams_by_class[class_id] for subject_id in subjects_by_class[class_id]))
+        
+        # Fees: three structures per session, paid to varying degrees
+        structures = [('Tuition Fee', 'yearly', 24000), ('Transport Fee', 'yearly', 9000), ('Exam Fee', 'one-time', 1500)]
+        structure_ids = insert_returning_ids(FeeStructure, [{
+            'name': name, 'amount': amount, 'frequency': frequency, 'is_active': True,
+            'school_id': school_id, 'session_id': session_id, 'created_at': now
+        } for name, frequency, amount in structures])
+        fee_rows = []
+        for student_id, class_id, roll in enrollments:
+            for structure_id, (name, frequency, amount) in zip(structure_ids, structures):
+                due = start + timedelta(days=rng.randrange(10, 300))
+                paid = rng.choice([amount, amount, amount, amount / 2, 0])
+                if paid >= amount:
+                    status = 'paid'
+                elif paid:
+                    status = 'partial'
+                else:
+                    status = 'overdue' if due < today else 'pending'
+                fee_rows.append({
+                    'student_id': student_id, 'fee_structure_id': structure_id, 'session_id': session_id,
+                    'class_id': class_id, 'fee_amount': amount, 'discount_amount': 0.0, 'fine_amount': 0.0,
+                    'paid_amount': paid, 'due_date': due, 'status': status,
+                    'payment_date': min(due, last_day) if paid else None,
+                    'created_at': now, 'updated_at': now
+                })
+        fee_ids = insert_returning_ids(StudentFee, fee_rows)
+        counts['student_fees'] += len(fee_ids)
+        counts['fee_transactions'] += copy_rows('fee_transactions', [
+            'transaction_type', 'amount', 'payment_method', 'transaction_id', 'transaction_date', 'status',
+            'receipt_number', 'student_fee_id', 'student_id'
+        ], (('payment', row['paid_amount'], rng.choice(['cash', 'upi', 'card', 'bank_transfer']),
+             f'SYN-{code}-{fee_id}', datetime.combine(row['payment_date'], datetime.min.time()) + timedelta(hours=10),
+             'success', f'RCPT-{code}-{fee_id}', fee_id, row['student_id'])
+            for fee_id, row in zip(fee_ids, fee_rows) if row['paid_amount']))
+    
+    return {
+        'counts': dict(counts),
+        'school_id': school_id,
+        'session_ids': session_ids,
+        'accounts': {
+            'admin': [staff[0]['email']],
+            'teacher': [user['email'] for user in staff[1:]],
+            'student': [row['email'] for row in student_rows]
+        }
+    }
+
+@app.cli.command('generate-data')
+@click.option('--schools', default=1, help='Schools to create')
+@click.option('--sessions', default=2, help='Academic sessions per school, the last one current')
+@click.option('--classes', default=10, help='Classes per session')
+@click.option('--students-per-class', default=40)
+@click.option('--teachers', default=15, help='Teachers per school')
+@click.option('--exams', default=3, help='Exams per class per session')
+@click.option('--prefix', default='LOAD', help='School code prefix; codes are PREFIX001, PREFIX002, ...')
+@click.option('--password', default='password123', help='Password for every generated account')
+@click.option('--seed', type=int, default=None, help='Random seed for a reproducible dataset')
+@click.option('--accounts-file', type=click.Path(dir_okay=False), default=None,
+              help='Write the generated login emails to this JSON file for load_test.py')
+def generate_data_command(schools, sessions, classes, students_per_class, teachers, exams,
+                          prefix, password, seed, accounts_file):
+    """Fill the database with synthetic schools for profiling and load tests"""
+    prefix = prefix.upper()
+    taken = School.query.filter(School.code.like(f'{prefix}%')).count()
+    if taken:
+        raise click.ClickException(f"{taken} school codes already start with {prefix}; choose another --prefix")
+    
+    rng = random.Random(seed)
+    password_hash = generate_password_hash(password)
+    accounts = {'password': password, 'admin': [], 'teacher': [], 'student': []}
+    totals = defaultdict(int)
+    started = time.monotonic()
+    
+    for index in range(1, schools + 1):
+        school_started = time.monotonic()
+        result = generate_synthetic_school(index, prefix, rng, sessions=sessions, classes=classes,
+                                           students_per_class=students_per_class, teachers=teachers,
+                                           exams=exams, password_hash=password_hash)
+        db.session.commit()
+        
+        # Derived tables the COPYs bypassed
+        rollup_attendance_summaries(school_id=result['school_id'])
+        for session_id in result['session_ids']:
+            rebuild_school_fee_stats(result['school_id'], session_id)
+        db.session.commit()
+        invalidate_context_cache(result['school_id'])
+        
+        for role, emails in result['accounts'].items():
+            accounts[role].extend(emails)
+        for table, count in result['counts'].items():
+            totals[table] += count
+        click.echo(f"School {prefix}{index:03d}: {sum(result['counts'].values())} rows "
+                   f"in {time.monotonic() - school_started:.1f}s")
+    
+    elapsed = time.monotonic() - started
+    for table, count in sorted(totals.items()):
+        click.echo(f"  {table}: {count}")
+    click.echo(f"Generated {sum(totals.values())} rows in {elapsed:.1f}s")
+    
+    if accounts_file:
+        with open(accounts_file, 'w') as f:
+            json.dump(accounts, f, indent=2)
+        click.echo(f"Login emails written to {accounts_file}")
+
 # ==================== INITIALIZATION ====================
 
 """def create_tables():
@@ -8614,6 +10999,13 @@ def setup_logging():
     app.logger.addHandler(file_handler)
     app.logger.setLevel(logging.INFO)
     app.logger.info('School ERP startup')
+    
+    if app.config['PROFILING_ENABLED']:
+        perf_handler = RotatingFileHandler('logs/perf.log', maxBytes=10 * 1024 * 1024, backupCount=5)
+        perf_handler.setFormatter(logging.Formatter('%(message)s'))  # one JSON object per line
+        perf_logger.addHandler(perf_handler)
+        perf_logger.setLevel(logging.INFO)
+        perf_logger.propagate = False
 
 
 # ==================== PASSWORD RESET BY DEVELOPER ====================
@@ -9158,6 +11550,479 @@ class ForgotPasswordForm(FlaskForm):
     submit = SubmitField('Reset Password')
 
 
+# ==================== BACKGROUND JOBS ====================
+# Long-running admin operations are queued in the background_jobs table and
+# executed by a separate worker process (`flask --app app run-worker`, see
+# Procfile). Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so
+# several can run side by side. Failed jobs are retried with exponential
+# backoff until max_attempts is reached. Files a job produces are stored in
+# job_result_files, since the web process serving the download may run on
+# another machine than the worker.
+
+JOB_RETRY_BASE_SECONDS = 30
+JOB_STALE_AFTER = timedelta(minutes=10)  # running jobs without a heartbeat are reclaimed
+JOB_HEARTBEAT_INTERVAL = 60  # seconds between heartbeats while a handler runs
+JOB_PRUNE_INTERVAL = 3600  # seconds between a worker's sweeps of expired job files and old mail
+JOB_HANDLERS = {}
+
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, default='{}')
+    status = db.Column(db.String(20), default='queued')  # 'queued', 'running', 'succeeded', 'failed'
+    progress = db.Column(db.Integer, default=0)
+    progress_message = db.Column(db.String(200))
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, default=3)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    # Foreign keys (no FK on school_id: a delete_school job outlives its school)
+    school_id = db.Column(db.Integer, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_background_jobs_status_run_after', 'status', 'run_after'),
+    )
+    
+    @property
+    def payload_data(self):
+        return json.loads(self.payload or '{}')
+    
+    @property
+    def result_data(self):
+        return json.loads(self.result) if self.result else None
+    
+    def report_progress(self, percent, message=None):
+        """Publish progress on its own connection so pollers see it before the job commits"""
+        from sqlalchemy.orm.attributes import set_committed_value
+        
+        progress = max(0, min(100, int(percent)))
+        jobs_table = BackgroundJob.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                jobs_table.update()
+                .where(jobs_table.c.id == self.id)
+                .values(progress=progress, progress_message=message,
+                        heartbeat_at=datetime.utcnow())
+            )
+        # Mirror the values without dirtying the job, so the handler's own
+        # session never flushes (and locks) this row mid-transaction
+        set_committed_value(self, 'progress', progress)
+        set_committed_value(self, 'progress_message', message)
+    
+    def to_dict(self):
+        result = self.result_data
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'status': self.status,
+            'progress': self.progress,
+            'progress_message': self.progress_message,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'error': self.error,
+            'result': result,
+            'download_url': url_for('download_job_result', job_id=self.id)
+                            if result and result.get('filename') else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class JobResultFile(db.Model):
+    __tablename__ = 'job_result_files'
+    job_id = db.Column(db.Integer, db.ForeignKey('background_jobs.id', ondelete='CASCADE'), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+@contextmanager
+def job_output_file(job, filename):
+    """Scratch path for a job's download. Whatever the handler writes there
+    is stored in job_result_files with the job's result; the local file is
+    always removed."""
+    path = os.path.join(app.config['EXPORT_FOLDER'], f'job-{job.id}-{filename}')
+    try:
+        yield path
+        with open(path, 'rb') as f:
+            db.session.add(JobResultFile(job_id=job.id, filename=filename, content=f.read()))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def prune_job_results(max_age_days):
+    """Delete stored job files older than max_age_days. Returns how many went."""
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    deleted = JobResultFile.query.filter(JobResultFile.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def background_job(job_type):
+    """Register a function as the handler for a job type.
+    
+    Handlers are called as handler(job, **payload) inside an app context,
+    without a request or current_user. Whatever they return (JSON
+    serializable) is stored as the job result.
+    """
+    def decorator(f):
+        JOB_HANDLERS[job_type] = f
+        return f
+    return decorator
+
+def enqueue_job(job_type, payload=None, school_id=None, created_by=None, max_attempts=3):
+    """Queue a background job and commit it. Returns the job."""
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job type: {job_type}")
+    
+    if created_by is None and has_request_context() and current_user.is_authenticated:
+        created_by = current_user.id
+        if school_id is None:
+            school_id = current_user.school_id
+    
+    job = BackgroundJob(
+        job_type=job_type,
+        payload=json.dumps(payload or {}),
+        school_id=school_id,
+        created_by=created_by,
+        max_attempts=max_attempts,
+        run_after=datetime.utcnow()
+    )
+    db.session.add(job)
+    db.session.commit()
+    app.logger.info(f"Queued job {job.id} ({job_type})")
+    return job
+
+def claim_next_job(worker_id):
+    """Lock the next runnable job for this worker, or return None"""
+    now = datetime.utcnow()
+    while True:
+        job = BackgroundJob.query.filter(
+            or_(
+                and_(BackgroundJob.status == 'queued', BackgroundJob.run_after <= now),
+                and_(BackgroundJob.status == 'running', BackgroundJob.heartbeat_at < now - JOB_STALE_AFTER)
+            )
+        ).order_by(BackgroundJob.run_after, BackgroundJob.id).with_for_update(skip_locked=True).first()
+        
+        if not job:
+            db.session.rollback()
+            return None
+        if job.status == 'queued' or (job.attempts or 0) < job.max_attempts:
+            break
+        # Its worker died on every allowed attempt, quite possibly because of
+        # the job itself (out of memory), so don't hand it to another one
+        job.status = 'failed'
+        job.error = f"Worker {job.locked_by} stopped responding during attempt {job.attempts}"
+        job.finished_at = now
+        db.session.commit()
+        app.logger.error(f"Job {job.id} ({job.job_type}) failed permanently: worker {job.locked_by} stopped responding")
+    
+    job.status = 'running'
+    job.attempts = (job.attempts or 0) + 1
+    job.locked_by = worker_id
+    job.started_at = now
+    job.heartbeat_at = now
+    job.error = None
+    db.session.commit()
+    return job
+
+@contextmanager
+def job_heartbeat(job):
+    """Refresh the job's heartbeat from a side thread while the block runs.
+    
+    Handlers such as delete_school never report progress, so without this
+    a job running longer than JOB_STALE_AFTER would be handed to a second
+    worker. The heartbeat stops with the worker process, so a job whose
+    worker died is still reclaimed.
+    """
+    engine = db.engine
+    jobs_table = BackgroundJob.__table__
+    job_id, worker_id = job.id, job.locked_by
+    stop = threading.Event()
+    
+    def beat():
+        while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        jobs_table.update()
+                        .where(jobs_table.c.id == job_id, jobs_table.c.locked_by == worker_id,
+                               jobs_table.c.status == 'running')
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+            except Exception as e:
+                app.logger.warning(f"Heartbeat for job {job_id} failed: {e}")
+    
+    thread = threading.Thread(target=beat, name=f'job-{job_id}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def run_job(job):
+    """Execute a claimed job and record success, retry or failure"""
+    handler = JOB_HANDLERS.get(job.job_type)
+    job_id = job.id
+    try:
+        if handler is None:
+            raise ValueError(f"No handler registered for job type {job.job_type}")
+        with job_heartbeat(job):
+            result = handler(job, **job.payload_data)
+            db.session.commit()
+        
+        job = BackgroundJob.query.get(job_id)
+        job.status = 'succeeded'
+        job.progress = 100
+        job.result = json.dumps(result) if result is not None else None
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        app.logger.info(f"Job {job_id} ({job.job_type}) succeeded")
+    except Exception as e:
+        db.session.rollback()
+        job = BackgroundJob.query.get(job_id)
+        job.error = f"{type(e).__name__}: {e}"
+        if job.attempts < job.max_attempts:
+            delay = JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1)
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            app.logger.warning(f"Job {job_id} ({job.job_type}) failed, retrying in {delay}s: {e}")
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+            app.logger.error(f"Job {job_id} ({job.job_type}) failed permanently: {e}")
+        db.session.commit()
+
+@app.cli.command('run-worker')
+@click.option('--poll-interval', default=2.0, help='Seconds to sleep when the queue is empty')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty')
+def run_worker_command(poll_interval, burst):
+    """Process background jobs and queued mail until stopped"""
+    import signal
+    import socket
+    
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = []
+    last_pruned = 0
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    app.logger.info(f"Job worker {worker_id} started")
+    
+    while not stopping:
+        with app.app_context():
+            job = claim_next_job(worker_id)
+            if job:
+                run_job(job)
+                continue
+            # Queue is empty: deliver any mail the web processes left behind
+            if deliver_queued_mail():
+                continue
+            if time.monotonic() - last_pruned > JOB_PRUNE_INTERVAL:
+                pruned = prune_job_results(app.config['JOB_RESULT_RETENTION_DAYS'])
+                if pruned:
+                    app.logger.info(f"Deleted {pruned} expired job result files")
+                purged = purge_outbound_email(app.config['MAIL_RETENTION_DAYS'])
+                if purged:
+                    app.logger.info(f"Deleted {purged} old outbound emails")
+                last_pruned = time.monotonic()
+        _mailer.close_if_idle(app.config['MAIL_IDLE_TIMEOUT'])
+        if burst:
+            break
+        time.sleep(poll_interval)
+    
+    _mailer.close()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(os.getpid())
+    app.logger.info(f"Job worker {worker_id} stopped")
+
+def get_visible_job(job_id):
+    """Fetch a job the current user may see, or 404"""
+    job = BackgroundJob.query.get_or_404(job_id)
+    if current_user.is_developer or job.created_by == current_user.id:
+        return job
+    if current_user.is_school_admin and job.school_id == current_user.school_id:
+        return job
+    abort(404)
+
+def job_status_redirect(job, next_url=None):
+    """Send the user to the polling page for a freshly queued job"""
+    return redirect(url_for('job_status_page', job_id=job.id, next=next_url))
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    """Job status and progress as JSON, for polling"""
+    return jsonify(get_visible_job(job_id).to_dict())
+
+@app.route('/jobs/<int:job_id>/view')
+@login_required
+def job_status_page(job_id):
+    """Progress page that polls job_status"""
+    job = get_visible_job(job_id)
+    next_url = request.args.get('next')
+    if not next_url or not next_url.startswith('/') or next_url.startswith('//'):
+        next_url = url_for('dashboard')
+    return render_template('job_status.html', job=job, next_url=next_url)
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+def download_job_result(job_id):
+    """Download the file produced by a finished job"""
+    job = get_visible_job(job_id)
+    stored = JobResultFile.query.get(job.id) if job.status == 'succeeded' else None
+    if not stored:
+        abort(404)
+    return send_file(BytesIO(stored.content), as_attachment=True, download_name=stored.filename)
+
+@app.cli.command('prune-job-results')
+@click.option('--max-age-days', default=None, type=int, help='Defaults to JOB_RESULT_RETENTION_DAYS')
+def prune_job_results_command(max_age_days):
+    """Delete downloadable job files older than the retention period"""
+    if max_age_days is None:
+        max_age_days = app.config['JOB_RESULT_RETENTION_DAYS']
+    print(f"Deleted {prune_job_results(max_age_days)} job result files")
+
+# ----- Job handlers -----
+
+@background_job('assign_fee_structure')
+def assign_fee_structure_job(job, fee_structure_id, due_date, class_ids=None, all_students=False):
+    fee_structure = FeeStructure.query.get(fee_structure_id)
+    if not fee_structure:
+        raise ValueError(f"Fee structure {fee_structure_id} not found")
+    job.report_progress(10, f'Assigning {fee_structure.name}')
+    result = bulk_assign_fee_structure(
+        fee_structure, datetime.strptime(due_date, '%Y-%m-%d').date(),
+        class_ids=class_ids, all_students=all_students
+    )
+    db.session.commit()
+    result['message'] = (f'Fee assigned to {result["inserted"]} students successfully! '
+                         f'{result["skipped"]} already had this fee.')
+    return result
+
+@background_job('export_csv')
+def export_csv_job(job, export, compress=False, **filters):
+    """Write a CSV export for download"""
+    if export == 'student_fees':
+        filename, header, query, format_row = student_fees_export(**filters)
+    elif export == 'fee_transactions':
+        filters['start_date'] = datetime.strptime(filters['start_date'], '%Y-%m-%d').date()
+        filters['end_date'] = datetime.strptime(filters['end_date'], '%Y-%m-%d').date()
+        filename, header, query, format_row = fee_transactions_export(**filters)
+    else:
+        raise ValueError(f"Unknown export: {export}")
+    
+    total = db.session.execute(
+        db.select(func.count()).select_from(query.subquery())
+    ).scalar() or 0
+    
+    if compress:
+        filename = f'{filename}.gz'
+    with job_output_file(job, filename) as path:
+        opener = (lambda: gzip.open(path, 'wt', newline='')) if compress else (lambda: open(path, 'w', newline=''))
+        with opener() as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for count, row in enumerate(stream_query_rows(query), start=1):
+                writer.writerow(format_row(row))
+                if count % CSV_EXPORT_BATCH_SIZE == 0:
+                    job.report_progress(count * 100 // max(total, 1), f'{count} of {total} rows')
+    
+    return {'filename': filename, 'rows': total,
+            'message': f'Export of {total} rows is ready.'}
+
+@background_job('delete_school')
+def delete_school_job(job, school_id):
+    school = School.query.get(school_id)
+    if not school:
+        return {'deleted': False}
+    job.report_progress(10, f'Deleting {school.name}')
+    school_name = school.name
+    delete_school_data(school)
+    db.session.commit()
+    return {'deleted': True, 'message': f'School "{school_name}" has been permanently deleted along with all associated data.'}
+
+@background_job('generate_report_cards')
+def generate_report_cards_job(job, school_id, session_id):
+    """Bring every class's report card snapshot up to date"""
+    classes = Class.query.filter_by(
+        school_id=school_id,
+        session_id=session_id,
+        is_active=True
+    ).order_by(Class.name).all()
+    for index, class_obj in enumerate(classes, start=1):
+        get_class_report_card(class_obj, session_id)
+        job.report_progress(index * 100 // len(classes), f'{class_obj.name} ready')
+    return {'classes': len(classes), 'message': f'Report cards generated for {len(classes)} classes.'}
+
+@background_job('report_card_pdfs')
+def report_card_pdfs_job(job, school_id, session_id, class_id=None):
+    """Render a PDF report card per student into a ZIP for download"""
+    school = School.query.get(school_id)
+    session_obj = AcademicSession.query.get(session_id)
+    if not school or not session_obj:
+        raise ValueError(f"School {school_id} or session {session_id} not found")
+    
+    query = Class.query.filter_by(school_id=school_id, session_id=session_id, is_active=True)
+    if class_id:
+        query = query.filter_by(id=class_id)
+    classes = query.order_by(Class.name).all()
+    total = StudentEnrollment.query.filter(
+        StudentEnrollment.class_id.in_([c.id for c in classes]),
+        StudentEnrollment.session_id == session_id,
+        StudentEnrollment.is_active == True
+    ).count()
+    
+    label = classes[0].name if class_id and classes else session_obj.name
+    filename = secure_filename(f'report_cards_{label}.zip')
+    documents = chain.from_iterable(
+        report_card_documents(class_obj, session_obj, school) for class_obj in classes
+    )
+    
+    job.report_progress(0, f'Rendering {total} report cards')
+    rendered = 0
+    # Templates run context processors that expect a request
+    with job_output_file(job, filename) as path:
+        with app.test_request_context(), zipfile.ZipFile(path, 'w') as archive:
+            for name, pdf in render_pdfs(documents):
+                archive.writestr(name, pdf)
+                rendered += 1
+                if rendered * 100 // max(total, 1) > (rendered - 1) * 100 // max(total, 1):
+                    job.report_progress(rendered * 100 // max(total, 1), f'{rendered} of {total} report cards')
+    
+    return {'filename': filename, 'documents': rendered,
+            'message': f'{rendered} report cards are ready.'}
+
+@background_job('generate_timetable')
+def generate_timetable_job(job, timetable_id, time_budget=20, **options):
+    timetable = Timetable.query.get(timetable_id)
+    if not timetable:
+        raise ValueError(f"Timetable {timetable_id} not found")
+    job.report_progress(5, 'Placing lessons')
+    result = generate_timetable(
+        timetable, time_budget=time_budget,
+        on_progress=lambda remaining: job.report_progress(50, f'{remaining} lessons still clash'),
+        **options
+    )
+    db.session.commit()
+    result['message'] = f'Generated {result["entries"]} lessons for {result["classes"]} classes.'
+    return result
+
+@background_job('rebuild_attendance_summaries')
+def rebuild_attendance_summaries_job(job, start_date=None, end_date=None, **filters):
+    rows = rollup_attendance_summaries(
+        start_date=datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None,
+        end_date=datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None,
+        **filters
+    )
+    db.session.commit()
+    return {'rows': rows, 'message': f'Rebuilt {rows} attendance summaries.'}
+
 # ==================== MAIN APPLICATION ====================
 setup_logging()
 with app.app_context():
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Benchmark the hot-path indexes against a generated dataset.
+
+Fills one synthetic school with classes, students, attendance, fees,
+transactions and marks, then runs EXPLAIN ANALYZE for the lookups the
+routes make, first without and then with the indexes declared on the
+models. Everything happens in one transaction that is rolled back, so
+nothing is left behind; dropping indexes locks the tables meanwhile, so
+point DATABASE_URL at a scratch copy rather than production.
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, Attendance, StudentEnrollment, StudentFee, FeeTransaction, StudentMarks
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+BENCHMARKED_MODELS = [Attendance, StudentEnrollment, StudentFee, FeeTransaction, StudentMarks]
+
+# (label, SQL) for the lookups the routes make; :ids come from the generated school
+HOT_QUERIES = [
+    ('attendance for a class on a day',
+     'SELECT * FROM attendance WHERE class_id = :class_id AND session_id = :session_id AND date = :day'),
+    ('active enrollments of a class',
+     'SELECT * FROM student_enrollments WHERE class_id = :class_id AND session_id = :session_id AND is_active'),
+    ("a student's enrollment",
+     'SELECT * FROM student_enrollments WHERE student_id = :student_id AND session_id = :session_id'),
+    ("a student's fees",
+     'SELECT * FROM student_fees WHERE student_id = :student_id AND session_id = :session_id'),
+    ('overdue fees of a session',
+     "SELECT * FROM student_fees WHERE session_id = :session_id AND status IN ('pending', 'partial') "
+     'AND due_date < :day'),
+    ("a student's transactions",
+     'SELECT * FROM fee_transactions WHERE student_id = :student_id ORDER BY transaction_date DESC'),
+    ('marks for an exam subject',
+     'SELECT * FROM student_marks WHERE exam_id = :exam_id AND subject_id = :subject_id'),
+]
+
+
+def generate_dataset(classes, students_per_class, days):
+    """Insert one synthetic school with bulk INSERT ... SELECT statements. Returns query parameters."""
+    params = {}
+    params['school_id'] = db.session.execute(text(
+        "INSERT INTO schools (name, code, is_active) VALUES ('Benchmark School', 'BENCH-' || md5(random()::text), TRUE) "
+        'RETURNING id'
+    )).scalar()
+    params['session_id'] = db.session.execute(text(
+        "INSERT INTO academic_sessions (name, start_date, end_date, is_current, school_id) "
+        "VALUES ('Benchmark', DATE '2025-04-01', DATE '2026-03-31', FALSE, :school_id) RETURNING id"
+    ), params).scalar()
+    fee_structure_id = db.session.execute(text(
+        "INSERT INTO fee_structures (name, amount, frequency, school_id, session_id) "
+        "VALUES ('Tuition', 1000, 'monthly', :school_id, :session_id) RETURNING id"
+    ), params).scalar()
+    statements = [
+        "INSERT INTO classes (name, code, school_id, session_id, is_active) "
+        "SELECT 'Class ' || n, 'B' || n, :school_id, :session_id, TRUE FROM generate_series(1, :classes) n",
+        "INSERT INTO students (student_id, first_name, last_name, date_of_birth, gender, school_id) "
+        "SELECT 'BENCH-' || :school_id || '-' || n, 'Student', n::text, DATE '2012-01-01', 'M', :school_id "
+        'FROM generate_series(1, :classes * :per_class) n',
+        'INSERT INTO student_enrollments (student_id, class_id, session_id, roll_number, enrollment_date, is_active) '
+        'SELECT s.id, c.id, :session_id, s.n, DATE \'2025-04-01\', TRUE FROM '
+        '(SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM students WHERE school_id = :school_id) s '
+        'JOIN (SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM classes WHERE session_id = :session_id) c '
+        'ON c.n = s.n % :classes',
+        'INSERT INTO attendance (student_id, class_id, session_id, date, status) '
+        "SELECT e.student_id, e.class_id, :session_id, DATE '2025-04-01' + d, "
+        "CASE WHEN random() < 0.9 THEN 'present' ELSE 'absent' END "
+        'FROM student_enrollments e CROSS JOIN generate_series(0, :days - 1) d WHERE e.session_id = :session_id',
+        'INSERT INTO student_fees (student_id, fee_structure_id, session_id, class_id, fee_amount, '
+        'discount_amount, fine_amount, paid_amount, due_date, status) '
+        "SELECT e.student_id, :fee_structure_id, :session_id, e.class_id, 12000, 0, 0, 0, "
+        "DATE '2025-04-10' + (random() * 300)::int, "
+        "(ARRAY['pending', 'partial', 'paid', 'overdue'])[1 + (random() * 3)::int] "
+        'FROM student_enrollments e WHERE e.session_id = :session_id',
+        'INSERT INTO fee_transactions (student_id, student_fee_id, transaction_type, amount, transaction_date, status) '
+        "SELECT f.student_id, f.id, 'payment', 1000, TIMESTAMP '2025-04-01' + random() * INTERVAL '300 days', 'success' "
+        'FROM student_fees f CROSS JOIN generate_series(1, 6) WHERE f.session_id = :session_id',
+        "INSERT INTO subjects (name, code, class_id, session_id, is_active) "
+        "SELECT s, left(s, 3), c.id, :session_id, TRUE FROM classes c "
+        "CROSS JOIN unnest(ARRAY['Mathematics', 'English', 'Science', 'Hindi', 'Social Studies', 'Computer']) s "
+        'WHERE c.session_id = :session_id',
+        "INSERT INTO exams (name, term, session_id, class_id) "
+        "SELECT t, t, :session_id, c.id FROM classes c "
+        "CROSS JOIN unnest(ARRAY['Unit Test 1', 'Half Yearly', 'Unit Test 2', 'Annual']) t "
+        'WHERE c.session_id = :session_id',
+        'INSERT INTO student_marks (student_id, exam_id, subject_id, marks_obtained, max_marks) '
+        'SELECT e.student_id, x.id, s.id, round((random() * 100)::numeric, 1), 100 '
+        'FROM student_enrollments e JOIN exams x ON x.class_id = e.class_id '
+        'JOIN subjects s ON s.class_id = e.class_id WHERE e.session_id = :session_id',
+    ]
+    values = dict(params, classes=classes, per_class=students_per_class, days=days,
+                  fee_structure_id=fee_structure_id)
+    for statement in statements:
+        db.session.execute(text(statement), values)
+
+    params['class_id'], params['student_id'] = db.session.execute(text(
+        'SELECT class_id, student_id FROM student_enrollments WHERE session_id = :session_id LIMIT 1'
+    ), params).one()
+    params['exam_id'], params['subject_id'] = db.session.execute(text(
+        'SELECT x.id, s.id FROM exams x JOIN subjects s ON s.class_id = x.class_id '
+        'WHERE x.class_id = :class_id LIMIT 1'
+    ), params).one()
+    params['day'] = db.session.execute(text(
+        "SELECT DATE '2025-04-01' + (:days / 2)"
+    ), {'days': days}).scalar()
+    return params
+
+
+def explain(sql, params):
+    """(plan summary, execution ms) from EXPLAIN ANALYZE"""
+    plan = db.session.execute(text(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}'), params).scalar()
+    plan = plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+
+    def nodes(node):
+        yield node
+        for child in node.get('Plans', []):
+            yield from nodes(child)
+
+    summary = ', '.join(
+        f"{node['Node Type']}" + (f" on {node['Index Name']}" if 'Index Name' in node else '')
+        for node in nodes(plan['Plan']) if 'Scan' in node['Node Type']
+    )
+    return summary, plan['Execution Time']
+
+
+def run_queries(params, repeat):
+    db.session.execute(text('ANALYZE attendance, student_enrollments, student_fees, fee_transactions, student_marks'))
+    results = {}
+    for label, sql in HOT_QUERIES:
+        runs = [explain(sql, params) for _ in range(repeat)]
+        results[label] = {'plan': runs[-1][0], 'ms': min(ms for _, ms in runs)}
+    return results
+
+
+def benchmark(classes, students_per_class, days, repeat):
+    indexes = [index for model in BENCHMARKED_MODELS for index in model.__table__.indexes]
+    try:
+        print(f"Generating {classes} classes x {students_per_class} students, {days} days of attendance...")
+        params = generate_dataset(classes, students_per_class, days)
+        for table in ('attendance', 'student_fees', 'fee_transactions', 'student_marks'):
+            count = db.session.execute(text(f'SELECT count(*) FROM {table}')).scalar()
+            print(f"  {table}: {count} rows")
+
+        for index in indexes:
+            db.session.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+        before = run_queries(params, repeat)
+
+        for index in indexes:
+            db.session.execute(CreateIndex(index))
+        after = run_queries(params, repeat)
+    finally:
+        db.session.rollback()
+
+    return [{'query': label, 'before': before[label], 'after': after[label]} for label, _ in HOT_QUERIES]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--classes', type=int, default=60)
+    parser.add_argument('--students-per-class', type=int, default=40)
+    parser.add_argument('--days', type=int, default=200, help='Days of attendance per student')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per query, the fastest is reported')
+    parser.add_argument('--json', dest='json_path', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    with app.app_context():
+        results = benchmark(args.classes, args.students_per_class, args.days, args.repeat)
+
+    for result in results:
+        before, after = result['before'], result['after']
+        speedup = before['ms'] / after['ms'] if after['ms'] else float('inf')
+        print(f"\n{result['query']}: {before['ms']:.2f} ms -> {after['ms']:.2f} ms ({speedup:.0f}x)")
+        print(f"  before: {before['plan']}")
+        print(f"  after:  {after['plan']}")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Gunicorn settings, read automatically from the working directory.
+
+Workers share PROMETHEUS_MULTIPROC_DIR so /metrics reports every worker,
+not just the one that answered the scrape. The Procfile points the job
+worker at the same directory.
+"""
+import os
+import tempfile
+
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'school_erp_metrics'))
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def on_starting(server):
+    # Files left by an earlier run would be added to this one's counters.
+    # A job worker that is still running keeps its files.
+    os.makedirs(metrics_dir, exist_ok=True)
+    for name in os.listdir(metrics_dir):
+        pid = name.rsplit('_', 1)[-1].split('.')[0]
+        if not pid.isdigit() or not process_alive(int(pid)):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Concurrent load driver for a running School ERP server.
+
+Virtual users log in with accounts made by `flask generate-data
+--accounts-file accounts.json` and replay role-specific browsing scripts
+in a loop: admins open their dashboards, teachers take attendance,
+students check fees and attendance. Prints request counts, errors and
+latency percentiles per page when the run ends.
+
+    python load_test.py --base-url http://localhost:5000 --accounts accounts.json \\
+        --admins 2 --teachers 10 --students 40 --duration 60
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import date
+from collections import defaultdict
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urljoin
+from urllib.request import HTTPCookieProcessor, build_opener
+
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+TAKE_ATTENDANCE_PATTERN = re.compile(r'href="(/teacher/attendance/take/\d+)"')
+STATUS_FIELD_PATTERN = re.compile(r'name="status_(\d+)"')
+
+
+class Stats:
+    """Latencies and errors per page name, shared by every virtual user"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, elapsed):
+        lines = [f"{'page':<28}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"]
+        total = 0
+        for name in sorted(self.latencies):
+            samples = sorted(self.latencies[name])
+            total += len(samples)
+
+            def percentile(p):
+                return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+
+            lines.append(f"{name:<28}{len(samples):>9}{self.errors[name]:>8}"
+                         f"{percentile(50):>9.1f}{percentile(95):>9.1f}{percentile(99):>9.1f}{samples[-1] * 1000:>9.1f}")
+        lines.append(f"{total} requests in {elapsed:.1f}s ({total / elapsed:.1f}/s), "
+                     f"{sum(self.errors.values())} errors")
+        return '\n'.join(lines)
+
+
+class VirtualUser:
+    """One logged-in browser: its own cookie jar, timing every request"""
+
+    def __init__(self, base_url, stats, timeout):
+        self.base_url = base_url
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def request(self, name, path, data=None):
+        """Fetch a page (POST when `data` is given) and return its HTML, or None on error"""
+        started = time.perf_counter()
+        try:
+            body = urlencode(data).encode() if data is not None else None
+            with self.opener.open(urljoin(self.base_url, path), body, timeout=self.timeout) as response:
+                html = response.read().decode('utf-8', 'replace')
+            self.stats.record(name, time.perf_counter() - started, True)
+            return html
+        except (HTTPError, URLError, OSError):
+            self.stats.record(name, time.perf_counter() - started, False)
+            return None
+
+    def login(self, email, password):
+        page = self.request('login form', '/login')
+        token = CSRF_PATTERN.search(page or '')
+        if not token:
+            return False
+        page = self.request('login', '/login', {'csrf_token': token.group(1), 'email': email, 'password': password})
+        return page is not None and 'name="password"' not in page
+
+
+def admin_script(user):
+    user.request('admin dashboard', '/admin/dashboard')
+    user.request('admin students', '/admin/students')
+    user.request('admin classes', '/admin/classes')
+    user.request('admin fee dashboard', '/admin/fees/dashboard')
+    user.request('admin fee students', '/admin/fees/students')
+
+
+def teacher_script(user):
+    user.request('teacher dashboard', '/teacher/dashboard')
+    page = user.request('teacher attendance', '/teacher/attendance')
+    classes = TAKE_ATTENDANCE_PATTERN.findall(page or '')
+    if not classes:
+        return
+    path = random.choice(classes)
+    form = user.request('take attendance form', path)
+    token = CSRF_PATTERN.search(form or '')
+    if not token:
+        return
+    data = {'csrf_token': token.group(1), 'date': date.today().isoformat()}
+    for student_id in set(STATUS_FIELD_PATTERN.findall(form)):
+        data[f'status_{student_id}'] = random.choice(['present'] * 8 + ['absent', 'late'])
+    user.request('take attendance submit', path, data)
+
+
+def student_script(user):
+    user.request('student dashboard', '/student/dashboard')
+    user.request('student fees', '/student/fees')
+    user.request('student attendance', '/student/attendance')
+
+
+SCRIPTS = {'admin': admin_script, 'teacher': teacher_script, 'student': student_script}
+
+
+def run_user(role, email, password, args, stats, deadline):
+    user = VirtualUser(args.base_url, stats, args.timeout)
+    if not user.login(email, password):
+        print(f"Login failed for {email}", file=sys.stderr)
+        return
+    while time.monotonic() < deadline:
+        SCRIPTS[role](user)
+        if args.think_time:
+            time.sleep(random.uniform(0, 2 * args.think_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay role-specific browsing against a running server')
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--accounts', required=True, help='JSON file written by flask generate-data --accounts-file')
+    parser.add_argument('--admins', type=int, default=1, help='Concurrent admin users')
+    parser.add_argument('--teachers', type=int, default=5, help='Concurrent teacher users')
+    parser.add_argument('--students', type=int, default=20, help='Concurrent student users')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to run')
+    parser.add_argument('--think-time', type=float, default=1.0, help='Mean pause between scripts, in seconds')
+    parser.add_argument('--timeout', type=float, default=30, help='Per-request timeout, in seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with open(args.accounts) as f:
+        accounts = json.load(f)
+
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = []
+    for role, count in (('admin', args.admins), ('teacher', args.teachers), ('student', args.students)):
+        emails = accounts.get(role, [])
+        if count and not emails:
+            parser.error(f"No {role} accounts in {args.accounts}")
+        for n in range(count):
+            thread = threading.Thread(target=run_user, daemon=True,
+                                      args=(role, emails[n % len(emails)], accounts['password'], args, stats, deadline))
+            thread.start()
+            threads.append(thread)
+
+    print(f"Running {len(threads)} virtual users for {args.duration:.0f}s against {args.base_url}...")
+    for thread in threads:
+        thread.join()
+    print(stats.report(time.monotonic() - started))
+
+
+if __name__ == '__main__':
+    main()
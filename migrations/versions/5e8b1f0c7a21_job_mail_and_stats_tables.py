@@ -0,0 +1,149 @@
+"""job, mail and stats tables
+
+The tables behind the job queue, queued outbound mail, materialized fee
+statistics and report card snapshots, plus the timetable version column
+and slot index.
+
+Importing the app runs db.create_all(), which may have made the tables
+already, so each step only runs for what is missing.
+
+Revision ID: 5e8b1f0c7a21
+Revises: c4d58d2715bf
+Create Date: 2026-10-18 16:42:10.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8b1f0c7a21'
+down_revision = 'c4d58d2715bf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table('background_jobs'):
+        op.create_table(
+            'background_jobs',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('job_type', sa.String(length=50), nullable=False),
+            sa.Column('payload', sa.Text(), nullable=True),
+            sa.Column('status', sa.String(length=20), nullable=True),
+            sa.Column('progress', sa.Integer(), nullable=True),
+            sa.Column('progress_message', sa.String(length=200), nullable=True),
+            sa.Column('result', sa.Text(), nullable=True),
+            sa.Column('error', sa.Text(), nullable=True),
+            sa.Column('attempts', sa.Integer(), nullable=True),
+            sa.Column('max_attempts', sa.Integer(), nullable=True),
+            sa.Column('run_after', sa.DateTime(), nullable=True),
+            sa.Column('locked_by', sa.String(length=100), nullable=True),
+            sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('started_at', sa.DateTime(), nullable=True),
+            sa.Column('finished_at', sa.DateTime(), nullable=True),
+            sa.Column('school_id', sa.Integer(), nullable=True),
+            sa.Column('created_by', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['created_by'], ['users.id'], ondelete='SET NULL'),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_background_jobs_status_run_after', 'background_jobs', ['status', 'run_after'])
+
+    if not inspector.has_table('job_result_files'):
+        op.create_table(
+            'job_result_files',
+            sa.Column('job_id', sa.Integer(), nullable=False),
+            sa.Column('filename', sa.String(length=255), nullable=False),
+            sa.Column('content', sa.LargeBinary(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['job_id'], ['background_jobs.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('job_id'),
+        )
+        op.create_index('ix_job_result_files_created_at', 'job_result_files', ['created_at'])
+
+    if not inspector.has_table('outbound_emails'):
+        op.create_table(
+            'outbound_emails',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('to_email', sa.String(length=120), nullable=False),
+            sa.Column('subject', sa.String(length=255), nullable=False),
+            sa.Column('html_body', sa.Text(), nullable=False),
+            sa.Column('text_body', sa.Text(), nullable=True),
+            sa.Column('status', sa.String(length=20), nullable=True),
+            sa.Column('attempts', sa.Integer(), nullable=True),
+            sa.Column('last_error', sa.Text(), nullable=True),
+            sa.Column('run_after', sa.DateTime(), nullable=True),
+            sa.Column('expires_at', sa.DateTime(), nullable=True),
+            sa.Column('locked_at', sa.DateTime(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('sent_at', sa.DateTime(), nullable=True),
+            sa.Column('school_id', sa.Integer(), nullable=True),
+            sa.Column('created_by', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['created_by'], ['users.id'], ondelete='SET NULL'),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_outbound_emails_status_run_after', 'outbound_emails', ['status', 'run_after'])
+
+    if not inspector.has_table('school_fee_stats'):
+        op.create_table(
+            'school_fee_stats',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('total_fees', sa.Float(), nullable=True),
+            sa.Column('total_paid', sa.Float(), nullable=True),
+            sa.Column('total_discount', sa.Float(), nullable=True),
+            sa.Column('total_fine', sa.Float(), nullable=True),
+            sa.Column('fee_count', sa.Integer(), nullable=True),
+            sa.Column('paid_count', sa.Integer(), nullable=True),
+            sa.Column('pending_count', sa.Integer(), nullable=True),
+            sa.Column('partial_count', sa.Integer(), nullable=True),
+            sa.Column('overdue_count', sa.Integer(), nullable=True),
+            sa.Column('overdue_as_of', sa.Date(), nullable=True),
+            sa.Column('students_with_fees', sa.Integer(), nullable=True),
+            sa.Column('updated_at', sa.DateTime(), nullable=True),
+            sa.Column('school_id', sa.Integer(), nullable=False),
+            sa.Column('session_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['school_id'], ['schools.id']),
+            sa.ForeignKeyConstraint(['session_id'], ['academic_sessions.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('school_id', 'session_id', name='uq_school_fee_stats_school_session'),
+        )
+
+    if not inspector.has_table('report_card_snapshots'):
+        op.create_table(
+            'report_card_snapshots',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('marks_version', sa.Integer(), nullable=False),
+            sa.Column('data_version', sa.Integer(), nullable=True),
+            sa.Column('data', sa.Text(), nullable=True),
+            sa.Column('generated_at', sa.DateTime(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('class_id', sa.Integer(), nullable=False),
+            sa.Column('session_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['class_id'], ['classes.id'], ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['session_id'], ['academic_sessions.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('class_id', 'session_id', name='uq_report_card_snapshot_class_session'),
+        )
+
+    if 'version' not in [c['name'] for c in inspector.get_columns('timetables')]:
+        op.add_column('timetables', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+    if 'ix_timetable_entries_slot' not in [i['name'] for i in inspector.get_indexes('timetable_entries')]:
+        op.create_index('ix_timetable_entries_slot', 'timetable_entries',
+                        ['timetable_id', 'day_of_week', 'period_id'])
+
+
+def downgrade():
+    op.drop_index('ix_timetable_entries_slot', table_name='timetable_entries')
+    op.drop_column('timetables', 'version')
+    op.drop_table('report_card_snapshots')
+    op.drop_table('school_fee_stats')
+    op.drop_index('ix_outbound_emails_status_run_after', table_name='outbound_emails')
+    op.drop_table('outbound_emails')
+    op.drop_index('ix_job_result_files_created_at', table_name='job_result_files')
+    op.drop_table('job_result_files')
+    op.drop_index('ix_background_jobs_status_run_after', table_name='background_jobs')
+    op.drop_table('background_jobs')
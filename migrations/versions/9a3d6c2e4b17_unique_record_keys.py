@@ -0,0 +1,159 @@
+"""unique record keys
+
+The unique keys the attendance, marks, fee and attendance summary upserts
+use as their ON CONFLICT targets. Databases built before them may hold
+duplicate rows, which are removed first:
+
+- attendance and marks keep the newest row (highest id) of each group;
+  the summaries and report cards built from the removed rows are queued
+  for a rebuild or marked stale
+- fee rows keep the copy with payments or transactions on it, else the
+  oldest; copies with no money recorded against them are deleted, and the
+  upgrade stops if more than one copy in a group has some
+- attendance summaries are derived data, so the older copies go and the
+  classes are queued for a rebuild
+
+Each table is locked against writes while it is deduplicated and the key
+is added, so the running release cannot slip a duplicate in between.
+
+Revision ID: 9a3d6c2e4b17
+Revises: 5e8b1f0c7a21
+Create Date: 2026-10-18 17:20:41.905512
+
+"""
+import json
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a3d6c2e4b17'
+down_revision = '5e8b1f0c7a21'
+branch_labels = None
+depends_on = None
+
+
+KEYS = [
+    ('attendance', 'uq_attendance_student_class_date', ['student_id', 'class_id', 'date']),
+    ('student_marks', 'uq_student_marks_student_exam_subject', ['student_id', 'exam_id', 'subject_id']),
+    ('student_fees', 'uq_student_fee_structure_session', ['student_id', 'fee_structure_id', 'session_id']),
+    ('attendance_summary', 'uq_attendance_summary_student_month',
+     ['student_id', 'class_id', 'session_id', 'month', 'year']),
+]
+
+
+def delete_older_copies(connection, table, columns, returning):
+    """Delete all but the highest-id row of each duplicate group"""
+    key_match = ' AND '.join(f'a.{column} = b.{column}' for column in columns)
+    return connection.execute(sa.text(
+        f'DELETE FROM {table} a USING {table} b WHERE {key_match} AND a.id < b.id '
+        f'RETURNING {returning}'
+    )).scalars().all()
+
+
+def queue_summary_rebuilds(connection, class_ids):
+    now = datetime.utcnow()
+    for class_id in sorted(set(class_ids)):
+        connection.execute(sa.text(
+            "INSERT INTO background_jobs (job_type, payload, status, progress, attempts, max_attempts, "
+            "run_after, created_at) SELECT 'rebuild_attendance_summaries', :payload, 'queued', 0, 0, 3, :now, :now "
+            "WHERE NOT EXISTS (SELECT 1 FROM background_jobs WHERE job_type = 'rebuild_attendance_summaries' "
+            "AND status = 'queued' AND payload = :payload)"
+        ), {'payload': json.dumps({'class_id': class_id}), 'now': now})
+
+
+def mark_report_cards_stale(connection, class_ids):
+    if class_ids:
+        connection.execute(sa.text(
+            'UPDATE report_card_snapshots SET marks_version = marks_version + 1 WHERE class_id = ANY(:ids)'
+        ), {'ids': sorted(set(class_ids))})
+
+
+def dedupe_attendance(connection):
+    class_ids = delete_older_copies(connection, 'attendance', ['student_id', 'class_id', 'date'], 'a.class_id')
+    queue_summary_rebuilds(connection, class_ids)
+    mark_report_cards_stale(connection, class_ids)
+    return len(class_ids)
+
+
+def dedupe_student_marks(connection):
+    exam_ids = delete_older_copies(connection, 'student_marks', ['student_id', 'exam_id', 'subject_id'], 'a.exam_id')
+    if exam_ids:
+        class_ids = connection.execute(sa.text(
+            'SELECT class_id FROM exams WHERE id = ANY(:ids)'
+        ), {'ids': sorted(set(exam_ids))}).scalars().all()
+        mark_report_cards_stale(connection, class_ids)
+    return len(exam_ids)
+
+
+def dedupe_student_fees(connection):
+    session_ids = connection.execute(sa.text(
+        'WITH fees AS ('
+        '  SELECT f.id, f.student_id, f.fee_structure_id, f.session_id,'
+        '    coalesce(f.paid_amount, 0) <> 0 OR coalesce(f.discount_amount, 0) <> 0'
+        '      OR coalesce(f.fine_amount, 0) <> 0'
+        '      OR EXISTS (SELECT 1 FROM fee_transactions t WHERE t.student_fee_id = f.id) AS has_money'
+        '  FROM student_fees f'
+        '), ranked AS ('
+        '  SELECT id, has_money, row_number() OVER ('
+        '    PARTITION BY student_id, fee_structure_id, session_id ORDER BY has_money DESC, id) AS n'
+        '  FROM fees'
+        ') '
+        'DELETE FROM student_fees WHERE id IN (SELECT id FROM ranked WHERE n > 1 AND NOT has_money) '
+        'RETURNING session_id'
+    )).scalars().all()
+
+    remaining = connection.execute(sa.text(
+        'SELECT count(*) FROM (SELECT 1 FROM student_fees '
+        'GROUP BY student_id, fee_structure_id, session_id HAVING count(*) > 1) d'
+    )).scalar()
+    if remaining:
+        raise RuntimeError(
+            f'{remaining} students have the same fee assigned more than once with payments, discounts '
+            'or fines recorded on more than one copy; merge those fee records, then run the upgrade again'
+        )
+
+    # A missing stats row is rebuilt from student_fees the next time it is read
+    if session_ids:
+        connection.execute(sa.text(
+            'DELETE FROM school_fee_stats WHERE session_id = ANY(:ids)'
+        ), {'ids': sorted(set(session_ids))})
+    return len(session_ids)
+
+
+def dedupe_attendance_summary(connection):
+    class_ids = delete_older_copies(
+        connection, 'attendance_summary', ['student_id', 'class_id', 'session_id', 'month', 'year'], 'a.class_id'
+    )
+    queue_summary_rebuilds(connection, class_ids)
+    return len(class_ids)
+
+
+DEDUPE = {
+    'attendance': dedupe_attendance,
+    'student_marks': dedupe_student_marks,
+    'student_fees': dedupe_student_fees,
+    'attendance_summary': dedupe_attendance_summary,
+}
+
+
+def upgrade():
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+
+    for table, name, columns in KEYS:
+        if name in [c['name'] for c in inspector.get_unique_constraints(table)]:
+            continue
+        # Blocks writes, not reads, until the upgrade commits
+        op.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+        removed = DEDUPE[table](connection)
+        if removed:
+            print(f'Removed {removed} duplicate row(s) from {table}')
+        op.create_unique_constraint(name, table, columns)
+
+
+def downgrade():
+    for table, name, columns in reversed(KEYS):
+        op.drop_constraint(name, table, type_='unique')
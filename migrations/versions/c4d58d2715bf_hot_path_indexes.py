@@ -0,0 +1,70 @@
+"""hot path indexes
+
+Composite indexes for the attendance, enrollment, fee, transaction and
+marks lookups most routes make, plus a partial unique index allowing at
+most one active enrollment per student and session.
+
+Databases created before this revision were built by db.create_all(), so
+it is the first revision. Indexes are built CONCURRENTLY and IF NOT EXISTS,
+so it can run against a live database and is a no-op where create_all()
+already made them.
+
+Revision ID: c4d58d2715bf
+Revises:
+Create Date: 2026-10-18 13:16:00.953112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d58d2715bf'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_attendance_class_session_date', 'attendance', 'class_id, session_id, date', ''),
+    ('ix_student_enrollments_class_session_active', 'student_enrollments', 'class_id, session_id, is_active', ''),
+    ('ix_student_enrollments_student_session', 'student_enrollments', 'student_id, session_id', ''),
+    ('ix_student_fees_session_status_due', 'student_fees', 'session_id, status, due_date', ''),
+    ('ix_fee_transactions_student_date', 'fee_transactions', 'student_id, transaction_date', ''),
+    ('ix_student_marks_exam_subject', 'student_marks', 'exam_id, subject_id', ''),
+]
+
+UNIQUE_INDEXES = [
+    ('uq_student_enrollments_active_student_session', 'student_enrollments', 'student_id, session_id', 'WHERE is_active'),
+]
+
+
+def upgrade():
+    connection = op.get_bind()
+    duplicates = connection.execute(sa.text(
+        'SELECT count(*) FROM (SELECT 1 FROM student_enrollments WHERE is_active '
+        'GROUP BY student_id, session_id HAVING count(*) > 1) d'
+    )).scalar()
+    if duplicates:
+        raise RuntimeError(
+            f'{duplicates} students have more than one active enrollment in a session; '
+            'deactivate the extra enrollments, then run the upgrade again'
+        )
+
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES + UNIQUE_INDEXES:
+            # A failed concurrent build leaves an invalid index behind; rebuild it
+            invalid = connection.execute(sa.text(
+                'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                'WHERE c.relname = :name AND NOT i.indisvalid'
+            ), {'name': name}).scalar()
+            if invalid:
+                op.execute(f'DROP INDEX CONCURRENTLY {name}')
+            unique = 'UNIQUE ' if (name, table, columns, where) in UNIQUE_INDEXES else ''
+            op.execute(f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns}) {where}')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in reversed(INDEXES + UNIQUE_INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,18 @@
+"""
+HTML to PDF conversion for the PDF process pools.
+
+Kept out of app.py so pool processes, which are started fresh rather than
+forked from a web or job worker, import weasyprint alone instead of the
+whole application with its database engine, mail thread and startup checks.
+"""
+try:
+    import weasyprint
+except (ImportError, OSError):  # package or its system libraries (pango) missing
+    weasyprint = None
+
+
+def html_to_pdf(html, base_url):
+    """Render an HTML document to PDF bytes"""
+    if weasyprint is None:
+        raise RuntimeError('PDF rendering requires weasyprint and its system libraries (pango)')
+    return weasyprint.HTML(string=html, base_url=base_url).write_pdf()
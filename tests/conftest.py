@@ -0,0 +1,116 @@
+"""
+Fixtures for the route benchmarks.
+
+Importing the app connects to the database DATABASE_URL points at. The
+benchmark school is created there on the first run and reused
+afterwards, so point it at a scratch copy.
+"""
+import os
+import sys
+import random
+import threading
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event, text
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (app, db, School, AcademicSession, Class, Exam, User, TeacherAssignment, StudentEnrollment,
+                 generate_synthetic_school, rollup_attendance_summaries, rebuild_school_fee_stats)
+
+DATASET = {'sessions': 1, 'classes': 10, 'students_per_class': 40, 'teachers': 15, 'exams': 3}
+DATASET_SEED = 2024
+PREFIX = 'BENCH'
+PASSWORD = 'benchmark'
+
+
+def pytest_addoption(parser):
+    parser.addoption('--latency-scale', type=float, default=1.0,
+                     help='Multiply every route latency budget, for slower machines')
+
+
+class StatementCounter:
+    """Counts the SQL statements this thread executes inside measure()"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.thread_id = None
+
+    @contextmanager
+    def measure(self):
+        self.count = 0
+        self.thread_id = threading.get_ident()
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        # Skip the mail sender and other background threads
+        if threading.get_ident() == self.thread_id:
+            self.count += 1
+
+
+@pytest.fixture(scope='session')
+def latency_scale(request):
+    return request.config.getoption('--latency-scale')
+
+
+@pytest.fixture(scope='session')
+def dataset():
+    """Create the benchmark school unless an earlier run did; returns ids and logins for the routes"""
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        school = School.query.filter_by(code=f'{PREFIX}001').first()
+        if not school:
+            result = generate_synthetic_school(1, PREFIX, random.Random(DATASET_SEED), password=PASSWORD, **DATASET)
+            db.session.commit()
+            rollup_attendance_summaries(school_id=result['school_id'])
+            for session_id in result['session_ids']:
+                rebuild_school_fee_stats(result['school_id'], session_id)
+            db.session.commit()
+            # Fresh tables have no planner statistics, which skews the first run's timings
+            db.session.execute(text('ANALYZE'))
+            db.session.commit()
+            school = db.session.get(School, result['school_id'])
+
+        session_obj = AcademicSession.query.filter_by(school_id=school.id, is_current=True).first()
+        class_obj = Class.query.filter_by(session_id=session_obj.id).order_by(Class.id).first()
+        exam = Exam.query.filter_by(class_id=class_obj.id).order_by(Exam.id).first()
+        class_teacher = TeacherAssignment.query.filter_by(class_id=class_obj.id, is_class_teacher=True).first()
+        enrollment = StudentEnrollment.query.filter_by(
+            class_id=class_obj.id
+        ).order_by(StudentEnrollment.roll_number).first()
+        return {
+            'ids': {'class_id': class_obj.id, 'exam_id': exam.id},
+            'logins': {
+                'admin': User.query.filter_by(school_id=school.id, role='admin').first().email,
+                'teacher': db.session.get(User, class_teacher.teacher_id).email,
+                'student': User.query.filter_by(student_id=enrollment.student_id).first().email
+            }
+        }
+
+
+@pytest.fixture(scope='session')
+def statement_counter(dataset):
+    with app.app_context():
+        return StatementCounter(db.engine)
+
+
+@pytest.fixture(scope='session')
+def login(dataset):
+    """Returns a logged-in test client for a role, one per role for the whole run"""
+    clients = {}
+
+    def client_for(role):
+        if role not in clients:
+            client = app.test_client()
+            response = client.post('/login', data={'email': dataset['logins'][role], 'password': PASSWORD})
+            assert response.status_code == 302, f"{role} login failed"
+            clients[role] = client
+        return clients[role]
+
+    return client_for
@@ -0,0 +1,68 @@
+"""
+Route benchmarks with query-count and latency budgets.
+
+Each major page is requested through the Flask test client as the
+matching role, and fails when its SQL statement count or median latency
+goes over budget, so a new per-row query shows up as a failure. Timings
+are collected by pytest-benchmark; compare runs across commits with
+--benchmark-autosave and --benchmark-compare.
+"""
+from collections import namedtuple
+
+import pytest
+from flask import url_for
+
+from app import app
+
+ROUNDS = 5
+
+# Budgets are statement counts and median milliseconds for one warm request
+# on the conftest dataset, including the user and context lookups every page
+# makes. Statement counts are exact, so lower them when a page gets cheaper;
+# latency budgets leave room for slower machines (see --latency-scale).
+Route = namedtuple('Route', 'endpoint role url_args max_queries max_ms')
+ROUTES = [
+    Route('admin_dashboard', 'admin', {}, 30, 300),
+    Route('manage_students', 'admin', {}, 9, 400),
+    Route('manage_classes', 'admin', {}, 16, 200),
+    Route('manage_exams', 'admin', {}, 16, 200),
+    Route('fee_dashboard', 'admin', {}, 10, 250),
+    Route('class_report_card', 'admin', {'class_id': 'class_id'}, 7, 250),
+    Route('view_exam_results', 'admin', {'exam_id': 'exam_id'}, 11, 250),
+    Route('admin_timetable', 'admin', {}, 9, 150),
+    Route('teacher_dashboard', 'teacher', {}, 31, 400),
+    Route('teacher_attendance_dashboard', 'teacher', {}, 34, 400),
+    Route('take_attendance', 'teacher', {'class_id': 'class_id'}, 14, 150),
+    Route('student_dashboard', 'student', {}, 9, 150),
+    Route('student_attendance', 'student', {}, 23, 250),
+    Route('student_fees', 'student', {}, 13, 150),
+]
+
+
+@pytest.mark.parametrize('route', ROUTES, ids=lambda route: route.endpoint)
+def test_route_within_budget(route, benchmark, dataset, login, statement_counter, latency_scale):
+    client = login(route.role)
+    with app.test_request_context():
+        url = url_for(route.endpoint, **{arg: dataset['ids'][key] for arg, key in route.url_args.items()})
+
+    # Warm up caches outside the measurement
+    assert client.get(url).status_code == 200
+
+    statuses = []
+    queries = []
+
+    def request_page():
+        with statement_counter.measure() as counter:
+            response = client.get(url)
+        statuses.append(response.status_code)
+        queries.append(counter.count)
+
+    benchmark.pedantic(request_page, rounds=ROUNDS, iterations=1)
+
+    assert set(statuses) == {200}, f"HTTP {statuses}"
+    assert max(queries) <= route.max_queries, f"{max(queries)} queries > {route.max_queries}"
+    # No stats when run with --benchmark-disable
+    if benchmark.stats:
+        median_ms = benchmark.stats.stats.median * 1000
+        budget_ms = route.max_ms * latency_scale
+        assert median_ms <= budget_ms, f"{median_ms:.0f} ms > {budget_ms:.0f}"